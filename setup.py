@@ -1,11 +1,17 @@
+import re
+
 import setuptools
 
 with open("README.md", "r", encoding="utf-8") as fh:
     long_description = fh.read()
 
+# The version lives in the package so nimbo can report it without pkg_resources
+with open("src/nimbo/__init__.py", "r", encoding="utf-8") as fh:
+    version = re.search(r'^version = "(.+)"$', fh.read(), re.MULTILINE).group(1)
+
 setuptools.setup(
     name="nimbo",  # Replace with your own username
-    version="0.3.1",
+    version=version,
     author="NimboSH, Ltd.",
     author_email="support@nimbo.sh",
     description="Run machine learning jobs on AWS with a single command.",
@@ -22,7 +28,7 @@ setuptools.setup(
     ],
     package_dir={"": "src"},
     packages=setuptools.find_packages(where="src"),
-    package_data={"nimbo": ["scripts/*.sh"]},
+    package_data={"nimbo": ["scripts/*.sh", "scripts/*.py"]},
     include_package_data=True,
     entry_points={"console_scripts": ["nimbo=nimbo.main:cli"]},
     python_requires=">=3.6",
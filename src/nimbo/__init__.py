@@ -3,28 +3,28 @@ import re
 import sys
 import typing as t
 
-import pkg_resources
-import pydantic
-
-import nimbo.core.config
-import nimbo.tests.aws.config
 from nimbo.core.config import RequiredCase
-from nimbo.core.config.aws_config import AwsConfig
-from nimbo.core.config.common_config import CloudProvider
-from nimbo.core.config.gcp_config import GcpConfig
 from nimbo.core.constants import IS_TEST_ENV
 from nimbo.core.print import nprint
 
-version = pkg_resources.get_distribution("nimbo").version
+if t.TYPE_CHECKING:
+    from nimbo.core.config.aws_config import AwsConfig
+    from nimbo.core.config.gcp_config import GcpConfig
+
+# Kept in sync with setup.py, which reads it from here. Looking the version up
+# through pkg_resources used to dominate the startup time of every command.
+version = "0.3.1"
 
 
-CONFIG: t.Optional[t.Union[AwsConfig, GcpConfig]] = None
+CONFIG: t.Optional[t.Union["AwsConfig", "GcpConfig"]] = None
 _CLOUD = None
 
 
 def set_config(config_factory, config_path):
     global CONFIG, _CLOUD
 
+    import pydantic
+
     try:
         CONFIG = config_factory(config_path)
     except pydantic.error_wrappers.ValidationError as e:
@@ -38,17 +38,34 @@ def set_config(config_factory, config_path):
         print(new_title + re.sub(r"\(type=.*\)", "", e_msg[title_end:]))
         sys.exit(1)
 
-    # Both of these imports depend on this file
-    from nimbo.core.cloud_provider.provider_impl.aws.aws_provider import AwsProvider
-    from nimbo.core.cloud_provider.provider_impl.gcp.gcp_provider import GcpProvider
+    # The provider, and with it boto3, is created the first time a command needs it
+    _CLOUD = None
+
+
+def _get_cloud():
+    global _CLOUD
 
-    if CONFIG.cloud_provider == CloudProvider.AWS:
-        _CLOUD = AwsProvider()
-    else:
-        _CLOUD = GcpProvider()
+    if _CLOUD is None:
+        # Both of these imports depend on this file
+        from nimbo.core.cloud_provider.provider_impl.aws.aws_provider import (
+            AwsProvider,
+        )
+        from nimbo.core.cloud_provider.provider_impl.gcp.gcp_provider import (
+            GcpProvider,
+        )
+        from nimbo.core.config import CloudProvider
+
+        if CONFIG.cloud_provider == CloudProvider.AWS:
+            _CLOUD = AwsProvider()
+        else:
+            _CLOUD = GcpProvider()
+
+    return _CLOUD
 
 
 if IS_TEST_ENV:
+    import nimbo.tests.aws.config
+
     set_config(nimbo.tests.aws.config.make_config, "nimbo-config.yml")
 
 
@@ -83,7 +100,7 @@ def cloud_context(func):
 
     @functools.wraps(func)
     def decorated(*args, **kwargs):
-        kwargs["cloud"] = _CLOUD
+        kwargs["cloud"] = _get_cloud()
         return func(*args, **kwargs)
 
     return decorated
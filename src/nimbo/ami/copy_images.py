@@ -1,42 +1,146 @@
+"""
+Copy a production image to every region.
+
+The copies are started in all regions at once and polled with backoff until
+they are available, so publishing takes about as long as the slowest region.
+Every copy is tagged like the source image once it is available. The resulting
+region to AMI map is printed as an 'image:' block for the nimbo config, where
+the image of region_name is used, and written as JSON with --output.
+
+Usage:
+    python copy_images.py [--source-region REGION] [--profile PROFILE]
+                          [--regions REGION ...] [--output PATH] IMAGE_ID
+"""
+
+import argparse
+import json
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import boto3
+import botocore.exceptions
+
+from nimbo.core.constants import FULL_REGION_NAMES
+
+POLL_DELAY = 10
+MAX_POLL_DELAY = 60
+# Copying a large image to a far away region can take well over an hour
+COPY_TIMEOUT = 3 * 3600
+
+
+def find_source_image(ec2, image_id):
+    response = ec2.describe_images(
+        Filters=[
+            {"Name": "tag:CreatedBy", "Values": ["nimbo"]},
+            {"Name": "tag:Type", "Values": ["production"]},
+        ],
+        ImageIds=[image_id],
+    )
+    if not response["Images"]:
+        raise ValueError(f"{image_id} is not a nimbo production image")
+    return response["Images"][0]
+
+
+def wait_until_available(ec2, image_id, timeout):
+    delay = POLL_DELAY
+    deadline = time.monotonic() + timeout
+
+    while time.monotonic() < deadline:
+        try:
+            images = ec2.describe_images(ImageIds=[image_id])["Images"]
+        except botocore.exceptions.ClientError as e:
+            # A new copy is not always visible to DescribeImages right away
+            if e.response["Error"]["Code"] != "InvalidAMIID.NotFound":
+                raise
+            images = []
+
+        state = images[0]["State"] if images else "pending"
+        if state == "available":
+            return
+        if state != "pending":
+            raise RuntimeError(f"Copy {image_id} is {state}")
+
+        time.sleep(delay)
+        delay = min(delay * 1.5, MAX_POLL_DELAY)
+
+    raise TimeoutError(f"Copy {image_id} was not available after {timeout} s")
 
-from nimbo import CONFIG
-
-image_id = sys.argv[1]
-
-base_region = "eu-west-1"
-session = boto3.Session(profile_name="nimbo", region_name=base_region)
-ec2 = session.client("ec2")
-response = ec2.describe_images(
-    Filters=[
-        {"Name": "tag:CreatedBy", "Values": ["nimbo"]},
-        {"Name": "tag:Type", "Values": ["production"]},
-    ],
-    ImageIds=[image_id],
-)
-image = response["Images"][0]
-
-for dest_region in CONFIG.full_region_names.keys():
-    if dest_region == base_region:
-        continue
-    print(dest_region)
-    session = boto3.Session(profile_name="nimbo", region_name=dest_region)
-    ec2 = session.client("ec2")
 
+def copy_to_region(ec2, image, source_region, timeout):
+    """ Copy image into the region of the ec2 client and return the new image id """
+
+    # The client token makes reruns pick up copies that are already in progress
     response = ec2.copy_image(
-        ClientToken=image_id,
+        ClientToken=image["ImageId"],
         Name=image["Name"],
-        SourceImageId=image_id,
-        SourceRegion=base_region,
-        Description=image["Description"],
+        SourceImageId=image["ImageId"],
+        SourceRegion=source_region,
+        Description=image.get("Description", ""),
     )
     new_image_id = response["ImageId"]
-    ec2.create_tags(
-        Resources=[new_image_id],
-        Tags=[
-            {"Key": "CreatedBy", "Value": "nimbo"},
-            {"Key": "Type", "Value": "production"},
-        ],
+
+    wait_until_available(ec2, new_image_id, timeout)
+
+    tags = [tag for tag in image["Tags"] if not tag["Key"].startswith("aws:")]
+    ec2.create_tags(Resources=[new_image_id], Tags=tags)
+    return new_image_id
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("image_id")
+    parser.add_argument("--source-region", default="eu-west-1")
+    parser.add_argument("--profile", default="nimbo")
+    parser.add_argument("--regions", nargs="+", default=list(FULL_REGION_NAMES))
+    parser.add_argument("--output", default=None)
+    parser.add_argument("--timeout", type=int, default=COPY_TIMEOUT)
+    args = parser.parse_args()
+
+    session = boto3.Session(profile_name=args.profile)
+    image = find_source_image(
+        session.client("ec2", region_name=args.source_region), args.image_id
     )
+
+    # Clients are thread safe, but creating them from one session is not
+    regions = [r for r in args.regions if r != args.source_region]
+    clients = {r: session.client("ec2", region_name=r) for r in regions}
+
+    images = {args.source_region: args.image_id}
+    failed = []
+    start = time.monotonic()
+
+    with ThreadPoolExecutor(max_workers=max(len(regions), 1)) as executor:
+        futures = {
+            executor.submit(
+                copy_to_region, clients[r], image, args.source_region, args.timeout
+            ): r
+            for r in regions
+        }
+        for future in as_completed(futures):
+            region = futures[future]
+            elapsed = round(time.monotonic() - start)
+            try:
+                images[region] = future.result()
+                print(f"{region}: {images[region]} ({elapsed} s)", flush=True)
+            except Exception as e:
+                failed.append(region)
+                print(f"{region}: copy failed, {e}", flush=True)
+
+    images = dict(sorted(images.items()))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(images, f, indent=4)
+
+    print("\nimage:")
+    for region, image_id in images.items():
+        print(f"  {region}: {image_id}")
+
+    if failed:
+        print(f"\nCopying failed in {', '.join(sorted(failed))}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -28,6 +28,9 @@ echo "source $CONDASH" >> .bashrc
 
 rm Miniconda3-latest-Linux-x86_64.sh
 
+# boto3 in the base environment is used by the nimbo agents on the instance
+$CONDA_PATH/bin/pip install -q boto3
+
 
 # Install cudatoolkit 10.2
 wget https://developer.download.nvidia.com/compute/cuda/repos/ubuntu1804/x86_64/cuda-ubuntu1804.pin
@@ -0,0 +1,191 @@
+"""
+Accounting, retries and coalescing of the AWS API calls made by nimbo.
+
+Every client is created with botocore's adaptive retry mode, which retries
+throttled calls with backoff and rate limits the client once AWS starts
+throttling it. Clients are shared by all threads of a command, so a burst of
+sweep jobs backs off together instead of each failing on RequestLimitExceeded.
+
+Calls are counted per operation, including the retries botocore made and the
+calls that were coalesced: identical Describe calls made while the same call
+is already in flight on the same client wait for its response instead of being
+sent again. Run any command with --stats to print the counters.
+
+botocore is only imported once a client is created, to keep it out of the CLI
+startup path.
+"""
+
+import collections
+import copy
+import functools
+import threading
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+# Adaptive mode retries throttling errors and rate limits the client itself
+_RETRY_MODE = "adaptive"
+_MAX_ATTEMPTS = 10
+# Only read-only calls are safe to answer with the response of another call
+_COALESCED_PREFIX = "Describe"
+# Longest wait for an in-flight call, after which the call is made on its own
+_COALESCE_TIMEOUT = 60
+_OPERATION_CONTEXT_KEY = "nimbo_operation"
+_IN_FLIGHT_CONTEXT_KEY = "nimbo_in_flight"
+_COALESCED_CONTEXT_KEY = "nimbo_coalesced"
+
+_calls: Dict[Tuple[str, str], int] = collections.Counter()
+_retries: Dict[Tuple[str, str], int] = collections.Counter()
+_coalesced: Dict[Tuple[str, str], int] = collections.Counter()
+_in_flight: Dict[Hashable, "_InFlight"] = {}
+_lock = threading.Lock()
+
+
+class _InFlight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.response: Optional[Tuple[Any, Dict]] = None
+
+
+def client_config(max_pool_connections: Optional[int] = None) -> Any:
+    """ botocore client config with adaptive retries """
+
+    import botocore.config
+
+    kwargs = {"retries": {"mode": _RETRY_MODE, "max_attempts": _MAX_ATTEMPTS}}
+    if max_pool_connections:
+        kwargs["max_pool_connections"] = max_pool_connections
+    return botocore.config.Config(**kwargs)
+
+
+def instrument(client: Any) -> Any:
+    """ Count the calls made by client and coalesce its concurrent Describe calls """
+
+    events = client.meta.events
+    # Registered first, so that a coalesced call returns before any other
+    # before-call handler sees it. Calls are only coalesced per client, as
+    # clients of other profiles may see other resources.
+    events.register_first(
+        "before-call", functools.partial(_before_call, client_id=id(client))
+    )
+    events.register("after-call", _after_call)
+    events.register("after-call-error", _after_call_error)
+    return client
+
+
+def _operation(model) -> Tuple[str, str]:
+    return model.service_model.service_name, model.name
+
+
+def _before_call(model, params, context, client_id, **kwargs):
+    # after-call-error is not given the model, so keep the operation around
+    context[_OPERATION_CONTEXT_KEY] = _operation(model)
+
+    if not model.name.startswith(_COALESCED_PREFIX):
+        return None
+
+    key = (
+        client_id,
+        _operation(model),
+        params.get("url_path"),
+        params.get("query_string") and repr(params["query_string"]),
+        repr(params.get("body")),
+    )
+
+    with _lock:
+        in_flight = _in_flight.get(key)
+        if in_flight is None:
+            _in_flight[key] = _InFlight()
+            context[_IN_FLIGHT_CONTEXT_KEY] = key
+            return None
+
+    if not in_flight.done.wait(_COALESCE_TIMEOUT):
+        with _lock:
+            if _in_flight.get(key) is in_flight:
+                del _in_flight[key]
+    if in_flight.response is None:
+        # The call failed without a response, make this one on its own
+        return None
+
+    context[_COALESCED_CONTEXT_KEY] = True
+    http_response, parsed = in_flight.response
+    return http_response, copy.deepcopy(parsed)
+
+
+def _after_call(http_response, parsed, model, context, **kwargs):
+    operation = _operation(model)
+
+    with _lock:
+        if context.get(_COALESCED_CONTEXT_KEY):
+            _coalesced[operation] += 1
+        else:
+            _calls[operation] += 1
+            _retries[operation] += parsed.get("ResponseMetadata", {}).get(
+                "RetryAttempts", 0
+            )
+
+        in_flight = _in_flight.pop(context.get(_IN_FLIGHT_CONTEXT_KEY), None)
+
+    if in_flight is not None:
+        in_flight.response = (http_response, copy.deepcopy(parsed))
+        in_flight.done.set()
+
+
+def _after_call_error(context, **kwargs):
+    with _lock:
+        if _OPERATION_CONTEXT_KEY in context:
+            _calls[context[_OPERATION_CONTEXT_KEY]] += 1
+        in_flight = _in_flight.pop(context.get(_IN_FLIGHT_CONTEXT_KEY), None)
+
+    if in_flight is not None:
+        in_flight.done.set()
+
+
+def stats() -> List[Dict[str, Any]]:
+    """ Calls, retries and coalesced calls of every operation called so far """
+
+    with _lock:
+        operations = sorted(set(_calls) | set(_coalesced))
+        return [
+            {
+                "service": service,
+                "operation": operation,
+                "calls": _calls[(service, operation)],
+                "retries": _retries[(service, operation)],
+                "coalesced": _coalesced[(service, operation)],
+            }
+            for service, operation in operations
+        ]
+
+
+def reset() -> None:
+    with _lock:
+        _calls.clear()
+        _retries.clear()
+        _coalesced.clear()
+
+
+def print_stats() -> None:
+    from rich.table import Table
+
+    from nimbo.core.print import nprint
+
+    rows = stats()
+    table = Table("Service", "Operation", "Calls", "Retries", "Coalesced")
+    for row in rows:
+        table.add_row(
+            row["service"],
+            row["operation"],
+            str(row["calls"]),
+            str(row["retries"]),
+            str(row["coalesced"]),
+        )
+    table.add_row(
+        "total",
+        "",
+        str(sum(row["calls"] for row in rows)),
+        str(sum(row["retries"] for row in rows)),
+        str(sum(row["coalesced"] for row in rows)),
+        style="bold",
+    )
+
+    print()
+    nprint(table)
@@ -0,0 +1,49 @@
+import json
+import os
+import tempfile
+import time
+from typing import Any, Optional
+
+from nimbo.core.constants import NIMBO_CACHE_DIR
+
+
+def _cache_file(name: str) -> str:
+    return os.path.join(NIMBO_CACHE_DIR, f"{name}.json")
+
+
+def _read_entries(name: str) -> dict:
+    try:
+        with open(_cache_file(name), "r") as f:
+            entries = json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+    return entries if isinstance(entries, dict) else {}
+
+
+def load(name: str, key: str, ttl: float) -> Optional[Any]:
+    """ Return the value cached under name/key if it is younger than ttl seconds """
+
+    entry = _read_entries(name).get(key)
+    if not entry or time.time() - entry.get("time", 0) > ttl:
+        return None
+
+    return entry.get("value")
+
+
+def store(name: str, key: str, value: Any) -> None:
+    """ Cache a JSON serialisable value under name/key, ignoring any IO errors """
+
+    entries = _read_entries(name)
+    entries[key] = {"time": time.time(), "value": value}
+
+    try:
+        os.makedirs(NIMBO_CACHE_DIR, exist_ok=True)
+        # Write to a temporary file first so that concurrent nimbo processes
+        # never observe a partially written cache file
+        fd, tmp_path = tempfile.mkstemp(dir=NIMBO_CACHE_DIR, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(entries, f)
+        os.replace(tmp_path, _cache_file(name))
+    except OSError:
+        pass
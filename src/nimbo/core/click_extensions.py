@@ -2,7 +2,6 @@ import enum
 import functools
 import sys
 
-import botocore.errorfactory
 import click
 
 from nimbo.core.constants import IS_TEST_ENV
@@ -22,6 +21,21 @@ class NimboCommand(click.Command):
     def __init__(self, *args, **kwargs):
         self.help_section: HelpSection = kwargs.pop("help_section", None)
         super().__init__(*args, **kwargs)
+        self.params.append(
+            click.Option(
+                ["--stats"],
+                is_flag=True,
+                help="Print the AWS API calls made by the command.",
+            )
+        )
+
+    def invoke(self, ctx: click.Context):
+        # The flag is handled here rather than passed on to the command
+        if ctx.params.pop("stats", False):
+            from nimbo.core import api_calls
+
+            ctx.call_on_close(api_calls.print_stats)
+        return super().invoke(ctx)
 
 
 class NimboGroup(click.Group):
@@ -78,6 +92,9 @@ def pprint_errors(func):
         if IS_TEST_ENV:
             return func(*args, **kwargs)
         else:
+            # Imported here to keep botocore out of the CLI startup path
+            import botocore.errorfactory
+
             try:
                 return func(*args, **kwargs)
             except botocore.errorfactory.ClientError as e:
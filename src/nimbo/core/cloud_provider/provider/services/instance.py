@@ -1,19 +1,49 @@
 import abc
 import os
+import shlex
 import socket
 import subprocess
+import sys
+import tarfile
 import time
-from typing import Dict
+from typing import Dict, List, Optional, Tuple
 
 from nimbo import CONFIG
-from nimbo.core.constants import NIMBO_ROOT
+from nimbo.core import manifest
+from nimbo.core.constants import (
+    NIMBO_REMOTE_LOG,
+    NIMBO_ROOT,
+    SSH_CONTROL_PATH,
+    SSH_CONTROL_PERSIST,
+)
 from nimbo.core.print import nprint, nprint_header
+from nimbo.core.scheduler import Resources
 
 
 class Instance(abc.ABC):
     @staticmethod
     @abc.abstractmethod
-    def run(job_cmd: str, dry_run=False) -> Dict[str, str]:
+    def run(job_cmd: str, dry_run=False, watch_spot=False) -> Dict[str, str]:
+        ...
+
+    @staticmethod
+    @abc.abstractmethod
+    def run_sweep(
+        job_cmds: List[str],
+        resources: Optional[Resources] = None,
+        max_instances: Optional[int] = None,
+        dry_run=False,
+    ) -> List[Dict[str, str]]:
+        ...
+
+    @staticmethod
+    @abc.abstractmethod
+    def bake_image(dry_run=False) -> Optional[str]:
+        ...
+
+    @staticmethod
+    @abc.abstractmethod
+    def snapshot_datasets(dry_run=False) -> Optional[str]:
         ...
 
     @staticmethod
@@ -23,7 +53,7 @@ class Instance(abc.ABC):
 
     @staticmethod
     @abc.abstractmethod
-    def _block_until_instance_running(instance_id: str) -> None:
+    def _block_until_instance_running(instance_id: str) -> str:
         ...
 
     @staticmethod
@@ -48,7 +78,7 @@ class Instance(abc.ABC):
 
     @staticmethod
     @abc.abstractmethod
-    def delete_all_instances(dry_run=False) -> None:
+    def delete_all_instances(dry_run=False, all_regions=False) -> None:
         ...
 
     @staticmethod
@@ -61,6 +91,11 @@ class Instance(abc.ABC):
     def ls_active_instances(dry_run=False) -> None:
         ...
 
+    @staticmethod
+    @abc.abstractmethod
+    def logs(instance_id: str, follow=False, dry_run=False) -> None:
+        ...
+
     @staticmethod
     @abc.abstractmethod
     def ls_stopped_instances(dry_run=False) -> None:
@@ -73,26 +108,84 @@ class Instance(abc.ABC):
         if dry_run:
             return
 
-        subprocess.Popen(
-            f"ssh -i {CONFIG.instance_key} "
-            f"-o 'StrictHostKeyChecking no' -o ServerAliveInterval=20 "
-            f"ubuntu@{host}",
-            shell=True,
-        ).communicate()
+        subprocess.Popen(f"{cls._ssh_cmd()} ubuntu@{host}", shell=True).communicate()
 
     @classmethod
     def sync_notebooks(cls, instance_id: str):
         host = cls._get_host_from_instance_id(instance_id)
 
         subprocess.Popen(
-            f"rsync -avm -e 'ssh -i {CONFIG.instance_key}' "
+            f"rsync -avm -e '{cls._ssh_cmd()}' "
             f"--include '*/' --include '*.ipynb' --exclude '*' "
             f"ubuntu@{host}:/home/ubuntu/project/ .",
             shell=True,
         ).communicate()
 
     @staticmethod
-    def _sync_code(host: str) -> None:
+    def _stream_remote_log(host: str, offset: int, follow: bool) -> Tuple[int, int]:
+        """
+        Write the job log of host to stdout from byte offset on, over the shared
+        ssh connection. Returns the exit code of ssh and the offset reached, from
+        which a dropped connection can be resumed.
+        """
+
+        tail_flags = "-F " if follow else ""
+        process = subprocess.Popen(
+            f"{Instance._ssh_cmd()} ubuntu@{host} "
+            f"'tail -c +{offset + 1} {tail_flags}{NIMBO_REMOTE_LOG}'",
+            stdout=subprocess.PIPE,
+            shell=True,
+        )
+
+        try:
+            while True:
+                chunk = os.read(process.stdout.fileno(), 64 * 1024)
+                if not chunk:
+                    break
+                sys.stdout.buffer.write(chunk)
+                sys.stdout.buffer.flush()
+                offset += len(chunk)
+        finally:
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+
+        return process.returncode, offset
+
+    @staticmethod
+    def _ssh_options(multiplexed=True) -> str:
+        """
+        Options shared by ssh, scp and rsync so that all of them reuse a single
+        multiplexed master connection per host instead of a new key exchange.
+        Connections that must outlive the master are not multiplexed.
+        """
+
+        options = f"-i {CONFIG.instance_key} -o StrictHostKeyChecking=no "
+        options += "-o ServerAliveInterval=5 "
+        if multiplexed:
+            options += (
+                f"-o ControlMaster=auto -o ControlPath={SSH_CONTROL_PATH} "
+                f"-o ControlPersist={SSH_CONTROL_PERSIST}"
+            )
+        else:
+            options += "-o ControlMaster=no -o ControlPath=none"
+        return options
+
+    @staticmethod
+    def _ssh_cmd(multiplexed=True) -> str:
+        return f"ssh {Instance._ssh_options(multiplexed)}"
+
+    @staticmethod
+    def _scp_cmd() -> str:
+        return f"scp {Instance._ssh_options()}"
+
+    @staticmethod
+    def _sync_code(host: str, instance_id: str) -> None:
+        """
+        Ship files that changed since the last sync to this instance as a single
+        gzipped tar stream, and remove files that no longer exist locally
+        """
+
         if ".git" not in os.listdir():
             nprint(
                 "No git repo found. Syncing all python and bash files as a fallback.",
@@ -101,30 +194,36 @@ class Instance(abc.ABC):
             nprint(
                 "Please consider using git to track the files to sync.", style="warning"
             )
-            subprocess.Popen(
-                f"rsync -avm -e 'ssh -i {CONFIG.instance_key}' "
-                f"--include '*/' --include '*.py' --include '*.ipynb' --include '*.sh' "
-                f"--exclude '*' "
-                f". ubuntu@{host}:/home/ubuntu/project",
-                shell=True,
-            ).communicate()
-        else:
-            output, error = subprocess.Popen(
-                "git ls-tree -r HEAD --name-only",
-                stdout=subprocess.PIPE,
-                shell=True,
-            ).communicate()
-            git_tracked_files = output.decode("utf-8").strip().splitlines()
-            include_files = [
-                f"--include '{file_name}'" for file_name in git_tracked_files
-            ]
-            include_string = " ".join(include_files)
-            subprocess.Popen(
-                f"rsync -amr -e 'ssh -i {CONFIG.instance_key}' "
-                f"--include '*/' {include_string} --exclude '*' "
-                f". ubuntu@{host}:/home/ubuntu/project",
-                shell=True,
-            ).communicate()
+
+        previous = manifest.load(instance_id)
+        current = manifest.build(manifest.project_files(), previous)
+        changed, removed = manifest.diff(current, previous)
+
+        if not changed and not removed:
+            nprint("Code is up to date.")
+            return
+
+        remote_cmd = "tar -xzf - -C /home/ubuntu/project"
+        if removed:
+            remote_cmd += " && cd /home/ubuntu/project && rm -f -- " + " ".join(
+                shlex.quote(path) for path in removed
+            )
+
+        process = subprocess.Popen(
+            f"{Instance._ssh_cmd()} ubuntu@{host} {shlex.quote(remote_cmd)}",
+            stdin=subprocess.PIPE,
+            shell=True,
+        )
+        with tarfile.open(fileobj=process.stdin, mode="w|gz") as tar:
+            for path in changed:
+                tar.add(path)
+        process.stdin.close()
+
+        if process.wait() != 0:
+            raise subprocess.CalledProcessError(process.returncode, "code sync")
+
+        manifest.save(instance_id, current)
+        nprint(f"Synced {len(changed)} changed and {len(removed)} removed files.")
 
     @staticmethod
     def _block_until_ssh_ready(host: str) -> None:
@@ -134,19 +233,20 @@ class Instance(abc.ABC):
         )
 
         start = time.monotonic()
+        deadline = start + CONFIG.ssh_timeout
 
-        reconnect_count = 0
-        while reconnect_count < CONFIG.ssh_timeout:
+        while time.monotonic() < deadline:
+            probe_start = time.monotonic()
             sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             sock.settimeout(1)
             error_num = sock.connect_ex((host, 22))
             sock.close()
-            
+
             if error_num == 0:
                 break
 
-            time.sleep(1)
-            reconnect_count += 1
+            # Refused connections return immediately, don't spin on them
+            time.sleep(max(0.0, 0.5 - (time.monotonic() - probe_start)))
         else:
             raise RuntimeError(
                 "Something went wrong while connecting to the instance.\n"
@@ -165,23 +265,32 @@ class Instance(abc.ABC):
         instance_id: str,
         job_cmd: str,
         script: str,
-    ) -> None:
+    ) -> int:
+        """ Run a setup script on the instance, returning the exit code of ssh """
 
-        remote_script = os.path.join(NIMBO_ROOT, "scripts", script)
+        # The python agents used by the setup scripts are shipped alongside them
+        scripts_dir = os.path.join(NIMBO_ROOT, "scripts")
+        remote_scripts = [os.path.join(scripts_dir, script)] + [
+            os.path.join(scripts_dir, agent)
+            for agent in sorted(os.listdir(scripts_dir))
+            if agent.endswith(".py")
+        ]
         subprocess.check_output(
-            f"{scp_cmd} {remote_script} ubuntu@{host}:/home/ubuntu/", shell=True
+            f"{scp_cmd} {' '.join(remote_scripts)} ubuntu@{host}:/home/ubuntu/",
+            shell=True,
         )
 
-        nimbo_log = "/home/ubuntu/nimbo-log.txt"
         bash_cmd = f"bash {script}"
         if CONFIG.run_in_background:
             full_command = (
                 f"nohup {bash_cmd} {instance_id} {job_cmd}"
-                f" </dev/null >{nimbo_log} 2>&1 &"
+                f" </dev/null >{NIMBO_REMOTE_LOG} 2>&1 &"
             )
         else:
             full_command = f"{bash_cmd} {instance_id} {job_cmd}"
 
-        subprocess.Popen(
+        process = subprocess.Popen(
             f'{ssh_cmd} ubuntu@{host} "{full_command}"', shell=True
-        ).communicate()
+        )
+        process.communicate()
+        return process.returncode
@@ -1,4 +1,5 @@
 import abc
+from typing import Optional
 
 
 class Utils(abc.ABC):
@@ -16,3 +17,8 @@ class Utils(abc.ABC):
     @abc.abstractmethod
     def spending(qty: int, timescale: str, dry_run=False) -> None:
         ...
+
+    @staticmethod
+    @abc.abstractmethod
+    def timings(instance_id: str, output: Optional[str] = None, dry_run=False) -> None:
+        ...
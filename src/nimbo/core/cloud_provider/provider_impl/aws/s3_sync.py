@@ -0,0 +1,173 @@
+"""
+In-process replacement for 'aws s3 sync', built on boto3's s3transfer manager.
+
+Both sides are listed once, compared by size and modification time (the same
+rule awscli uses) and only the differing files are transferred, with a single
+transfer manager spreading all files across a shared pool of worker threads.
+"""
+
+import os
+from typing import Dict, List, NamedTuple, Tuple
+
+from boto3.s3.transfer import TransferConfig, create_transfer_manager
+
+from nimbo import CONFIG
+from nimbo.core.print import nprint
+
+# S3 DeleteObjects accepts at most 1000 keys per request
+_DELETE_BATCH_SIZE = 1000
+
+
+class FileInfo(NamedTuple):
+    size: int
+    mtime: float
+
+
+class SyncPlan(NamedTuple):
+    transfer: List[str]
+    delete: List[str]
+
+
+def split_s3_path(path: str) -> Tuple[str, str]:
+    """ Split s3://bucket/some/prefix into ("bucket", "some/prefix/") """
+
+    if not path.startswith("s3://"):
+        raise ValueError(f"'{path}' is not an S3 path of the form s3://bucket/path")
+
+    bucket, _, prefix = path[len("s3://") :].partition("/")
+    prefix = prefix.strip("/")
+    return bucket, prefix + "/" if prefix else ""
+
+
+def list_local(folder: str) -> Dict[str, FileInfo]:
+    """ Map every file under folder, by its '/' separated relative path """
+
+    files = {}
+
+    for root, _, file_names in os.walk(folder):
+        for file_name in file_names:
+            path = os.path.join(root, file_name)
+            rel_path = os.path.relpath(path, folder).replace(os.sep, "/")
+            stat = os.stat(path)
+            files[rel_path] = FileInfo(stat.st_size, stat.st_mtime)
+
+    return files
+
+
+def list_remote(client, bucket: str, prefix: str) -> Dict[str, FileInfo]:
+    """ Map every object under prefix, by its key relative to prefix """
+
+    files = {}
+    paginator = client.get_paginator("list_objects_v2")
+
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            rel_key = obj["Key"][len(prefix) :]
+            # Skip "folder" placeholder objects created by the S3 console
+            if rel_key and not rel_key.endswith("/"):
+                files[rel_key] = FileInfo(obj["Size"], obj["LastModified"].timestamp())
+
+    return files
+
+
+def make_plan(
+    source: Dict[str, FileInfo], target: Dict[str, FileInfo], delete=False
+) -> SyncPlan:
+    """
+    A file is transferred when it is missing from the target, differs in size,
+    or is newer in the source than in the target
+    """
+
+    transfer = []
+    for rel_path, info in source.items():
+        existing = target.get(rel_path)
+        if (
+            existing is None
+            or existing.size != info.size
+            or info.mtime > existing.mtime
+        ):
+            transfer.append(rel_path)
+
+    to_delete = [path for path in target if path not in source] if delete else []
+
+    return SyncPlan(sorted(transfer), sorted(to_delete))
+
+
+def sync(source: str, target: str, delete=False) -> None:
+    """ Sync a local folder to an S3 path or an S3 path to a local folder """
+
+    client = CONFIG.get_client("s3", max_pool_connections=CONFIG.s3_transfer_workers)
+    transfer_config = TransferConfig(
+        max_concurrency=CONFIG.s3_transfer_workers,
+        multipart_chunksize=CONFIG.s3_chunk_size_mb * 1024 * 1024,
+        multipart_threshold=CONFIG.s3_chunk_size_mb * 1024 * 1024,
+    )
+
+    if target.startswith("s3://"):
+        bucket, prefix = split_s3_path(target)
+        plan = make_plan(
+            list_local(source), list_remote(client, bucket, prefix), delete
+        )
+        _upload(client, transfer_config, plan, source, bucket, prefix)
+    else:
+        bucket, prefix = split_s3_path(source)
+        remote = list_remote(client, bucket, prefix)
+        plan = make_plan(remote, list_local(target), delete)
+        _download(client, transfer_config, plan, remote, bucket, prefix, target)
+
+    nprint(
+        f"{len(plan.transfer)} file{'' if len(plan.transfer) == 1 else 's'} "
+        f"transferred, {len(plan.delete)} deleted."
+    )
+
+
+def _upload(client, transfer_config, plan, folder, bucket, prefix) -> None:
+    extra_args = {}
+    if CONFIG.encryption:
+        extra_args["ServerSideEncryption"] = CONFIG.encryption
+
+    with create_transfer_manager(client, transfer_config) as manager:
+        futures = [
+            manager.upload(
+                os.path.join(folder, *rel_path.split("/")),
+                bucket,
+                prefix + rel_path,
+                extra_args=extra_args,
+            )
+            for rel_path in plan.transfer
+        ]
+        for future in futures:
+            future.result()
+
+    for i in range(0, len(plan.delete), _DELETE_BATCH_SIZE):
+        batch = plan.delete[i : i + _DELETE_BATCH_SIZE]
+        client.delete_objects(
+            Bucket=bucket,
+            Delete={"Objects": [{"Key": prefix + key} for key in batch], "Quiet": True},
+        )
+
+
+def _download(client, transfer_config, plan, remote, bucket, prefix, folder) -> None:
+    paths = {
+        rel_path: os.path.join(folder, *rel_path.split("/"))
+        for rel_path in plan.transfer
+    }
+
+    for path in paths.values():
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    with create_transfer_manager(client, transfer_config) as manager:
+        futures = [
+            manager.download(bucket, prefix + rel_path, path)
+            for rel_path, path in paths.items()
+        ]
+        for future in futures:
+            future.result()
+
+    # Match local modification times to S3 so the next sync sees them as equal
+    for rel_path, path in paths.items():
+        mtime = remote[rel_path].mtime
+        os.utime(path, (mtime, mtime))
+
+    for rel_path in plan.delete:
+        os.remove(os.path.join(folder, *rel_path.split("/")))
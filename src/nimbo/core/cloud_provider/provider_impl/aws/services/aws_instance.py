@@ -1,46 +1,114 @@
+import functools
+import hashlib
+import json
+import math
+import os
+import re
+import shlex
+import shutil
 import subprocess
 import sys
+import tarfile
+import tempfile
+import threading
 import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from pprint import pprint
-from typing import Dict, List, Union
+from typing import Dict, Generator, List, Optional, Tuple, Union
 
 import botocore.exceptions
 import requests
 
 from nimbo import CONFIG
+from nimbo.core import manifest, scheduler, timing
 from nimbo.core.cloud_provider.provider.services.instance import Instance
+from nimbo.core.cloud_provider.provider_impl.aws import s3_sync
 from nimbo.core.cloud_provider.provider_impl.aws.services.aws_permissions import (
     AwsPermissions,
 )
 from nimbo.core.cloud_provider.provider_impl.aws.services.aws_storage import AwsStorage
-from nimbo.core.constants import NIMBO_VARS
-from nimbo.core.print import nprint, nprint_header
+from nimbo.core.constants import FULL_REGION_NAMES, NIMBO_VARS
+from nimbo.core.print import nlive, nprint, nprint_header
+
+# TerminateInstances accepts at most 1000 instance ids per request
+_TERMINATE_BATCH_SIZE = 1000
+_REGION_WORKERS = 8
+_DISABLED_REGION_ERRORS = ("AuthFailure", "OptInRequired")
+_WARM_POOL_TAG = "NimboWarmPool"
+_SWEEP_WORKERS = 16
+_SPOT_REQUEST_WORKERS = 8
+_SPOT_WATCH_INTERVAL = 15
+# How long to wait for an instance to be reclaimed after losing its ssh session
+_SPOT_TERMINATION_WAIT = 5 * 60
+_SSH_CONNECTION_LOST = 255
+# Longest wait for a launched instance to run, and for a running one to get an IP
+_INSTANCE_START_TIMEOUT = 10 * 60
+_PUBLIC_IP_WAIT = 30
+_NOTEBOOK_PORT = 57467
+# Spot request status codes of requests that may still be fulfilled
+_SPOT_PENDING_CODES = ("pending-evaluation", "pending-fulfillment")
+# How long sweep jobs wait for the first job to publish the conda environment
+_SWEEP_ENV_WAIT = 30 * 60
+_SWEEP_STATUS_STYLES = {"running": "green", "failed": "red", "cancelled": "red"}
+# Tags that match baked images to the base image, conda env and datasets
+_BAKED_BASE_TAG = "NimboBaseImage"
+_BAKED_ENV_TAG = "NimboEnvHash"
+_BAKED_DATASETS_TAG = "NimboDatasetsHash"
+# Creating an image of a large volume can take a while, poll for up to an hour
+_IMAGE_WAIT = {"Delay": 15, "MaxAttempts": 240}
+# Dataset volumes are attached here and snapshots matched by the S3 datasets path
+_DATASETS_DEVICE = "/dev/sdf"
+_DATASETS_PATH_TAG = "NimboDatasetsPath"
+_SNAPSHOT_WAIT = {"Delay": 15, "MaxAttempts": 480}
+# Logs are uploaded as <date>_<instance id>.txt, and while the job runs as chunks
+# under <log>.parts/<byte offset of the chunk>
+_LOG_PARTS_SUFFIX = ".parts/"
+_LOG_RECONNECT_DELAY = 5
 
 
 class AwsInstance(Instance):
     @staticmethod
-    def run(job_cmd: str, dry_run=False) -> Dict[str, str]:
+    def run(job_cmd: str, dry_run=False, watch_spot=False) -> Dict[str, str]:
         if dry_run:
             return {"message": job_cmd + "_dry_run"}
 
+        result = AwsInstance._run_once(job_cmd)
+
+        # Jobs on reclaimed spot instances resume on a new one from the results
+        # uploaded when the interruption notice was given
+        for restart_count in range(1, CONFIG.spot_max_relaunches + 1):
+            if not AwsInstance._was_spot_interrupted(job_cmd, result, watch_spot):
+                break
+            nprint_header(
+                f"Spot instance {result['instance_id']} was interrupted. "
+                f"Relaunching the job ({restart_count}/{CONFIG.spot_max_relaunches})..."
+            )
+            result = AwsInstance._run_once(job_cmd, restart_count)
+
+        return result
+
+    @staticmethod
+    def _run_once(
+        job_cmd: str, restart_count=0, datasets_volume_size: Optional[int] = None
+    ) -> Dict[str, str]:
         # Launch instance with new volume for anaconda
         start_t = time.monotonic()
 
-        instance_id = AwsInstance._start_instance()
+        instance_id = AwsInstance._start_instance(datasets_volume_size)
 
         try:
             # Wait for the instance to be running
-            AwsInstance._block_until_instance_running(instance_id)
+            with timing.span("instance running"):
+                host = AwsInstance._block_until_instance_running(instance_id)
             end_t = time.monotonic()
             nprint_header(f"Instance running. ({round((end_t - start_t), 2)} s)")
             nprint_header(f"InstanceId: [green]{instance_id}[/green]")
             print()
 
-            time.sleep(5)
-            host = AwsInstance._get_host_from_instance_id(instance_id)
-
-            AwsInstance._block_until_ssh_ready(host)
+            with timing.span("ssh ready"):
+                AwsInstance._block_until_ssh_ready(host)
 
             if job_cmd == "_nimbo_launch":
                 nprint_header(
@@ -48,11 +116,8 @@ class AwsInstance(Instance):
                 )
                 return {"message": job_cmd + "_success", "instance_id": instance_id}
 
-            ssh = (
-                f"ssh -i {CONFIG.instance_key} -o 'StrictHostKeyChecking no'"
-                " -o ServerAliveInterval=5 "
-            )
-            scp = f"scp -i {CONFIG.instance_key} -o 'StrictHostKeyChecking no'"
+            ssh = AwsInstance._ssh_cmd()
+            scp = AwsInstance._scp_cmd()
 
             local_env = "/tmp/local_env.yml"
             user_conda_yml = CONFIG.conda_env
@@ -62,40 +127,49 @@ class AwsInstance(Instance):
             # Send conda env yaml and setup scripts to instance
             print()
             nprint_header(f"Syncing conda, config, and setup files...")
-            AwsInstance._write_nimbo_vars()
+            datasets_volume = None
+            if CONFIG.dataset_snapshots or datasets_volume_size:
+                datasets_volume = AwsInstance._datasets_volume_id(instance_id)
+            AwsInstance._write_nimbo_vars(restart_count, datasets_volume)
 
             # Create project folder and send env and config files there
-            subprocess.check_output(f"{ssh} ubuntu@{host} mkdir project", shell=True)
-            subprocess.check_output(
-                f"{scp} {local_env} {CONFIG.config_path} {NIMBO_VARS}"
-                f" ubuntu@{host}:/home/ubuntu/project/",
-                shell=True,
-            )
+            # Instances resumed from the warm pool already have a project folder
+            with timing.span("file copy"):
+                subprocess.check_output(
+                    f"{ssh} ubuntu@{host} mkdir -p project", shell=True
+                )
+                subprocess.check_output(
+                    f"{scp} {local_env} {CONFIG.config_path} {NIMBO_VARS}"
+                    f" ubuntu@{host}:/home/ubuntu/project/",
+                    shell=True,
+                )
 
             # Sync code with instance
             print()
             nprint_header(f"Syncing code...")
-            AwsInstance._sync_code(host)
+            with timing.span("code sync"):
+                AwsInstance._sync_code(host, instance_id)
 
             nprint_header(f"Running setup code on the instance from here on.")
             # Run remote_setup script on instance
-            AwsInstance._run_remote_script(
-                ssh, scp, host, instance_id, job_cmd, "remote_setup.sh"
-            )
+            with timing.span("remote setup"):
+                exit_code = AwsInstance._run_remote_script(
+                    ssh, scp, host, instance_id, job_cmd, "remote_setup.sh"
+                )
 
             if job_cmd == "_nimbo_notebook":
-                subprocess.Popen(
-                    f"{ssh} -o 'ExitOnForwardFailure yes' "
-                    f"ubuntu@{host} -NfL 57467:localhost:57467 >/dev/null 2>&1",
-                    shell=True,
-                ).communicate()
+                AwsInstance._forward_notebook_port(host)
                 nprint_header(
                     "Make sure to run 'nimbo sync-notebooks <instance_id>' frequently "
                     "to sync the notebook to your local folder, as the remote notebooks"
                     " will be lost once the instance is terminated."
                 )
 
-            return {"message": job_cmd + "_success", "instance_id": instance_id}
+            return {
+                "message": job_cmd + "_success",
+                "instance_id": instance_id,
+                "exit_code": exit_code,
+            }
 
         except BaseException as e:
             if (
@@ -105,11 +179,581 @@ class AwsInstance(Instance):
                 nprint(e, style="error")
 
             if not CONFIG.persist:
-                nprint_header(f"Deleting instance {instance_id} (from local)... ")
-                AwsInstance.delete_instance(instance_id)
+                AwsInstance._release_instance(instance_id)
 
             return {"message": job_cmd + "_error", "instance_id": instance_id}
 
+        finally:
+            AwsInstance._upload_timings(instance_id)
+
+    @staticmethod
+    def _forward_notebook_port(host: str) -> None:
+        """
+        Forward the notebook port over a connection of its own, which unlike the
+        multiplexed master is not closed after ControlPersist seconds idle
+        """
+
+        forward_cmd = (
+            f"{AwsInstance._ssh_cmd(multiplexed=False)} -o ExitOnForwardFailure=yes "
+            f"-NfL {_NOTEBOOK_PORT}:localhost:{_NOTEBOOK_PORT} ubuntu@{host}"
+        )
+
+        # ssh -f keeps stderr open in the background, so it goes to a file
+        with tempfile.TemporaryFile() as stderr:
+            returncode = subprocess.call(
+                forward_cmd, shell=True, stdout=subprocess.DEVNULL, stderr=stderr
+            )
+            stderr.seek(0)
+            error = stderr.read().decode("utf-8", "replace").strip()
+
+        if returncode != 0:
+            # The notebook keeps running, so the instance is left as it is
+            nprint(
+                f"Could not forward the notebook port {_NOTEBOOK_PORT}: {error}\n"
+                f"Forward it yourself with: {forward_cmd}",
+                style="error",
+            )
+
+    @staticmethod
+    def _upload_timings(instance_id: str) -> None:
+        """ Upload the spans recorded locally next to the ones of remote_setup.sh """
+
+        spans = timing.collect()
+        if not spans or not CONFIG.s3_results_path:
+            return
+
+        bucket, prefix = s3_sync.split_s3_path(CONFIG.s3_results_path)
+        extra_args = {}
+        if CONFIG.encryption:
+            extra_args["ServerSideEncryption"] = CONFIG.encryption
+        try:
+            CONFIG.get_client("s3").put_object(
+                Bucket=bucket,
+                Key=f"{prefix}nimbo-timings/{instance_id}/local.jsonl",
+                Body=timing.dumps(spans).encode("utf-8"),
+                **extra_args,
+            )
+        except botocore.exceptions.ClientError as e:
+            nprint(f"Could not upload the launch timings: {e}", style="warning")
+
+    @staticmethod
+    def bake_image(dry_run=False) -> Optional[str]:
+        if dry_run:
+            return None
+
+        # The image should hold every dataset file, not only the required ones,
+        # and the instance is terminated once imaged rather than pooled. The
+        # setup runs in the foreground, so the image is only taken once it is done
+        CONFIG.stage_required_files = []
+        CONFIG.warm_pool_size = 0
+        CONFIG.run_in_background = False
+
+        result = AwsInstance._run_once("_nimbo_bake")
+        if result["message"] != "_nimbo_bake_success":
+            return None
+
+        instance_id = result["instance_id"]
+        base_image_id = AwsInstance._base_image_id()
+        try:
+            if result["exit_code"]:
+                nprint("Instance setup failed, no image was created.", style="error")
+                return None
+
+            env_hash = manifest.file_hash(CONFIG.conda_env)
+            project = re.sub(r"[^\w.()/-]", "-", os.path.basename(os.getcwd()))
+            tags = AwsInstance._make_instance_tags() + [
+                {"Key": _BAKED_BASE_TAG, "Value": base_image_id},
+                {"Key": _BAKED_ENV_TAG, "Value": env_hash},
+                {
+                    "Key": _BAKED_DATASETS_TAG,
+                    "Value": AwsInstance._datasets_hash(AwsInstance._list_datasets()),
+                },
+            ]
+
+            print()
+            nprint_header("Creating image...")
+            ec2 = CONFIG.get_client("ec2")
+            response = ec2.create_image(
+                InstanceId=instance_id,
+                Name=f"nimbo-{project}-{env_hash[:12]}-{int(time.time())}",
+                Description=f"nimbo image of {base_image_id} with {CONFIG.conda_env}",
+                TagSpecifications=[
+                    {"ResourceType": "image", "Tags": tags},
+                    {"ResourceType": "snapshot", "Tags": tags},
+                ],
+            )
+            image_id = response["ImageId"]
+            ec2.get_waiter("image_available").wait(
+                ImageIds=[image_id], WaiterConfig=_IMAGE_WAIT
+            )
+            nprint_header(
+                f"Image [green]{image_id}[/green] is available. Jobs using "
+                f"{CONFIG.conda_env} on {base_image_id} will now launch from it."
+            )
+        finally:
+            AwsInstance.delete_instance(instance_id)
+
+        return image_id
+
+    @staticmethod
+    def snapshot_datasets(dry_run=False) -> Optional[str]:
+        if dry_run:
+            return None
+
+        files = AwsInstance._list_datasets()
+        total_gib = sum(info.size for info in files.values()) / 2 ** 30
+        # Leave room for the filesystem and for the datasets to grow a bit
+        size = math.ceil(total_gib * 1.1) + 1
+
+        previous = AwsInstance._find_datasets_snapshot(
+            CONFIG.region_name, CONFIG.s3_datasets_path
+        )
+        if previous:
+            # Starting from the last snapshot only downloads the new files
+            size = max(size, previous[1])
+            nprint_header(f"Updating dataset snapshot {previous[0]}...")
+
+        # remote_setup.sh only stages the datasets, then unmounts the volume
+        # before returning, so that it can be snapshotted right away
+        CONFIG.warm_pool_size = 0
+        CONFIG.run_in_background = False
+
+        result = AwsInstance._run_once("_nimbo_snapshot_datasets", 0, size)
+        if result["message"] != "_nimbo_snapshot_datasets_success":
+            return None
+
+        instance_id = result["instance_id"]
+        try:
+            if result["exit_code"]:
+                nprint("Staging failed, no snapshot was created.", style="error")
+                return None
+
+            tags = AwsInstance._make_instance_tags() + [
+                {"Key": _DATASETS_PATH_TAG, "Value": CONFIG.s3_datasets_path},
+                {
+                    "Key": _BAKED_DATASETS_TAG,
+                    "Value": AwsInstance._datasets_hash(files),
+                },
+            ]
+
+            print()
+            nprint_header("Creating snapshot...")
+            ec2 = CONFIG.get_client("ec2")
+            response = ec2.create_snapshot(
+                VolumeId=AwsInstance._datasets_volume_id(instance_id),
+                Description=f"nimbo datasets from {CONFIG.s3_datasets_path}",
+                TagSpecifications=[{"ResourceType": "snapshot", "Tags": tags}],
+            )
+            snapshot_id = response["SnapshotId"]
+            ec2.get_waiter("snapshot_completed").wait(
+                SnapshotIds=[snapshot_id], WaiterConfig=_SNAPSHOT_WAIT
+            )
+
+            zones = CONFIG.dataset_snapshot_fast_restore_zones
+            if zones:
+                nprint_header(f"Enabling fast snapshot restore in {', '.join(zones)}")
+                ec2.enable_fast_snapshot_restores(
+                    AvailabilityZones=zones, SourceSnapshotIds=[snapshot_id]
+                )
+
+            nprint_header(
+                f"Snapshot [green]{snapshot_id}[/green] is ready. Set "
+                "dataset_snapshots to yes to attach it instead of downloading."
+            )
+        finally:
+            AwsInstance.delete_instance(instance_id)
+
+        return snapshot_id
+
+    @staticmethod
+    def _list_datasets() -> Dict[str, s3_sync.FileInfo]:
+        bucket, prefix = s3_sync.split_s3_path(CONFIG.s3_datasets_path)
+        return s3_sync.list_remote(CONFIG.get_client("s3"), bucket, prefix)
+
+    @staticmethod
+    def _datasets_hash(files: Dict[str, s3_sync.FileInfo]) -> str:
+        """ Hash of the dataset files in S3, by their keys, sizes and timestamps """
+
+        listing = json.dumps(sorted(files.items())).encode("utf-8")
+        return hashlib.sha1(listing).hexdigest()
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def _find_datasets_snapshot(
+        region_name: str, s3_datasets_path: str
+    ) -> Optional[Tuple[str, int]]:
+        """ (snapshot id, size in GiB) of the newest snapshot of the datasets """
+
+        ec2 = CONFIG.get_client("ec2")
+        response = ec2.describe_snapshots(
+            OwnerIds=["self"],
+            Filters=[
+                {"Name": "status", "Values": ["completed"]},
+                {"Name": f"tag:{_DATASETS_PATH_TAG}", "Values": [s3_datasets_path]},
+            ],
+        )
+        snapshots = sorted(response["Snapshots"], key=lambda snap: snap["StartTime"])
+        if not snapshots:
+            return None
+        return snapshots[-1]["SnapshotId"], snapshots[-1]["VolumeSize"]
+
+    @staticmethod
+    def _datasets_block_device(
+        volume_size: Optional[int], ebs_config: Dict
+    ) -> Optional[Dict]:
+        """
+        The mapping of the datasets volume, restored from the newest snapshot of
+        the datasets, or None when datasets are downloaded to the root volume
+        """
+
+        if not CONFIG.dataset_snapshots and volume_size is None:
+            return None
+
+        snapshot = AwsInstance._find_datasets_snapshot(
+            CONFIG.region_name, CONFIG.s3_datasets_path
+        )
+        if snapshot is None and volume_size is None:
+            nprint(
+                "No dataset snapshot found, run 'nimbo snapshot-datasets' first. "
+                "Downloading the datasets instead.",
+                style="warning",
+            )
+            return None
+
+        ebs = {k: v for k, v in ebs_config.items() if k != "VolumeSize"}
+        ebs["DeleteOnTermination"] = True
+        if snapshot:
+            ebs["SnapshotId"] = snapshot[0]
+        if volume_size:
+            ebs["VolumeSize"] = volume_size
+        return {"DeviceName": _DATASETS_DEVICE, "Ebs": ebs}
+
+    @staticmethod
+    def _datasets_volume_id(instance_id: str) -> Optional[str]:
+        """ The id of the datasets volume of an instance, if it has one """
+
+        response = CONFIG.get_client("ec2").describe_instances(
+            InstanceIds=[instance_id]
+        )
+        inst = response["Reservations"][0]["Instances"][0]
+        for mapping in inst.get("BlockDeviceMappings", []):
+            if mapping["DeviceName"] == _DATASETS_DEVICE:
+                return mapping["Ebs"]["VolumeId"]
+        return None
+
+    @staticmethod
+    def _was_spot_interrupted(job_cmd: str, result: Dict, watch_spot=False) -> bool:
+        """
+        Whether the instance of a finished run was reclaimed by spot. Jobs run in
+        the background are only watched, for as long as they run, with watch_spot
+        """
+
+        if (
+            not CONFIG.spot
+            or job_cmd.startswith("_nimbo_")
+            or result["message"] != job_cmd + "_success"
+        ):
+            return False
+
+        if CONFIG.run_in_background:
+            # Persisted instances outlive their jobs, so there is nothing to watch
+            if CONFIG.persist:
+                return False
+            if not watch_spot:
+                nprint(
+                    "The job runs in the background and will not be relaunched if"
+                    " the spot instance is interrupted, unless run with --watch-spot.",
+                    style="warning",
+                )
+                return False
+            nprint_header(
+                "Watching the spot instance for interruptions until the job ends..."
+            )
+            timeout = None
+        elif result["exit_code"] == _SSH_CONNECTION_LOST:
+            timeout = _SPOT_TERMINATION_WAIT
+        else:
+            return False
+
+        return AwsInstance._wait_for_spot_termination(result["instance_id"], timeout)
+
+    @staticmethod
+    def _wait_for_spot_termination(instance_id: str, timeout: Optional[float]) -> bool:
+        """
+        Wait until the instance stops running, returning whether it was reclaimed
+        by spot. Returns False if it is still running after timeout seconds
+        """
+
+        ec2 = CONFIG.get_client("ec2")
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while deadline is None or time.monotonic() < deadline:
+            response = ec2.describe_instances(InstanceIds=[instance_id])
+            inst = response["Reservations"][0]["Instances"][0]
+            if inst["State"]["Name"] not in ("pending", "running"):
+                reason = inst.get("StateReason", {}).get("Code")
+                return reason == "Server.SpotInstanceTermination"
+            time.sleep(_SPOT_WATCH_INTERVAL)
+
+        return False
+
+    @staticmethod
+    def run_sweep(
+        job_cmds: List[str],
+        resources: Optional[scheduler.Resources] = None,
+        max_instances: Optional[int] = None,
+        dry_run=False,
+    ) -> List[Dict[str, str]]:
+        if dry_run:
+            return [{"message": job_cmd + "_dry_run"} for job_cmd in job_cmds]
+
+        rows = AwsInstance._make_sweep_rows(job_cmds, resources, max_instances)
+        for row in rows:
+            row.update({"instance_id": "", "status": "queued"})
+
+        # Jobs run detached so that their instances can be set up concurrently
+        CONFIG.run_in_background = True
+
+        AwsPermissions.allow_ingress_current_ip(CONFIG.security_group)
+        shutil.copyfile(CONFIG.conda_env, "/tmp/local_env.yml")
+        AwsInstance._write_nimbo_vars()
+
+        nprint_header("Uploading code for all jobs...")
+        code = manifest.build(manifest.project_files(), manifest.load("sweep"))
+        manifest.save("sweep", code)
+        bucket, key, code_url = AwsInstance._upload_code_archive(list(code))
+
+        cancelled = threading.Event()
+        executor = ThreadPoolExecutor(max_workers=min(len(rows), _SWEEP_WORKERS))
+
+        try:
+            with nlive(AwsInstance._sweep_table(rows)) as live:
+                futures = [
+                    executor.submit(
+                        AwsInstance._provision_sweep_job,
+                        row,
+                        code,
+                        code_url,
+                        # Only the first job builds the conda environment
+                        CONFIG.conda_env_cache and i > 0,
+                        cancelled,
+                    )
+                    for i, row in enumerate(rows)
+                ]
+                try:
+                    while not all(future.done() for future in futures):
+                        time.sleep(0.5)
+                        live.update(AwsInstance._sweep_table(rows))
+                except KeyboardInterrupt:
+                    # Jobs being provisioned release their instances on their own
+                    cancelled.set()
+                    for row, future in zip(rows, futures):
+                        if future.cancel():
+                            row["status"] = "cancelled"
+                executor.shutdown(wait=True)
+                live.update(AwsInstance._sweep_table(rows))
+        finally:
+            executor.shutdown(wait=True)
+            CONFIG.get_client("s3").delete_object(Bucket=bucket, Key=key)
+
+        for i, row in enumerate(rows):
+            if row["status"] == "failed":
+                nprint(f"Instance {i} failed: {row.get('error')}", style="error")
+
+        return [
+            {
+                "message": row["cmd"]
+                + ("_success" if row["status"] == "running" else "_error"),
+                "instance_id": row["instance_id"],
+            }
+            for row in rows
+        ]
+
+    @staticmethod
+    def _provision_sweep_job(
+        row: Dict[str, str],
+        code: manifest.Manifest,
+        code_url: str,
+        wait_for_env: bool,
+        cancelled: threading.Event,
+    ) -> None:
+        """ Launch an instance for one sweep job and start the job on it """
+
+        def set_status(status: str) -> None:
+            if cancelled.is_set():
+                raise RuntimeError("Sweep cancelled")
+            row["status"] = status
+
+        if cancelled.is_set():
+            row["status"] = "cancelled"
+            return
+
+        row["status"] = "launching"
+        try:
+            with timing.span("launch instance"):
+                instance_id = AwsInstance._launch_instance(cancelled=cancelled)
+        except Exception as e:
+            row["status"] = "cancelled" if cancelled.is_set() else "failed"
+            row["error"] = str(e)
+            return
+        row["instance_id"] = instance_id
+
+        try:
+            set_status("starting")
+            with timing.span("instance running"):
+                host = AwsInstance._block_until_instance_running(instance_id)
+            with timing.span("ssh ready"):
+                AwsInstance._block_until_ssh_ready(host)
+
+            set_status("syncing")
+            ssh = AwsInstance._ssh_cmd()
+            scp = AwsInstance._scp_cmd()
+            subprocess.check_output(f"{ssh} ubuntu@{host} mkdir -p project", shell=True)
+            subprocess.check_output(
+                f"{scp} /tmp/local_env.yml {CONFIG.config_path} {NIMBO_VARS}"
+                f" ubuntu@{host}:/home/ubuntu/project/",
+                shell=True,
+            )
+
+            if manifest.load(instance_id):
+                # Instances resumed from the warm pool only need the changes
+                AwsInstance._sync_code(host, instance_id)
+            else:
+                fetch_cmd = (
+                    f"curl -sf {shlex.quote(code_url)}"
+                    " | tar -xzf - -C /home/ubuntu/project"
+                )
+                subprocess.check_output(
+                    f"{ssh} ubuntu@{host} {shlex.quote(fetch_cmd)}", shell=True
+                )
+                manifest.save(instance_id, code)
+
+            if row["schedule"]:
+                subprocess.run(
+                    f"{ssh} ubuntu@{host} 'cat > project/nimbo_jobs.json'",
+                    input=row["schedule"].encode("utf-8"),
+                    shell=True,
+                    check=True,
+                )
+
+            extra_vars = []
+            if wait_for_env:
+                extra_vars.append(f"ENV_CACHE_WAIT={_SWEEP_ENV_WAIT}")
+            if CONFIG.dataset_snapshots:
+                datasets_volume = AwsInstance._datasets_volume_id(instance_id)
+                if datasets_volume:
+                    extra_vars.append(f"DATASETS_VOLUME={datasets_volume}")
+            if extra_vars:
+                subprocess.run(
+                    f"{ssh} ubuntu@{host} 'cat >> project/nimbo_vars'",
+                    input=("\n" + "\n".join(extra_vars) + "\n").encode("utf-8"),
+                    shell=True,
+                    check=True,
+                )
+
+            set_status("setting up")
+            with timing.span("remote setup"):
+                exit_code = AwsInstance._run_remote_script(
+                    ssh, scp, host, instance_id, row["cmd"], "remote_setup.sh"
+                )
+            if exit_code:
+                raise RuntimeError(f"Remote setup exited with code {exit_code}")
+            row["status"] = "running"
+
+        except BaseException as e:
+            row["status"] = "cancelled" if cancelled.is_set() else "failed"
+            row["error"] = str(e)
+            if not CONFIG.persist:
+                AwsInstance._release_instance(instance_id)
+
+        finally:
+            AwsInstance._upload_timings(instance_id)
+
+    @staticmethod
+    def _make_sweep_rows(
+        job_cmds: List[str],
+        resources: Optional[scheduler.Resources],
+        max_instances: Optional[int],
+    ) -> List[Dict]:
+        """
+        One row per instance of the sweep. Instances running several jobs, or jobs
+        with resource requirements, get a schedule for the nimbo_schedule.py agent
+        """
+
+        if not resources and not max_instances:
+            return [
+                {"jobs": [job_cmd], "cmd": job_cmd, "schedule": None}
+                for job_cmd in job_cmds
+            ]
+
+        capacity = scheduler.instance_resources(CONFIG.instance_type)
+        if CONFIG.spot:
+            # Jobs have to fit whichever spot instance type gets fulfilled
+            for instance_type, _ in AwsInstance._spot_candidates():
+                other = scheduler.instance_resources(instance_type)
+                capacity = scheduler.Resources(*map(min, capacity, other))
+        needed = resources or capacity
+        queues = scheduler.pack([needed] * len(job_cmds), capacity, max_instances)
+
+        rows = []
+        for queue in queues:
+            schedule = {
+                "capacity": capacity._asdict(),
+                "jobs": [
+                    {"index": i, "cmd": job_cmds[i], **needed._asdict()} for i in queue
+                ],
+            }
+            rows.append(
+                {
+                    "jobs": [job_cmds[i] for i in queue],
+                    "cmd": "_nimbo_schedule",
+                    "schedule": json.dumps(schedule),
+                }
+            )
+        return rows
+
+    @staticmethod
+    def _upload_code_archive(files: List[str]) -> Tuple[str, str, str]:
+        """
+        Upload files once as a gzipped tar to the results bucket, returning the
+        bucket, the key and a presigned url that instances can fetch it from
+        """
+
+        s3 = CONFIG.get_client("s3")
+        bucket, _ = s3_sync.split_s3_path(CONFIG.s3_results_path)
+        key = f"nimbo-code/{uuid.uuid4().hex}.tar.gz"
+
+        extra_args = {}
+        if CONFIG.encryption:
+            extra_args["ServerSideEncryption"] = CONFIG.encryption
+
+        with tempfile.TemporaryFile() as f:
+            with tarfile.open(fileobj=f, mode="w:gz") as tar:
+                for path in files:
+                    tar.add(path)
+            f.seek(0)
+            s3.upload_fileobj(f, bucket, key, ExtraArgs=extra_args)
+
+        url = s3.generate_presigned_url(
+            "get_object", Params={"Bucket": bucket, "Key": key}, ExpiresIn=3600
+        )
+        return bucket, key, url
+
+    @staticmethod
+    def _sweep_table(rows: List[Dict[str, str]]):
+        from rich.table import Table
+
+        table = Table("#", "Jobs", "Instance", "Status")
+        for i, row in enumerate(rows):
+            style = _SWEEP_STATUS_STYLES.get(row["status"], "yellow")
+            table.add_row(
+                str(i),
+                "\n".join(row["jobs"]),
+                row["instance_id"],
+                f"[{style}]{row['status']}[/{style}]",
+            )
+        return table
+
     @staticmethod
     def run_access_test(dry_run=False) -> None:
         if dry_run:
@@ -118,6 +762,7 @@ class AwsInstance(Instance):
         CONFIG.instance_type = "t3.medium"
         CONFIG.run_in_background = False
         CONFIG.persist = False
+        CONFIG.warm_pool_size = 0
 
         try:
             # Send test file to s3 results path and delete it
@@ -168,15 +813,11 @@ class AwsInstance(Instance):
             print("Instance deletion allowed \u2713")
             print("\nLaunching another instance...")
             instance_id = AwsInstance._start_instance()
+            host = AwsInstance._block_until_instance_running(instance_id)
             print(f"Instance running. InstanceId: {instance_id}")
 
-            time.sleep(5)
-            host = AwsInstance._get_host_from_instance_id(instance_id)
-            ssh = (
-                f"ssh -i {CONFIG.instance_key} -o 'StrictHostKeyChecking no' "
-                "-o ServerAliveInterval=20"
-            )
-            scp = f"scp -i {CONFIG.instance_key} -o 'StrictHostKeyChecking no'"
+            ssh = AwsInstance._ssh_cmd()
+            scp = AwsInstance._scp_cmd()
 
             AwsInstance._block_until_ssh_ready(host)
 
@@ -208,28 +849,95 @@ class AwsInstance(Instance):
             sys.exit(1)
 
     @staticmethod
-    def _block_until_instance_running(instance_id: str) -> None:
-        status = ""
-        while status != "running":
-            time.sleep(1)
-            status = AwsInstance.get_status(instance_id)
+    def _block_until_instance_running(instance_id: str) -> str:
+        """
+        Poll with backoff until the instance is running and has a public IP,
+        returning the IP observed by the same describe_instances call
+        """
+
+        ec2 = CONFIG.get_client("ec2")
+        delay = 0.5
+        deadline = time.monotonic() + _INSTANCE_START_TIMEOUT
+        running_since = None
+
+        while time.monotonic() < deadline:
+            try:
+                response = ec2.describe_instances(
+                    InstanceIds=[instance_id],
+                    Filters=AwsInstance._make_instance_filters(),
+                )
+            except botocore.exceptions.ClientError as e:
+                # Newly launched instances can take a moment to become visible
+                if e.response["Error"]["Code"] != "InvalidInstanceID.NotFound":
+                    raise
+            else:
+                reservations = response["Reservations"]
+                if reservations:
+                    inst = reservations[0]["Instances"][0]
+                    status = inst["State"]["Name"]
+                    host = inst.get("PublicIpAddress")
+
+                    if status == "running" and host:
+                        return host
+                    if status not in ["pending", "running"]:
+                        raise RuntimeError(
+                            f"Instance {instance_id} is {status}, expected it to start"
+                        )
+                    if status == "running":
+                        running_since = running_since or time.monotonic()
+                        if time.monotonic() - running_since >= _PUBLIC_IP_WAIT:
+                            raise RuntimeError(
+                                f"Instance {instance_id} is running without a public"
+                                " IP address, so nimbo cannot reach it. Launch it in"
+                                " a subnet that assigns public IP addresses."
+                            )
+
+            time.sleep(delay)
+            delay = min(delay * 1.5, 5)
+
+        raise RuntimeError(
+            f"Instance {instance_id} did not start within "
+            f"{_INSTANCE_START_TIMEOUT} s, check it in the EC2 console."
+        )
 
     @staticmethod
-    def _write_nimbo_vars() -> None:
+    def _write_nimbo_vars(
+        restart_count=0, datasets_volume: Optional[str] = None
+    ) -> None:
         var_list = [
             f"S3_DATASETS_PATH={CONFIG.s3_datasets_path}",
             f"S3_RESULTS_PATH={CONFIG.s3_results_path}",
             f"LOCAL_DATASETS_PATH={CONFIG.local_datasets_path}",
             f"LOCAL_RESULTS_PATH={CONFIG.local_results_path}",
+            f"REGION_NAME={CONFIG.region_name}",
+            f"STAGE_WORKERS={CONFIG.stage_workers}",
+            f"STAGE_REQUIRED={shlex.quote(','.join(CONFIG.stage_required_files))}",
         ]
         if CONFIG.encryption:
             var_list.append(f"ENCRYPTION={CONFIG.encryption}")
+        if CONFIG.conda_env_cache and CONFIG.conda_env and CONFIG.s3_results_path:
+            bucket, _ = s3_sync.split_s3_path(CONFIG.s3_results_path)
+            var_list.append(f"CONDA_ENV_CACHE=s3://{bucket}/nimbo-envs")
+        if CONFIG.conda_env:
+            var_list.append(f"ENV_HASH={manifest.file_hash(CONFIG.conda_env)}")
+        if AwsInstance._uses_warm_pool():
+            var_list.append("WARM_POOL=1")
+        if CONFIG.spot:
+            var_list.append("SPOT=1")
+            var_list.append(f"RESTART_COUNT={restart_count}")
+        if CONFIG.spot_interruption_hook:
+            hook = shlex.quote(CONFIG.spot_interruption_hook)
+            var_list.append(f"SPOT_INTERRUPTION_HOOK={hook}")
+        if datasets_volume:
+            var_list.append(f"DATASETS_VOLUME={datasets_volume}")
+        for use in CONFIG.instance_store:
+            var_list.append(f"INSTANCE_STORE_{use.value.upper()}=1")
         with open(NIMBO_VARS, "w") as f:
             f.write("\n".join(var_list))
 
     @staticmethod
     def _get_host_from_instance_id(instance_id: str, dry_run=False) -> str:
-        ec2 = CONFIG.get_session().client("ec2")
+        ec2 = CONFIG.get_client("ec2")
         try:
             response = ec2.describe_instances(
                 InstanceIds=[instance_id],
@@ -245,13 +953,57 @@ class AwsInstance(Instance):
 
     @staticmethod
     def _get_image_id() -> str:
-        if CONFIG.image[:4] == "ami-":
-            image_id = CONFIG.image
+        image_id = AwsInstance._base_image_id()
+
+        if CONFIG.use_baked_images and CONFIG.conda_env:
+            env_hash = manifest.file_hash(CONFIG.conda_env)
+            baked_image_id = AwsInstance._find_baked_image(
+                CONFIG.region_name, image_id, env_hash
+            )
+            if baked_image_id:
+                return baked_image_id
+
+        return image_id
+
+    @staticmethod
+    def _base_image_id() -> str:
+        """ The configured AMI, looked up by region_name when given per region """
+
+        image = CONFIG.image
+        if isinstance(image, dict):
+            if CONFIG.region_name not in image:
+                raise ValueError(f"No image is specified for {CONFIG.region_name}")
+            image = image[CONFIG.region_name]
+
+        if image[:4] == "ami-":
+            image_id = image
         else:
             raise ValueError("You have to specify an AMI")
 
         return image_id
 
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def _find_baked_image(
+        region_name: str, base_image_id: str, env_hash: str
+    ) -> Optional[str]:
+        """
+        The newest image baked from base_image_id with the same conda env. Datasets
+        changed since then are still staged on launch, only the new files are copied
+        """
+
+        ec2 = CONFIG.get_client("ec2")
+        response = ec2.describe_images(
+            Owners=["self"],
+            Filters=[
+                {"Name": "state", "Values": ["available"]},
+                {"Name": f"tag:{_BAKED_BASE_TAG}", "Values": [base_image_id]},
+                {"Name": f"tag:{_BAKED_ENV_TAG}", "Values": [env_hash]},
+            ],
+        )
+        images = sorted(response["Images"], key=lambda image: image["CreationDate"])
+        return images[-1]["ImageId"] if images else None
+
     @staticmethod
     def _make_instance_tags() -> List[Dict[str, str]]:
         return [
@@ -269,12 +1021,25 @@ class AwsInstance(Instance):
         return filters
 
     @staticmethod
-    def _start_instance() -> str:
-        AwsPermissions.allow_ingress_current_ip(CONFIG.security_group)
+    def _start_instance(datasets_volume_size: Optional[int] = None) -> str:
+        with timing.span("ingress rule"):
+            AwsPermissions.allow_ingress_current_ip(CONFIG.security_group)
+        with timing.span("launch instance"):
+            return AwsInstance._launch_instance(datasets_volume_size)
 
-        ec2 = CONFIG.get_session().client("ec2")
+    @staticmethod
+    def _launch_instance(
+        datasets_volume_size: Optional[int] = None,
+        cancelled: Optional[threading.Event] = None,
+    ) -> str:
+        if AwsInstance._uses_warm_pool():
+            instance_id = AwsInstance._acquire_pooled_instance()
+            if instance_id:
+                nprint_header(f"Resuming instance {instance_id} from the warm pool...")
+                return instance_id
+
+        ec2 = CONFIG.get_client("ec2")
         instance_tags = AwsInstance._make_instance_tags()
-        instance_filters = AwsInstance._make_instance_filters()
 
         image = AwsInstance._get_image_id()
         nprint_header(f"Launching instance with image {image}... ")
@@ -286,8 +1051,15 @@ class AwsInstance(Instance):
         if CONFIG.disk_iops:
             ebs_config["Iops"] = CONFIG.disk_iops
 
+        block_devices = [{"DeviceName": "/dev/sda1", "Ebs": ebs_config}]
+        datasets_device = AwsInstance._datasets_block_device(
+            datasets_volume_size, ebs_config
+        )
+        if datasets_device:
+            block_devices.append(datasets_device)
+
         instance_config = {
-            "BlockDeviceMappings": [{"DeviceName": "/dev/sda1", "Ebs": ebs_config}],
+            "BlockDeviceMappings": block_devices,
             "ImageId": image,
             "InstanceType": CONFIG.instance_type,
             "KeyName": Path(CONFIG.instance_key).stem,
@@ -297,67 +1069,242 @@ class AwsInstance(Instance):
         }
 
         if CONFIG.spot:
-            extra_kwargs = {}
-            if CONFIG.spot_duration:
-                extra_kwargs = {"BlockDurationMinutes": CONFIG.spot_duration}
-
-            instance = ec2.request_spot_instances(
-                LaunchSpecification=instance_config,
-                TagSpecifications=[
-                    {"ResourceType": "spot-instances-request", "Tags": instance_tags}
-                ],
-                **extra_kwargs,
-            )
-            instance_request = instance["SpotInstanceRequests"][0]
-            request_id = instance_request["SpotInstanceRequestId"]
-
-            try:
-                nprint_header("Spot instance request submitted.")
-                nprint_header(
-                    "Waiting for the spot instance request to be fulfilled... "
+            with timing.span("spot request"):
+                instance_id = AwsInstance._request_spot_instance(
+                    instance_config, instance_tags, cancelled
                 )
-
-                status = ""
-                while status != "fulfilled":
-                    time.sleep(2)
-                    response = ec2.describe_spot_instance_requests(
-                        SpotInstanceRequestIds=[request_id],
-                        Filters=instance_filters,
-                    )
-                    instance_request = response["SpotInstanceRequests"][0]
-                    status = instance_request["Status"]["Code"]
-                    if status not in [
-                        "fulfilled",
-                        "pending-evaluation",
-                        "pending-fulfillment",
-                    ]:
-                        raise Exception(response["SpotInstanceRequests"][0]["Status"])
-            except KeyboardInterrupt:
-                ec2.cancel_spot_instance_requests(SpotInstanceRequestIds=[request_id])
-                nprint_header("Cancelled spot instance request.")
-                sys.exit(1)
-
-            nprint_header("Done.")
-            ec2.create_tags(
-                Resources=[instance_request["InstanceId"]],
-                Tags=instance_tags,
-            )
-            instance = instance_request
+            ec2.create_tags(Resources=[instance_id], Tags=instance_tags)
+            return instance_id
         else:
             instance_config["MinCount"] = 1
             instance_config["MaxCount"] = 1
             instance_config["InstanceInitiatedShutdownBehavior"] = "terminate"
+            if AwsInstance._uses_warm_pool():
+                # Shutting down at the end of the job returns it to the pool
+                instance_config["InstanceInitiatedShutdownBehavior"] = "stop"
+                instance_tags = instance_tags + [
+                    {"Key": _WARM_POOL_TAG, "Value": AwsInstance._warm_pool_key()}
+                ]
             instance_config["TagSpecifications"] = [
                 {"ResourceType": "instance", "Tags": instance_tags}
             ]
             instance = ec2.run_instances(**instance_config)
-            instance = instance["Instances"][0]
+            return instance["Instances"][0]["InstanceId"]
+
+    @staticmethod
+    def _spot_candidates() -> List[Tuple[str, Optional[str]]]:
+        """ (instance type, availability zone) pairs to request, in preference order """
+
+        instance_types = [CONFIG.instance_type] + [
+            t for t in CONFIG.spot_fallback_types if t != CONFIG.instance_type
+        ]
+        zones = CONFIG.spot_availability_zones or [None]
+        return [(t, zone) for t in instance_types for zone in zones]
+
+    @staticmethod
+    def _request_spot_instance(
+        instance_config: Dict,
+        instance_tags: List[Dict[str, str]],
+        cancelled: Optional[threading.Event] = None,
+    ) -> str:
+        """
+        Request a spot instance for every candidate type and zone at once, keep
+        the most preferred one that is fulfilled first and cancel all others
+        """
+
+        ec2 = CONFIG.get_client("ec2")
+        candidates = AwsInstance._spot_candidates()
+
+        extra_kwargs = {}
+        if CONFIG.spot_duration:
+            extra_kwargs = {"BlockDurationMinutes": CONFIG.spot_duration}
+
+        def request(candidate: Tuple[str, Optional[str]]) -> str:
+            instance_type, zone = candidate
+            launch_spec = dict(instance_config, InstanceType=instance_type)
+            if zone:
+                launch_spec["Placement"] = dict(
+                    instance_config["Placement"], AvailabilityZone=zone
+                )
+            response = ec2.request_spot_instances(
+                LaunchSpecification=launch_spec,
+                TagSpecifications=[
+                    {"ResourceType": "spot-instances-request", "Tags": instance_tags}
+                ],
+                **extra_kwargs,
+            )
+            return response["SpotInstanceRequests"][0]["SpotInstanceRequestId"]
+
+        workers = min(len(candidates), _SPOT_REQUEST_WORKERS)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(request, c) for c in candidates]
+        try:
+            request_ids = [future.result() for future in futures]
+        except Exception:
+            # Don't leave the requests that did go through behind
+            AwsInstance._cancel_spot_requests(
+                [f.result() for f in futures if not f.exception()]
+            )
+            raise
+
+        nprint_header(
+            f"{len(request_ids)} spot instance request"
+            f"{'' if len(request_ids) == 1 else 's'} submitted."
+        )
+        nprint_header("Waiting for a spot instance request to be fulfilled... ")
+
+        try:
+            winner = AwsInstance._wait_for_spot_request(request_ids, cancelled)
+        except KeyboardInterrupt:
+            AwsInstance._cancel_spot_requests(request_ids)
+            nprint_header("Cancelled spot instance requests.")
+            sys.exit(1)
+        except Exception:
+            AwsInstance._cancel_spot_requests(request_ids)
+            raise
+
+        losing_ids = [i for i in request_ids if i != winner["SpotInstanceRequestId"]]
+        AwsInstance._cancel_spot_requests(losing_ids)
+
+        instance_type, zone = candidates[
+            request_ids.index(winner["SpotInstanceRequestId"])
+        ]
+        nprint_header(
+            f"Done. Got a {instance_type} spot instance"
+            + (f" in {zone}." if zone else ".")
+        )
+        return winner["InstanceId"]
+
+    @staticmethod
+    def _wait_for_spot_request(
+        request_ids: List[str], cancelled: Optional[threading.Event] = None
+    ) -> Dict:
+        """
+        Poll with backoff until one of the requests is fulfilled, preferring the
+        earliest ones, and raise once every request failed or cancelled is set
+        """
+
+        ec2 = CONFIG.get_client("ec2")
+        open_ids = list(request_ids)
+        failures = []
+        delay = 1.0
+
+        while open_ids:
+            if cancelled is None:
+                time.sleep(delay)
+            elif cancelled.wait(delay):
+                # The sweep was interrupted, the caller cancels the requests
+                raise RuntimeError("Sweep cancelled")
+            delay = min(delay * 1.5, 5)
+
+            response = ec2.describe_spot_instance_requests(
+                SpotInstanceRequestIds=open_ids,
+                Filters=AwsInstance._make_instance_filters(),
+            )
+            requests_by_id = {
+                r["SpotInstanceRequestId"]: r for r in response["SpotInstanceRequests"]
+            }
+
+            for request_id in list(open_ids):
+                spot_request = requests_by_id.get(request_id)
+                if spot_request is None:
+                    continue
+                status = spot_request["Status"]
+                if status["Code"] == "fulfilled":
+                    return spot_request
+                if status["Code"] not in _SPOT_PENDING_CODES:
+                    # No capacity or too low a price for this candidate, drop it
+                    failures.append(status)
+                    open_ids.remove(request_id)
+
+        raise Exception(failures)
+
+    @staticmethod
+    def _cancel_spot_requests(request_ids: List[str]) -> None:
+        """ Cancel spot requests and terminate instances that fulfilled them """
+
+        if not request_ids:
+            return
+
+        ec2 = CONFIG.get_client("ec2")
+        response = ec2.cancel_spot_instance_requests(SpotInstanceRequestIds=request_ids)
+        cancelled_ids = [
+            spot_request["SpotInstanceRequestId"]
+            for spot_request in response["CancelledSpotInstanceRequests"]
+        ]
+        if not cancelled_ids:
+            return
+
+        # Cancelling a fulfilled request leaves its instance running
+        response = ec2.describe_spot_instance_requests(
+            SpotInstanceRequestIds=cancelled_ids
+        )
+        instance_ids = [
+            spot_request["InstanceId"]
+            for spot_request in response["SpotInstanceRequests"]
+            if "InstanceId" in spot_request
+        ]
+        if instance_ids:
+            ec2.terminate_instances(InstanceIds=instance_ids)
+
+    @staticmethod
+    def _uses_warm_pool() -> bool:
+        # One-time spot instances cannot be stopped, so they are never pooled
+        return CONFIG.warm_pool_size > 0 and not CONFIG.spot
+
+    @staticmethod
+    def _warm_pool_key() -> str:
+        """ Pooled instances are only reused with the same type, image and env """
+
+        env_hash = manifest.file_hash(CONFIG.conda_env) if CONFIG.conda_env else ""
+        key = f"{CONFIG.instance_type}:{AwsInstance._get_image_id()}:{env_hash}"
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+    @staticmethod
+    def _acquire_pooled_instance() -> Optional[str]:
+        """
+        Start a stopped instance from the warm pool, terminating the least recently
+        used ones beyond warm_pool_size. Returns None when the pool is empty
+        """
+
+        ec2 = CONFIG.get_client("ec2")
+        pool_filter = {
+            "Name": f"tag:{_WARM_POOL_TAG}",
+            "Values": [AwsInstance._warm_pool_key()],
+        }
+        pooled = sorted(
+            AwsInstance._describe_instances(["stopped"], filters=[pool_filter]),
+            key=lambda inst: inst["LaunchTime"],
+            reverse=True,
+        )
+
+        excess = pooled[CONFIG.warm_pool_size :]
+        if excess:
+            ec2.terminate_instances(InstanceIds=[inst["InstanceId"] for inst in excess])
+
+        for inst in pooled[: CONFIG.warm_pool_size]:
+            response = ec2.start_instances(InstanceIds=[inst["InstanceId"]])
+            # Another nimbo process may have resumed the same instance first
+            previous_state = response["StartingInstances"][0]["PreviousState"]
+            if previous_state["Name"] == "stopped":
+                return inst["InstanceId"]
+
+        return None
 
-        return instance["InstanceId"]
+    @staticmethod
+    def _release_instance(instance_id: str) -> None:
+        """ Return an instance to the warm pool when it is used, else terminate it """
+
+        if AwsInstance._uses_warm_pool():
+            nprint_header(f"Stopping instance {instance_id} for the warm pool...")
+            CONFIG.get_client("ec2").stop_instances(InstanceIds=[instance_id])
+        else:
+            nprint_header(f"Deleting instance {instance_id} (from local)... ")
+            AwsInstance.delete_instance(instance_id)
 
     @staticmethod
     def stop_instance(instance_id: str, dry_run=False) -> None:
-        ec2 = CONFIG.get_session().client("ec2")
+        ec2 = CONFIG.get_client("ec2")
         try:
             response = ec2.stop_instances(InstanceIds=[instance_id], DryRun=dry_run)
             pprint(response)
@@ -367,7 +1314,7 @@ class AwsInstance(Instance):
 
     @staticmethod
     def resume_instance(instance_id: str, dry_run=False) -> None:
-        ec2 = CONFIG.get_session().client("ec2")
+        ec2 = CONFIG.get_client("ec2")
         try:
             response = ec2.start_instances(InstanceIds=[instance_id], DryRun=dry_run)
             pprint(response)
@@ -377,7 +1324,7 @@ class AwsInstance(Instance):
 
     @staticmethod
     def delete_instance(instance_id: str, dry_run=False) -> None:
-        ec2 = CONFIG.get_session().client("ec2")
+        ec2 = CONFIG.get_client("ec2")
         try:
             response = ec2.terminate_instances(
                 InstanceIds=[instance_id], DryRun=dry_run
@@ -389,31 +1336,25 @@ class AwsInstance(Instance):
                 raise
 
     @staticmethod
-    def delete_all_instances(dry_run=False) -> None:
-        ec2 = CONFIG.get_session().client("ec2")
-        try:
-            response = ec2.describe_instances(
-                Filters=[{"Name": "instance-state-name", "Values": ["running"]}]
-                + AwsInstance._make_instance_filters(),
-                DryRun=dry_run,
+    def delete_all_instances(dry_run=False, all_regions=False) -> None:
+        regions = list(FULL_REGION_NAMES) if all_regions else [CONFIG.region_name]
+
+        workers = min(len(regions), _REGION_WORKERS)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(
+                lambda region: AwsInstance._terminate_all_in_region(region, dry_run),
+                regions,
             )
-            for reservation in response["Reservations"]:
-                for inst in reservation["Instances"]:
-                    instance_id = inst["InstanceId"]
-                    delete_response = ec2.terminate_instances(
-                        InstanceIds=[instance_id],
+            for region, statuses in zip(regions, results):
+                for instance_id, status in statuses:
+                    location = f" ({region})" if all_regions else ""
+                    nprint_header(
+                        f"Instance [green]{instance_id}[/green]{location}: {status}"
                     )
-                    status = delete_response["TerminatingInstances"][0]["CurrentState"][
-                        "Name"
-                    ]
-                    nprint_header(f"Instance [green]{instance_id}[/green]: {status}")
-        except botocore.exceptions.ClientError as e:
-            if "DryRunOperation" not in str(e):
-                raise
 
     @staticmethod
     def get_status(instance_id: str, dry_run=False) -> str:
-        ec2 = CONFIG.get_session().client("ec2")
+        ec2 = CONFIG.get_client("ec2")
         try:
             response = ec2.describe_instances(
                 InstanceIds=[instance_id],
@@ -427,48 +1368,223 @@ class AwsInstance(Instance):
                 raise
 
     @staticmethod
-    def ls_active_instances(dry_run=False) -> None:
-        ec2 = CONFIG.get_session().client("ec2")
+    def logs(instance_id: str, follow=False, dry_run=False) -> None:
+        """
+        Stream the job log over ssh while the instance runs, resuming from the
+        last byte written whenever the connection drops. Once the instance is
+        gone, only the bytes that were not streamed yet are read from S3.
+        """
+
+        if dry_run:
+            AwsInstance._get_host_from_instance_id(instance_id, dry_run)
+            return
+
+        offset, last_part = 0, None
+
+        while True:
+            status, host = AwsInstance._status_and_host(instance_id)
+
+            if status == "running" and host:
+                exit_code, offset = AwsInstance._stream_remote_log(host, offset, follow)
+                if exit_code == 0:
+                    return
+            elif status != "pending":
+                AwsInstance._read_s3_log(instance_id, offset, last_part)
+                return
+
+            # Catch up from S3 while ssh is unavailable, then try ssh again
+            offset, last_part = AwsInstance._read_s3_log(
+                instance_id, offset, last_part
+            )
+            if not follow:
+                return
+            time.sleep(_LOG_RECONNECT_DELAY)
+
+    @staticmethod
+    def _status_and_host(instance_id: str) -> Tuple[Optional[str], Optional[str]]:
+        """ The state and public IP of an instance, or None for unknown instances """
+
         try:
-            response = ec2.describe_instances(
-                Filters=[
-                    {"Name": "instance-state-name", "Values": ["running", "pending"]}
-                ]
-                + AwsInstance._make_instance_filters(),
-                DryRun=dry_run,
+            response = CONFIG.get_client("ec2").describe_instances(
+                InstanceIds=[instance_id],
+                Filters=AwsInstance._make_instance_filters(),
             )
-            for reservation in response["Reservations"]:
-                for inst in reservation["Instances"]:
-                    nprint(
-                        f"Id: [bright_green]{inst['InstanceId']}[/bright_green]\n"
-                        f"Status: {inst['State']['Name']}\n"
-                        f"Launch Time: {inst['LaunchTime']}\n"
-                        f"InstanceType: {inst['InstanceType']}\n"
-                        f"IP Address: {inst['PublicIpAddress']}\n"
-                    )
+        except botocore.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] != "InvalidInstanceID.NotFound":
+                raise
+            return None, None
+
+        if not response["Reservations"]:
+            return None, None
+        inst = response["Reservations"][0]["Instances"][0]
+        return inst["State"]["Name"], inst.get("PublicIpAddress")
+
+    @staticmethod
+    def _find_s3_log(instance_id: str) -> Optional[str]:
+        """ The key of the newest log of the instance, whether complete or not """
+
+        s3 = CONFIG.get_client("s3")
+        bucket, prefix = s3_sync.split_s3_path(CONFIG.s3_results_path)
+        suffix = f"_{instance_id}.txt"
+
+        # Listing one level deep returns every log once, not every log chunk
+        keys = []
+        paginator = s3.get_paginator("list_objects_v2")
+        for page in paginator.paginate(
+            Bucket=bucket, Prefix=f"{prefix}nimbo-logs/", Delimiter="/"
+        ):
+            keys.extend(obj["Key"] for obj in page.get("Contents", []))
+            keys.extend(
+                p["Prefix"][: -len(_LOG_PARTS_SUFFIX)]
+                for p in page.get("CommonPrefixes", [])
+                if p["Prefix"].endswith(_LOG_PARTS_SUFFIX)
+            )
+
+        keys = [key for key in keys if key.endswith(suffix)]
+        return max(keys) if keys else None
 
+    @staticmethod
+    def _read_s3_log(
+        instance_id: str, offset: int, last_part: Optional[str] = None
+    ) -> Tuple[int, Optional[str]]:
+        """
+        Write the log from byte offset on to stdout. The complete log is read
+        with a ranged GET, and until it is uploaded only the chunks after
+        last_part are listed. Returns the offset and last chunk reached.
+        """
+
+        log_key = AwsInstance._find_s3_log(instance_id)
+        if log_key is None:
+            return offset, last_part
+
+        s3 = CONFIG.get_client("s3")
+        bucket, _ = s3_sync.split_s3_path(CONFIG.s3_results_path)
+
+        try:
+            response = s3.get_object(
+                Bucket=bucket, Key=log_key, Range=f"bytes={offset}-"
+            )
+            data = response["Body"].read()
+            sys.stdout.buffer.write(data)
+            sys.stdout.buffer.flush()
+            return offset + len(data), last_part
+        except botocore.exceptions.ClientError as e:
+            code = e.response["Error"]["Code"]
+            if code == "InvalidRange":
+                # The complete log has no bytes past offset
+                return offset, last_part
+            if code not in ("NoSuchKey", "404"):
+                raise
+
+        parts_prefix = log_key + _LOG_PARTS_SUFFIX
+        paginator = s3.get_paginator("list_objects_v2")
+        for page in paginator.paginate(
+            Bucket=bucket, Prefix=parts_prefix, StartAfter=last_part or parts_prefix
+        ):
+            for obj in page.get("Contents", []):
+                last_part = obj["Key"]
+                part_offset = int(obj["Key"][len(parts_prefix) :])
+                if part_offset + obj["Size"] <= offset:
+                    continue
+
+                # Chunks may overlap bytes that were already streamed over ssh
+                skip = max(0, offset - part_offset)
+                extra_args = {"Range": f"bytes={skip}-"} if skip else {}
+                response = s3.get_object(Bucket=bucket, Key=obj["Key"], **extra_args)
+                data = response["Body"].read()
+                sys.stdout.buffer.write(data)
+                sys.stdout.buffer.flush()
+                offset = part_offset + skip + len(data)
+
+        return offset, last_part
+
+    @staticmethod
+    def ls_active_instances(dry_run=False) -> None:
+        try:
+            entries = [
+                f"Id: [bright_green]{inst['InstanceId']}[/bright_green]\n"
+                f"Status: {inst['State']['Name']}\n"
+                f"Launch Time: {inst['LaunchTime']}\n"
+                f"InstanceType: {inst['InstanceType']}\n"
+                f"IP Address: {inst.get('PublicIpAddress')}\n"
+                for inst in AwsInstance._describe_instances(
+                    ["running", "pending"], dry_run=dry_run
+                )
+            ]
         except botocore.exceptions.ClientError as e:
             if "DryRunOperation" not in str(e):
                 raise
+            return
+
+        if entries:
+            nprint("\n".join(entries))
 
     @staticmethod
     def ls_stopped_instances(dry_run=False) -> None:
-        ec2 = CONFIG.get_session().client("ec2")
         try:
-            response = ec2.describe_instances(
-                Filters=[
-                    {"Name": "instance-state-name", "Values": ["stopped", "stopping"]}
-                ]
-                + AwsInstance._make_instance_filters(),
-                DryRun=dry_run,
-            )
-            for reservation in response["Reservations"]:
-                for inst in reservation["Instances"]:
-                    print(
-                        f"ID: {inst['InstanceId']}\n"
-                        f"Launch Time: {inst['LaunchTime']}\n"
-                        f"InstanceType: {inst['InstanceType']}\n"
-                    )
+            entries = [
+                f"ID: {inst['InstanceId']}\n"
+                f"Launch Time: {inst['LaunchTime']}\n"
+                f"InstanceType: {inst['InstanceType']}\n"
+                for inst in AwsInstance._describe_instances(
+                    ["stopped", "stopping"], dry_run=dry_run
+                )
+            ]
         except botocore.exceptions.ClientError as e:
             if "DryRunOperation" not in str(e):
                 raise
+            return
+
+        if entries:
+            print("\n".join(entries))
+
+    @staticmethod
+    def _describe_instances(
+        states: List[str],
+        region_name: Optional[str] = None,
+        dry_run=False,
+        filters: Optional[List[Dict]] = None,
+    ) -> Generator[Dict, None, None]:
+        """ Yield every nimbo instance of the user in one of states, across pages """
+
+        ec2 = CONFIG.get_client("ec2", region_name=region_name)
+        paginator = ec2.get_paginator("describe_instances")
+        pages = paginator.paginate(
+            Filters=[{"Name": "instance-state-name", "Values": states}]
+            + AwsInstance._make_instance_filters()
+            + (filters or []),
+            DryRun=dry_run,
+        )
+        for page in pages:
+            for reservation in page["Reservations"]:
+                yield from reservation["Instances"]
+
+    @staticmethod
+    def _terminate_all_in_region(region_name: str, dry_run=False) -> List[Tuple]:
+        """ Terminate all running instances in a region, returning (id, state) """
+
+        try:
+            instance_ids = [
+                inst["InstanceId"]
+                for inst in AwsInstance._describe_instances(
+                    ["running"], region_name, dry_run
+                )
+            ]
+        except botocore.exceptions.ClientError as e:
+            # Regions that are not enabled for the account reject every request
+            error_code = e.response["Error"]["Code"]
+            if "DryRunOperation" in str(e) or error_code in _DISABLED_REGION_ERRORS:
+                return []
+            raise
+
+        ec2 = CONFIG.get_client("ec2", region_name=region_name)
+        statuses = []
+        for i in range(0, len(instance_ids), _TERMINATE_BATCH_SIZE):
+            response = ec2.terminate_instances(
+                InstanceIds=instance_ids[i : i + _TERMINATE_BATCH_SIZE]
+            )
+            statuses.extend(
+                (inst["InstanceId"], inst["CurrentState"]["Name"])
+                for inst in response["TerminatingInstances"]
+            )
+        return statuses
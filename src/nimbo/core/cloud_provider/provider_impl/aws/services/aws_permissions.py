@@ -7,6 +7,7 @@ import botocore.exceptions
 import requests
 
 from nimbo import CONFIG
+from nimbo.core import api_calls
 from nimbo.core.cloud_provider.provider.services.permissions import Permissions
 from nimbo.core.constants import ASSUME_ROLE_POLICY, EC2_POLICY_JSON
 from nimbo.core.print import nprint, nprint_header
@@ -21,7 +22,7 @@ S3_ACCESS_ROLE_NAME = "NimboFullS3AccessRole"
 class AwsPermissions(Permissions):
     @staticmethod
     def mk_instance_key(dry_run=False) -> None:
-        ec2 = CONFIG.get_session().client("ec2")
+        ec2 = CONFIG.get_client("ec2")
 
         if "/" in CONFIG.user_arn:
             username = CONFIG.user_arn.split("/")[1]
@@ -45,7 +46,7 @@ class AwsPermissions(Permissions):
 
     @staticmethod
     def allow_ingress_current_ip(target: str, dry_run=False) -> None:
-        ec2 = CONFIG.get_session().client("ec2")
+        ec2 = CONFIG.get_client("ec2")
 
         try:
             response = ec2.describe_security_groups(GroupNames=[target], DryRun=dry_run)
@@ -90,9 +91,14 @@ class AwsPermissions(Permissions):
     @staticmethod
     def setup(profile: str, no_s3_access=False) -> None:
         session = boto3.Session(profile_name=profile)
-        account = session.client("sts").get_caller_identity()["Account"]
+        sts = api_calls.instrument(
+            session.client("sts", config=api_calls.client_config())
+        )
+        account = sts.get_caller_identity()["Account"]
 
-        iam = session.client("iam")
+        iam = api_calls.instrument(
+            session.client("iam", config=api_calls.client_config())
+        )
 
         nprint_header(f"Creating user group {NIMBO_USER_GROUP}...")
         AwsPermissions._create_group(iam, NIMBO_USER_GROUP)
@@ -174,7 +180,9 @@ class AwsPermissions(Permissions):
     @staticmethod
     def add_user(profile: str, username: str) -> None:
         session = boto3.Session(profile_name=profile)
-        iam = session.client("iam")
+        iam = api_calls.instrument(
+            session.client("iam", config=api_calls.client_config())
+        )
 
         iam.add_user_to_group(GroupName=NIMBO_USER_GROUP, UserName=username)
         print(f"User {username} added to {NIMBO_USER_GROUP}.")
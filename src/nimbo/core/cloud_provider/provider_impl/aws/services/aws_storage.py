@@ -5,6 +5,7 @@ import botocore.exceptions
 
 from nimbo import CONFIG
 from nimbo.core.cloud_provider.provider.services.storage import Storage
+from nimbo.core.cloud_provider.provider_impl.aws import s3_sync
 from nimbo.core.print import nprint
 
 
@@ -64,9 +65,8 @@ class AwsStorage(Storage):
         """
 
         try:
-            session = CONFIG.get_session()
-            s3 = session.client("s3")
-            location = {"LocationConstraint": session.region_name}
+            s3 = CONFIG.get_client("s3")
+            location = {"LocationConstraint": CONFIG.region_name}
             s3.create_bucket(Bucket=bucket_name, CreateBucketConfiguration=location)
         except botocore.exceptions.ClientError as e:
             if e.response["Error"]["Code"] == "BucketAlreadyOwnedByYou":
@@ -79,9 +79,8 @@ class AwsStorage(Storage):
 
     @staticmethod
     def _sync_folder(source, target, delete=False) -> None:
-        command = AwsStorage.mk_s3_command("sync", source, target, delete)
-        print(f"\nRunning command: {command}")
-        subprocess.Popen(command, shell=True).communicate()
+        print(f"\nSyncing {source} to {target}...")
+        s3_sync.sync(source, target, delete)
 
     @staticmethod
     def mk_s3_command(cmd, source, target, delete=False) -> str:
@@ -1,13 +1,27 @@
 import json
-from datetime import date, datetime
-from typing import Generator
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, Generator, List, Optional
 
 from dateutil.relativedelta import relativedelta
 
 from nimbo import CONFIG
+from nimbo.core import cache, timing
 from nimbo.core.cloud_provider.provider.services.utils import Utils
-from nimbo.core.constants import FULL_REGION_NAMES, INSTANCE_GPU_MAP
-from nimbo.core.print import nprint
+from nimbo.core.cloud_provider.provider_impl.aws import s3_sync
+from nimbo.core.constants import (
+    FULL_REGION_NAMES,
+    INSTANCE_GPU_MAP,
+    PRICE_CACHE_TTL,
+    SPOT_PRICE_CACHE_TTL,
+)
+from nimbo.core.print import nprint, nprint_header
+
+# Instance type families with GPUs, matched server side by describe_instance_types
+_GPU_INSTANCE_PATTERNS = ["p2.*", "p3.*", "p3dn.*", "p4d.*", "g4dn.*"]
+# Concurrent pricing requests, kept low as the pricing API throttles aggressively
+_PRICING_WORKERS = 8
+_SPOT_HISTORY_HOURS = 24
 
 
 class AwsUtils(Utils):
@@ -16,9 +30,19 @@ class AwsUtils(Utils):
         if dry_run:
             return
 
-        full_region_name = FULL_REGION_NAMES[CONFIG.region_name]
+        cache_key = CONFIG.region_name
+        prices = cache.load("gpu_prices", cache_key, PRICE_CACHE_TTL)
 
-        pricing = CONFIG.get_session().client("pricing", region_name="us-east-1")
+        if prices is None:
+            instance_types = list(AwsUtils._instance_types())
+            with ThreadPoolExecutor(max_workers=_PRICING_WORKERS) as executor:
+                prices = dict(
+                    zip(
+                        instance_types,
+                        executor.map(AwsUtils._on_demand_price, instance_types),
+                    )
+                )
+            cache.store("gpu_prices", cache_key, prices)
 
         string = AwsUtils._format_price_string(
             "InstanceType", "Price ($/hour)", "GPUs", "CPUs", "Mem (Gb)"
@@ -26,40 +50,9 @@ class AwsUtils(Utils):
         print()
         nprint(string, style="bold")
 
-        for instance_type in AwsUtils._instance_types():
-            response = pricing.get_products(
-                ServiceCode="AmazonEC2",
-                MaxResults=100,
-                FormatVersion="aws_v1",
-                Filters=[
-                    {
-                        "Type": "TERM_MATCH",
-                        "Field": "instanceType",
-                        "Value": instance_type,
-                    },
-                    {
-                        "Type": "TERM_MATCH",
-                        "Field": "location",
-                        "Value": full_region_name,
-                    },
-                    {
-                        "Type": "TERM_MATCH",
-                        "Field": "operatingSystem",
-                        "Value": "Linux",
-                    },
-                    {"Type": "TERM_MATCH", "Field": "capacitystatus", "Value": "Used"},
-                    {"Type": "TERM_MATCH", "Field": "preInstalledSw", "Value": "NA"},
-                    {"Type": "TERM_MATCH", "Field": "tenancy", "Value": "shared"},
-                ],
-            )
-
-            inst = json.loads(response["PriceList"][0])
-            inst = inst["terms"]["OnDemand"]
-            inst = list(inst.values())[0]
-            inst = list(inst["priceDimensions"].values())[0]
-            inst = inst["pricePerUnit"]
-            currency = list(inst.keys())[0]
-            price = float(inst[currency])
+        for instance_type, price in prices.items():
+            if price is None:
+                continue
 
             num_gpus, gpu_type, mem, cpus = INSTANCE_GPU_MAP[instance_type]
             string = AwsUtils._format_price_string(
@@ -68,54 +61,137 @@ class AwsUtils(Utils):
             print(string)
         print()
 
+    @staticmethod
+    def _on_demand_price(instance_type: str) -> Optional[float]:
+        """ On-demand Linux price of instance_type in CONFIG.region_name """
+
+        full_region_name = FULL_REGION_NAMES[CONFIG.region_name]
+        pricing = CONFIG.get_client("pricing", region_name="us-east-1")
+
+        response = pricing.get_products(
+            ServiceCode="AmazonEC2",
+            MaxResults=100,
+            FormatVersion="aws_v1",
+            Filters=[
+                {
+                    "Type": "TERM_MATCH",
+                    "Field": "instanceType",
+                    "Value": instance_type,
+                },
+                {
+                    "Type": "TERM_MATCH",
+                    "Field": "location",
+                    "Value": full_region_name,
+                },
+                {
+                    "Type": "TERM_MATCH",
+                    "Field": "operatingSystem",
+                    "Value": "Linux",
+                },
+                {"Type": "TERM_MATCH", "Field": "capacitystatus", "Value": "Used"},
+                {"Type": "TERM_MATCH", "Field": "preInstalledSw", "Value": "NA"},
+                {"Type": "TERM_MATCH", "Field": "tenancy", "Value": "shared"},
+            ],
+        )
+
+        if not response["PriceList"]:
+            return None
+
+        inst = json.loads(response["PriceList"][0])
+        inst = inst["terms"]["OnDemand"]
+        inst = list(inst.values())[0]
+        inst = list(inst["priceDimensions"].values())[0]
+        inst = inst["pricePerUnit"]
+        currency = list(inst.keys())[0]
+        return float(inst[currency])
+
     @staticmethod
     def ls_spot_gpu_prices(dry_run=False) -> None:
         if dry_run:
             return
 
-        ec2 = CONFIG.get_session().client("ec2")
+        cache_key = CONFIG.region_name
+        rows = cache.load("spot_prices", cache_key, SPOT_PRICE_CACHE_TTL)
 
-        string = AwsUtils._format_price_string(
-            "InstanceType", "Price ($/hour)", "GPUs", "CPUs", "Mem (Gb)"
+        if rows is None:
+            ec2 = CONFIG.get_client("ec2")
+            paginator = ec2.get_paginator("describe_spot_price_history")
+            pages = paginator.paginate(
+                InstanceTypes=list(INSTANCE_GPU_MAP.keys()),
+                ProductDescriptions=["Linux/UNIX"],
+                StartTime=datetime.utcnow() - timedelta(hours=_SPOT_HISTORY_HOURS),
+            )
+            records = [r for page in pages for r in page["SpotPriceHistory"]]
+            rows = AwsUtils._aggregate_spot_prices(records)
+            cache.store("spot_prices", cache_key, rows)
+
+        string = AwsUtils._format_spot_price_string(
+            "InstanceType", "Zone", "Latest", "Min", "Mean", "GPUs", "CPUs", "Mem (Gb)"
         )
         print()
         nprint(string, style="bold")
+        nprint(
+            f"\tPrices in $/hour over the last {_SPOT_HISTORY_HOURS} hours", style="dim"
+        )
 
-        for instance_type in AwsUtils._instance_types():
-            response = ec2.describe_spot_price_history(
-                InstanceTypes=[instance_type],
-                Filters=[{"Name": "product-description", "Values": ["Linux/UNIX"]}],
-            )
-
-            price = float(response["SpotPriceHistory"][0]["SpotPrice"])
-
+        for instance_type, zone, latest, low, mean in rows:
             num_gpus, gpu_type, mem, cpus = INSTANCE_GPU_MAP[instance_type]
-            string = AwsUtils._format_price_string(
-                instance_type, round(price, 2), f"{num_gpus} x {gpu_type}", cpus, mem
+            string = AwsUtils._format_spot_price_string(
+                instance_type,
+                zone,
+                round(latest, 2),
+                round(low, 2),
+                round(mean, 2),
+                f"{num_gpus} x {gpu_type}",
+                cpus,
+                mem,
             )
             print(string)
         print()
 
+    @staticmethod
+    def _aggregate_spot_prices(records: List[Dict[str, Any]]) -> List[List]:
+        """
+        Reduce SpotPriceHistory records to rows of
+        [instance_type, availability_zone, latest, min, mean], sorted by
+        instance type and then by latest price
+        """
+
+        grouped = {}
+        for record in records:
+            key = (record["InstanceType"], record["AvailabilityZone"])
+            grouped.setdefault(key, []).append(record)
+
+        rows = []
+        for (instance_type, zone), zone_records in grouped.items():
+            prices = [float(r["SpotPrice"]) for r in zone_records]
+            latest = max(zone_records, key=lambda r: r["Timestamp"])
+            rows.append(
+                [
+                    instance_type,
+                    zone,
+                    float(latest["SpotPrice"]),
+                    min(prices),
+                    sum(prices) / len(prices),
+                ]
+            )
+
+        return sorted(rows, key=lambda row: (row[0], row[2]))
+
     @staticmethod
     def _instance_types() -> Generator[str, None, None]:
         """Yield all relevant EC2 instance types in region CONFIG.region_name"""
 
-        describe_args = {}
-        client = CONFIG.get_session().client("ec2")
-
-        def instance_type_generator():
-            while True:
-                describe_result = client.describe_instance_types(**describe_args)
-                yield from (i["InstanceType"] for i in describe_result["InstanceTypes"])
-                if "NextToken" not in describe_result:
-                    break
-                describe_args["NextToken"] = describe_result["NextToken"]
-
-        return (
-            inst
-            for inst in sorted(instance_type_generator())
-            if inst.startswith(("p2", "p3", "p4", "g4d"))
+        client = CONFIG.get_client("ec2")
+        paginator = client.get_paginator("describe_instance_types")
+        pages = paginator.paginate(
+            Filters=[{"Name": "instance-type", "Values": _GPU_INSTANCE_PATTERNS}]
+        )
+
+        instance_types = (
+            i["InstanceType"] for page in pages for i in page["InstanceTypes"]
         )
+        return (inst for inst in sorted(instance_types) if inst in INSTANCE_GPU_MAP)
 
     @staticmethod
     def _format_price_string(instance_type, price, gpus, cpus, mem) -> str:
@@ -124,6 +200,15 @@ class AwsUtils(Utils):
         )
         return string
 
+    @staticmethod
+    def _format_spot_price_string(
+        instance_type, zone, latest, low, mean, gpus, cpus, mem
+    ) -> str:
+        string = (
+            "\t{0: <16} {1: <16} {2: <8} {3: <8} {4: <8} {5: <10} {6: <5} {7:<7}"
+        ).format(instance_type, zone, latest, low, mean, gpus, cpus, mem)
+        return string
+
     @staticmethod
     def spending(qty: int, timescale: str, dry_run=False) -> None:
         today = date.today()
@@ -148,7 +233,7 @@ class AwsUtils(Utils):
             "Amazon Simple Storage Service",
         ]
 
-        client = CONFIG.get_session().client("ce")
+        client = CONFIG.get_client("ce")
         results = client.get_cost_and_usage(
             TimePeriod={"End": end, "Start": start},
             Granularity=granularity.upper(),
@@ -218,3 +303,52 @@ class AwsUtils(Utils):
         print("\t" + "-" * 32)
         print(row_string(["Total", ec2_total, s3_total]))
         print()
+
+    @staticmethod
+    def timings(instance_id: str, output: Optional[str] = None, dry_run=False) -> None:
+        if dry_run:
+            return
+
+        spans = AwsUtils._load_timings(instance_id)
+        if not spans:
+            raise ValueError(
+                f"No timings found for {instance_id} in {CONFIG.s3_results_path}"
+            )
+
+        from rich.table import Table
+
+        start = spans[0]["ts"]
+        end = max(s["ts"] + s["dur"] for s in spans)
+        table = Table("Phase", "Where", "Start (s)", "Duration (s)")
+        for s in spans:
+            table.add_row(
+                s["name"],
+                s.get("cat", ""),
+                f"{(s['ts'] - start) / 1e6:.1f}",
+                f"{s['dur'] / 1e6:.1f}",
+            )
+        table.add_row("total", "", "0.0", f"{(end - start) / 1e6:.1f}", style="bold")
+
+        print()
+        nprint(table)
+
+        if output:
+            with open(output, "w") as f:
+                json.dump(timing.chrome_trace(spans), f)
+            nprint_header(f"Trace written to {output}, open it in chrome://tracing")
+
+    @staticmethod
+    def _load_timings(instance_id: str) -> List[Dict[str, Any]]:
+        """ The local and remote spans of an instance, ordered by start time """
+
+        s3 = CONFIG.get_client("s3")
+        bucket, prefix = s3_sync.split_s3_path(CONFIG.s3_results_path)
+        prefix = f"{prefix}nimbo-timings/{instance_id}/"
+
+        spans = []
+        response = s3.list_objects_v2(Bucket=bucket, Prefix=prefix)
+        for obj in response.get("Contents", []):
+            body = s3.get_object(Bucket=bucket, Key=obj["Key"])["Body"].read()
+            spans.extend(timing.loads(body.decode("utf-8")))
+
+        return sorted(spans, key=lambda s: s["ts"])
@@ -1,11 +1,29 @@
-from typing import Dict
+from typing import Dict, List, Optional
 
 from nimbo.core.cloud_provider.provider.services.instance import Instance
+from nimbo.core.scheduler import Resources
 
 
 class GcpInstance(Instance):
     @staticmethod
-    def run(job_cmd: str, dry_run=False) -> Dict[str, str]:
+    def run(job_cmd: str, dry_run=False, watch_spot=False) -> Dict[str, str]:
+        pass
+
+    @staticmethod
+    def run_sweep(
+        job_cmds: List[str],
+        resources: Optional[Resources] = None,
+        max_instances: Optional[int] = None,
+        dry_run=False,
+    ) -> List[Dict[str, str]]:
+        pass
+
+    @staticmethod
+    def bake_image(dry_run=False) -> Optional[str]:
+        pass
+
+    @staticmethod
+    def snapshot_datasets(dry_run=False) -> Optional[str]:
         pass
 
     @staticmethod
@@ -13,7 +31,7 @@ class GcpInstance(Instance):
         pass
 
     @staticmethod
-    def _block_until_instance_running(instance_id: str) -> None:
+    def _block_until_instance_running(instance_id: str) -> str:
         pass
 
     @staticmethod
@@ -33,7 +51,7 @@ class GcpInstance(Instance):
         pass
 
     @staticmethod
-    def delete_all_instances(dry_run=False) -> None:
+    def delete_all_instances(dry_run=False, all_regions=False) -> None:
         pass
 
     @staticmethod
@@ -44,6 +62,10 @@ class GcpInstance(Instance):
     def ls_active_instances(dry_run=False) -> None:
         pass
 
+    @staticmethod
+    def logs(instance_id: str, follow=False, dry_run=False) -> None:
+        pass
+
     @staticmethod
     def ls_stopped_instances(dry_run=False) -> None:
         pass
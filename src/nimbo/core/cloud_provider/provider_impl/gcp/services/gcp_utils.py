@@ -1,3 +1,5 @@
+from typing import Optional
+
 from nimbo.core.cloud_provider.provider.services.utils import Utils
 
 
@@ -13,3 +15,7 @@ class GcpUtils(Utils):
     @staticmethod
     def spending(qty: int, timescale: str, dry_run=False) -> None:
         pass
+
+    @staticmethod
+    def timings(instance_id: str, output: Optional[str] = None, dry_run=False) -> None:
+        pass
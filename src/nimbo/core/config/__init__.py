@@ -1,16 +1,21 @@
 import typing as t
 
-import pydantic
+from nimbo.core.config.enums import CloudProvider, RequiredCase
 
-import nimbo.core.config.yaml_loader
-from nimbo.core.config.aws_config import AwsConfig
-from nimbo.core.config.common_config import CloudProvider
-from nimbo.core.config.common_config import RequiredCase
-from nimbo.core.config.gcp_config import GcpConfig
+if t.TYPE_CHECKING:
+    from nimbo.core.config.aws_config import AwsConfig
+    from nimbo.core.config.gcp_config import GcpConfig
 
 
 # noinspection PyUnresolvedReferences
-def make_config(config_path: str) -> t.Union[AwsConfig, GcpConfig]:
+def make_config(config_path: str) -> t.Union["AwsConfig", "GcpConfig"]:
+    # pydantic and the config models are only imported once a command runs
+    import pydantic
+
+    from nimbo.core.config import yaml_loader
+    from nimbo.core.config.aws_config import AwsConfig
+    from nimbo.core.config.gcp_config import GcpConfig
+
     config = yaml_loader.from_file(config_path)
     config["config_path"] = config_path
 
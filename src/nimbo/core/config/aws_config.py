@@ -1,15 +1,25 @@
 import enum
 import os
 import sys
-from typing import Optional
+import threading
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple, Union
 
-import boto3
-import botocore
-import botocore.session
 import pydantic
 
+from nimbo.core import api_calls, cache
 from nimbo.core.config.common_config import BaseConfig, RequiredCase
-from nimbo.core.constants import FULL_REGION_NAMES
+from nimbo.core.constants import FULL_REGION_NAMES, IDENTITY_CACHE_TTL
+
+if TYPE_CHECKING:
+    import boto3
+
+# Process-wide caches, sessions are keyed by (profile, region) and clients by
+# (profile, region, service, max_pool_connections). boto3 sessions are not
+# thread safe, so every session and client is created holding _CACHE_LOCK.
+_SESSIONS: Dict[Tuple[Optional[str], Optional[str]], "boto3.Session"] = {}
+_CLIENTS: Dict[Tuple[Optional[str], Optional[str], str, Optional[int]], Any] = {}
+_IDENTITIES: Dict[str, Dict[str, str]] = {}
+_CACHE_LOCK = threading.RLock()
 
 
 class _DiskType(str, enum.Enum):
@@ -22,6 +32,11 @@ class _DiskType(str, enum.Enum):
     GP3 = "gp3"
 
 
+class _InstanceStoreUse(str, enum.Enum):
+    DATASETS = "datasets"
+    CONDA_PKGS = "conda_pkgs"
+
+
 class _Encryption(str, enum.Enum):
     AES256 = "AES256"
     AWSKMS = "aws:kms"
@@ -30,36 +45,130 @@ class _Encryption(str, enum.Enum):
 class AwsConfig(BaseConfig):
     aws_profile: Optional[str] = None
     region_name: Optional[str] = None
-    image: Optional[str] = None
+    # Either one AMI, or a map of region names to AMIs such as the one printed by
+    # ami/copy_images.py, in which case the AMI of region_name is used
+    image: Union[str, Dict[str, str], None] = None
+    # Launch from an image made with 'nimbo bake-image' when one matches
+    use_baked_images: bool = True
 
     s3_datasets_path: Optional[str] = None
+    # Attach the datasets as an EBS volume restored from the newest snapshot made
+    # by 'nimbo snapshot-datasets', only files changed since are downloaded
+    dataset_snapshots: bool = False
+    # Zones to enable fast snapshot restore in for new dataset snapshots
+    dataset_snapshot_fast_restore_zones: List[str] = []
     s3_results_path: Optional[str] = None
     encryption: _Encryption = None
+    s3_transfer_workers: pydantic.conint(ge=1) = 16
+    s3_chunk_size_mb: pydantic.conint(ge=5) = 8
 
     instance_type: Optional[str] = None
     disk_size: Optional[int] = None
     disk_iops: pydantic.conint(ge=0) = None
     disk_type: _DiskType = _DiskType.GP2
+    # Local NVMe instance store volumes are striped together on instance types
+    # that have them, and used for the datasets and the conda package cache
+    instance_store: List[_InstanceStoreUse] = []
     spot: bool = False
     spot_duration: pydantic.conint(ge=60, le=360, multiple_of=60) = None
+    # Spot requests are also placed for these instance types and zones, the
+    # first one to be fulfilled is used, preferring earlier types and zones
+    spot_fallback_types: List[str] = []
+    spot_availability_zones: List[str] = []
+    # Jobs on interrupted spot instances are relaunched up to this many times,
+    # after running the hook so that the job can save a checkpoint to results.
+    # Jobs run in the background are only relaunched with 'nimbo run --watch-spot'
+    spot_max_relaunches: pydantic.conint(ge=0) = 0
+    spot_interruption_hook: Optional[str] = None
     security_group: Optional[str] = None
     instance_key: Optional[str] = None
     role: Optional[str] = None
+    # Number of stopped instances kept per (instance type, image, conda env) for
+    # reuse by later runs, 0 disables the warm pool
+    warm_pool_size: pydantic.conint(ge=0) = 0
 
     # The following are defined internally
     user_arn: Optional[str] = None
 
-    def get_session(self) -> boto3.Session:
-        session = boto3.Session(
-            profile_name=self.aws_profile, region_name=self.region_name
-        )
+    def get_session(self) -> "boto3.Session":
+        # boto3 is only imported once a command talks to AWS
+        import boto3
+
+        key = (self.aws_profile, self.region_name)
+
+        with _CACHE_LOCK:
+            session = _SESSIONS.get(key)
+            if session is None:
+                session = boto3.Session(
+                    profile_name=self.aws_profile, region_name=self.region_name
+                )
+                _SESSIONS[key] = session
+
+            caller_identity = self._get_caller_identity(session)
 
-        caller_identity = session.client("sts").get_caller_identity()
         self.user_id = caller_identity["UserId"]
         self.user_arn = caller_identity["Arn"]
 
         return session
 
+    def get_client(
+        self,
+        service: str,
+        region_name: Optional[str] = None,
+        max_pool_connections: Optional[int] = None,
+    ) -> Any:
+        """
+        Get a cached boto3 client with adaptive retries and call accounting,
+        region_name defaults to the config region
+        """
+
+        region_name = region_name if region_name else self.region_name
+        key = (self.aws_profile, region_name, service, max_pool_connections)
+
+        with _CACHE_LOCK:
+            session = self.get_session()
+            client = _CLIENTS.get(key)
+            if client is None:
+                client = api_calls.instrument(
+                    session.client(
+                        service,
+                        region_name=region_name,
+                        config=api_calls.client_config(max_pool_connections),
+                    )
+                )
+                _CLIENTS[key] = client
+
+        return client
+
+    def _get_caller_identity(self, session: "boto3.Session") -> Dict[str, str]:
+        """
+        Resolve the STS caller identity once per profile and access key, reusing
+        an on-disk copy for IDENTITY_CACHE_TTL seconds so that short CLI
+        invocations skip STS
+        """
+
+        # Keyed by the access key as well, so that the identity is looked up
+        # again as soon as the credentials behind a profile change
+        credentials = session.get_credentials()
+        access_key = credentials.access_key if credentials else None
+        cache_key = f"{self.aws_profile}:{access_key}"
+
+        if cache_key in _IDENTITIES:
+            return _IDENTITIES[cache_key]
+
+        caller_identity = cache.load("identity", cache_key, IDENTITY_CACHE_TTL)
+
+        if not caller_identity:
+            sts = api_calls.instrument(
+                session.client("sts", config=api_calls.client_config())
+            )
+            response = sts.get_caller_identity()
+            caller_identity = {"UserId": response["UserId"], "Arn": response["Arn"]}
+            cache.store("identity", cache_key, caller_identity)
+
+        _IDENTITIES[cache_key] = caller_identity
+        return caller_identity
+
     def assert_required_config_exists(self, *cases: RequiredCase) -> None:
         """ Designed to be used with the assert_required_config annotation """
 
@@ -129,6 +238,8 @@ class AwsConfig(BaseConfig):
             sys.exit(1)
 
     def _aws_profile_exists(self) -> Optional[str]:
+        import botocore.session
+
         if self.aws_profile not in botocore.session.Session().available_profiles:
             return f"AWS Profile '{self.aws_profile}' could not be found"
 
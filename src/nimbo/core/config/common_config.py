@@ -1,36 +1,11 @@
-import enum
 import os
-from typing import Optional, Set
+from typing import List, Optional
 
 import pydantic
 
-
-class RequiredCase(str, enum.Enum):
-    # First digit is a unique ID, other digits are the IDs of dependencies
-    NONE = "0"
-    MINIMAL = "10"
-    STORAGE = "210"
-    INSTANCE = "310"
-    JOB = "43210"
-
-    @classmethod
-    def decompose(cls, *cases: "RequiredCase") -> Set["RequiredCase"]:
-        """ Gets all cases that compose each case and the case itself """
-
-        decomposed = set()
-
-        for case in cases:
-            for c in RequiredCase:
-                if c[0] in case.value:
-                    decomposed.add(c)
-
-        # noinspection PyTypeChecker
-        return decomposed
-
-
-class CloudProvider(str, enum.Enum):
-    AWS = "AWS"
-    GCP = "GCP"
+# RequiredCase and CloudProvider live in a pydantic free module so that the CLI
+# can be built without importing pydantic; they are re-exported from here
+from nimbo.core.config.enums import CloudProvider, RequiredCase
 
 
 class BaseConfig(pydantic.BaseModel):
@@ -43,8 +18,13 @@ class BaseConfig(pydantic.BaseModel):
 
     local_datasets_path: Optional[str] = None
     local_results_path: Optional[str] = None
+    # Jobs start once files matching these patterns (relative to the project
+    # root) are staged, the remaining files keep downloading in the background
+    stage_required_files: List[str] = []
+    stage_workers: pydantic.conint(strict=True, ge=1) = 32
 
     conda_env: Optional[str] = None
+    conda_env_cache: bool = True
     run_in_background: bool = False
     persist: bool = False
 
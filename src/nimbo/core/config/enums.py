@@ -0,0 +1,30 @@
+import enum
+from typing import Set
+
+
+class RequiredCase(str, enum.Enum):
+    # First digit is a unique ID, other digits are the IDs of dependencies
+    NONE = "0"
+    MINIMAL = "10"
+    STORAGE = "210"
+    INSTANCE = "310"
+    JOB = "43210"
+
+    @classmethod
+    def decompose(cls, *cases: "RequiredCase") -> Set["RequiredCase"]:
+        """ Gets all cases that compose each case and the case itself """
+
+        decomposed = set()
+
+        for case in cases:
+            for c in RequiredCase:
+                if c[0] in case.value:
+                    decomposed.add(c)
+
+        # noinspection PyTypeChecker
+        return decomposed
+
+
+class CloudProvider(str, enum.Enum):
+    AWS = "AWS"
+    GCP = "GCP"
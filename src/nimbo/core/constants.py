@@ -5,6 +5,20 @@ IS_TEST_ENV = "NIMBO_ENV" in os.environ and os.environ["NIMBO_ENV"] == "test"
 
 NIMBO_ROOT = str(pathlib.Path(__file__).parent.parent.absolute())
 NIMBO_VARS = "/tmp/nimbo_vars"
+# Output of jobs run in the background, also shipped to <s3_results_path>/nimbo-logs/
+NIMBO_REMOTE_LOG = "/home/ubuntu/nimbo-log.txt"
+# One multiplexed master ssh connection is shared by every ssh/scp/rsync call
+# to the same host and kept open for SSH_CONTROL_PERSIST seconds after last use
+SSH_CONTROL_PATH = "/tmp/nimbo-ssh-%C"
+SSH_CONTROL_PERSIST = 600
+
+NIMBO_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".nimbo", "cache")
+
+# Seconds for which the STS caller identity of a profile is reused from disk
+IDENTITY_CACHE_TTL = 3600
+# Seconds for which GPU on-demand and spot prices are reused from disk
+PRICE_CACHE_TTL = 6 * 3600
+SPOT_PRICE_CACHE_TTL = 1800
 
 NIMBO_DEFAULT_CONFIG = """cloud_provider: AWS
 
@@ -99,7 +113,9 @@ EC2_POLICY_JSON = {
             "Action": [
                 "ec2:AuthorizeSecurityGroupEgress",
                 "ec2:AuthorizeSecurityGroupIngress",
+                "ec2:CreateImage",
                 "ec2:CreateKeyPair",
+                "ec2:CreateSnapshot",
                 "ec2:CreateSecurityGroup",
                 "ec2:CreateTags",
                 "ec2:CreateVolume",
@@ -108,6 +124,7 @@ EC2_POLICY_JSON = {
                 "ec2:DeleteTags",
                 "ec2:DeleteVolume",
                 "ec2:Describe*",
+                "ec2:EnableFastSnapshotRestores",
                 "ec2:GetConsole*",
                 "ec2:ModifySnapshotAttribute",
                 "ec2:RequestSpotInstances",
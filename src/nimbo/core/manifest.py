@@ -0,0 +1,92 @@
+"""
+Content hashed manifests of the project files that get synced to instances.
+
+A manifest maps each relative file path to [size, mtime_ns, sha1]. Hashes from
+the previous manifest are reused for files whose size and mtime are unchanged,
+so building a manifest for a warm project only hashes the files that were
+actually edited.
+"""
+
+import hashlib
+import json
+import os
+import subprocess
+from typing import Dict, List, Optional, Tuple
+
+from nimbo.core.constants import NIMBO_CACHE_DIR
+
+Manifest = Dict[str, List]
+
+_MANIFEST_DIR = os.path.join(NIMBO_CACHE_DIR, "manifests")
+_FALLBACK_EXTENSIONS = (".py", ".ipynb", ".sh")
+
+
+def project_files() -> List[str]:
+    """
+    Files tracked by git, including staged and unstaged working tree changes.
+    Without a git repo, fall back to all python, notebook and bash files.
+    """
+
+    if os.path.isdir(".git"):
+        output = subprocess.check_output(["git", "ls-files", "-z", "--cached"])
+        files = [f for f in output.decode("utf-8").split("\0") if f]
+        # Tracked files deleted from the working tree are not synced
+        return [f for f in files if os.path.isfile(f)]
+
+    files = []
+    for root, dirs, file_names in os.walk("."):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        for file_name in file_names:
+            if file_name.endswith(_FALLBACK_EXTENSIONS):
+                path = os.path.relpath(os.path.join(root, file_name))
+                files.append(path.replace(os.sep, "/"))
+    return files
+
+
+def file_hash(path: str) -> str:
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def build(files: List[str], previous: Optional[Manifest] = None) -> Manifest:
+    previous = previous or {}
+    manifest = {}
+
+    for path in files:
+        stat = os.stat(path)
+        old = previous.get(path)
+        if old and old[0] == stat.st_size and old[1] == stat.st_mtime_ns:
+            manifest[path] = old
+        else:
+            manifest[path] = [stat.st_size, stat.st_mtime_ns, file_hash(path)]
+
+    return manifest
+
+
+def diff(new: Manifest, old: Manifest) -> Tuple[List[str], List[str]]:
+    """ Return (changed or added paths, removed paths) going from old to new """
+
+    changed = [
+        path
+        for path, entry in new.items()
+        if path not in old or old[path][2] != entry[2]
+    ]
+    removed = [path for path in old if path not in new]
+    return sorted(changed), sorted(removed)
+
+
+def load(name: str) -> Manifest:
+    try:
+        with open(os.path.join(_MANIFEST_DIR, f"{name}.json"), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save(name: str, manifest: Manifest) -> None:
+    os.makedirs(_MANIFEST_DIR, exist_ok=True)
+    with open(os.path.join(_MANIFEST_DIR, f"{name}.json"), "w") as f:
+        json.dump(manifest, f)
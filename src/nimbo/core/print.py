@@ -1,25 +1,46 @@
-from rich.console import Console
-from rich.theme import Theme
-
-_console = Console(
-    theme=Theme(
-        {
-            "repr.number": "",
-            "repr.str": "",
-            "repr.ellipsis": "",
-            "repr.eui48": "",
-            "repr.eui64": "",
-            "repr.ipv4": "",
-            "repr.ipv6": "",
-            "repr.filename": "",
-            "repr.path": "",
-            "error": "bold red",
-            "warning": "bold magenta",
-        }
-    )
-)
-nprint = _console.print
+_console = None
+
+
+def _get_console():
+    # rich is imported on first print rather than when the CLI starts
+    global _console
+
+    if _console is None:
+        from rich.console import Console
+        from rich.theme import Theme
+
+        _console = Console(
+            theme=Theme(
+                {
+                    "repr.number": "",
+                    "repr.str": "",
+                    "repr.ellipsis": "",
+                    "repr.eui48": "",
+                    "repr.eui64": "",
+                    "repr.ipv4": "",
+                    "repr.ipv6": "",
+                    "repr.filename": "",
+                    "repr.path": "",
+                    "error": "bold red",
+                    "warning": "bold magenta",
+                }
+            )
+        )
+
+    return _console
+
+
+def nprint(*args, **kwargs) -> None:
+    _get_console().print(*args, **kwargs)
 
 
 def nprint_header(x) -> None:
     nprint(f"[blue]==>[/blue] {x}", style="bold")
+
+
+def nlive(renderable):
+    """ A rich Live display that nprint output is printed above """
+
+    from rich.live import Live
+
+    return Live(renderable, console=_get_console(), refresh_per_second=4)
@@ -0,0 +1,79 @@
+"""
+Packing of sweep jobs onto multi-GPU instances.
+
+Jobs are packed first fit decreasing into groups that fit on one instance at the
+same time. When the number of instances is capped, every instance gets a queue
+of several groups, and the nimbo_schedule.py agent on the instance backfills
+the GPUs freed by finished jobs with the next queued jobs that fit.
+"""
+
+from typing import List, NamedTuple, Optional
+
+from nimbo.core.constants import INSTANCE_GPU_MAP
+
+
+class Resources(NamedTuple):
+    gpus: int
+    cpus: int
+    memory: int
+
+
+def instance_resources(instance_type: str) -> Resources:
+    if instance_type not in INSTANCE_GPU_MAP:
+        raise ValueError(
+            f"Jobs can only be packed onto GPU instances, '{instance_type}' should be"
+            f" one of {', '.join(INSTANCE_GPU_MAP)}"
+        )
+
+    gpus, _, memory, cpus = INSTANCE_GPU_MAP[instance_type]
+    return Resources(gpus, cpus, memory)
+
+
+def fits(needed: Resources, free: Resources) -> bool:
+    return all(n <= f for n, f in zip(needed, free))
+
+
+def pack(
+    requirements: List[Resources],
+    capacity: Resources,
+    max_instances: Optional[int] = None,
+) -> List[List[int]]:
+    """
+    Assign jobs, given by their resource requirements, to as few instances as
+    allow all of them to run at once, or to at most max_instances instances.
+    Returns the indices of the jobs queued on each instance.
+    """
+
+    for needed in requirements:
+        if not fits(needed, capacity):
+            raise ValueError(
+                f"A job needing {needed.gpus} GPUs, {needed.cpus} CPUs and "
+                f"{needed.memory} GiB does not fit on an instance with "
+                f"{capacity.gpus} GPUs, {capacity.cpus} CPUs and {capacity.memory} GiB"
+            )
+
+    groups: List[List[int]] = []
+    free: List[Resources] = []
+
+    # Largest jobs first, the sort is stable so equal jobs keep their order
+    order = sorted(
+        range(len(requirements)), key=lambda i: requirements[i], reverse=True
+    )
+    for i in order:
+        needed = requirements[i]
+        for g, group_free in enumerate(free):
+            if fits(needed, group_free):
+                groups[g].append(i)
+                free[g] = Resources(*(f - n for f, n in zip(group_free, needed)))
+                break
+        else:
+            groups.append([i])
+            free.append(Resources(*(c - n for c, n in zip(capacity, needed))))
+
+    if max_instances is None or len(groups) <= max_instances:
+        return [sorted(group) for group in groups]
+
+    queues: List[List[int]] = [[] for _ in range(max_instances)]
+    for i, group in enumerate(groups):
+        queues[i % max_instances].extend(sorted(group))
+    return queues
@@ -0,0 +1,76 @@
+"""
+Timing spans of the phases of launching an instance and running a job.
+
+Spans are Chrome trace "complete" events with microsecond epoch timestamps, so
+the spans recorded locally and the ones written by remote_setup.sh line up on
+one timeline. They are stored as JSON lines under
+<s3_results_path>/nimbo-timings/<instance_id>/ and can be opened in
+chrome://tracing or Perfetto once wrapped in {"traceEvents": [...]}.
+
+Spans are collected per thread, so that every instance of a sweep gets its own.
+"""
+
+import contextlib
+import json
+import threading
+import time
+from typing import Dict, Iterator, List
+
+# Chrome trace process ids, which the trace viewers show as separate tracks
+LOCAL_PID = 1
+REMOTE_PID = 2
+
+_local = threading.local()
+
+
+def _spans() -> List[Dict]:
+    if not hasattr(_local, "spans"):
+        _local.spans = []
+    return _local.spans
+
+
+@contextlib.contextmanager
+def span(name: str) -> Iterator[None]:
+    start = time.time()
+    try:
+        yield
+    finally:
+        _spans().append(
+            {
+                "name": name,
+                "cat": "local",
+                "ph": "X",
+                "ts": int(start * 1e6),
+                "dur": int((time.time() - start) * 1e6),
+                "pid": LOCAL_PID,
+                "tid": 1,
+            }
+        )
+
+
+def collect() -> List[Dict]:
+    """ Return and clear the spans recorded by the current thread """
+
+    spans = list(_spans())
+    _spans().clear()
+    return spans
+
+
+def dumps(spans: List[Dict]) -> str:
+    return "".join(json.dumps(s) + "\n" for s in spans)
+
+
+def loads(text: str) -> List[Dict]:
+    """ Parse JSON lines of spans, skipping lines cut off by an interrupted write """
+
+    spans = []
+    for line in text.splitlines():
+        try:
+            spans.append(json.loads(line))
+        except ValueError:
+            continue
+    return spans
+
+
+def chrome_trace(spans: List[Dict]) -> Dict:
+    return {"traceEvents": sorted(spans, key=lambda s: s["ts"])}
@@ -1,4 +1,6 @@
+import itertools
 import os
+from typing import List, Sequence
 
 import click
 
@@ -20,3 +22,30 @@ def generate_config(config_path: str) -> None:
         f.write(NIMBO_DEFAULT_CONFIG)
 
     print(f"Example config written to {config_path}")
+
+
+def expand_sweep(job_cmds: Sequence[str], params: Sequence[str]) -> List[str]:
+    """
+    Expand the {name} placeholders of every job command with each combination of
+    the values of the sweep parameters it uses, given as name=value1,value2
+    """
+
+    grid = []
+    for param in params:
+        name, sep, values = param.partition("=")
+        if not name or not sep or not values:
+            raise ValueError(
+                f"Sweep parameter '{param}' should be of the form name=value1,value2"
+            )
+        grid.append((name, values.split(",")))
+
+    expanded = []
+    for job_cmd in job_cmds:
+        used = [(name, values) for name, values in grid if f"{{{name}}}" in job_cmd]
+        for combination in itertools.product(*(values for _, values in used)):
+            expanded_cmd = job_cmd
+            for (name, _), value in zip(used, combination):
+                expanded_cmd = expanded_cmd.replace("{" + name + "}", value)
+            expanded.append(expanded_cmd)
+
+    return expanded
@@ -11,6 +11,7 @@ from nimbo.core.click_extensions import (
 )
 from nimbo.core import utils
 from nimbo.core.config import RequiredCase, make_config
+from nimbo.core.scheduler import Resources
 
 _CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"], max_content_width=90)
 _CONFIG_PATH_OVERRIDE = (
@@ -42,18 +43,89 @@ def cli(config):
 
 @cli.command(cls=NimboCommand, help_section=HelpSection.INSTANCE)
 @click.argument("job_cmd")
+@click.option(
+    "--watch-spot",
+    is_flag=True,
+    help="With run_in_background and spot_max_relaunches, block until the job ends"
+    " to relaunch it if the spot instance is interrupted.",
+)
 @click.option("--dry-run", is_flag=True)
 @assert_required_config(RequiredCase.JOB)
 @pprint_errors
 @cloud_context
-def run(cloud, job_cmd, dry_run):
+def run(cloud, job_cmd, watch_spot, dry_run):
     """Run JOB_CMD on an instance.
 
     JOB_CMD is any command you would run locally.
     E.g. \"python runner.py --epochs=10\".\n
     The command must be between quotes.
     """
-    cloud.run(job_cmd, dry_run)
+    cloud.run(job_cmd, dry_run, watch_spot)
+
+
+@cli.command(
+    cls=NimboCommand,
+    help_section=HelpSection.INSTANCE,
+    short_help="Run a sweep of jobs, each on its own instance.",
+)
+@click.argument("job_cmds", nargs=-1)
+@click.option(
+    "-p",
+    "--param",
+    "params",
+    multiple=True,
+    help="Sweep parameter name=value1,value2, replacing {name} in JOB_CMDS.",
+)
+@click.option(
+    "-f",
+    "--file",
+    "jobs_file",
+    type=click.File(),
+    help="File with one job command per line.",
+)
+@click.option(
+    "--gpus",
+    type=click.IntRange(min=0),
+    help="GPUs per job. Packs as many jobs on each instance as its GPUs, CPUs and"
+    " memory allow, each job pinned to its own GPUs.",
+)
+@click.option("--cpus", type=click.IntRange(min=0), help="CPUs per job.")
+@click.option("--memory", type=click.IntRange(min=0), help="Memory per job in GiB.")
+@click.option(
+    "--max-instances",
+    type=click.IntRange(min=1),
+    help="Queue jobs on at most this many instances, starting queued jobs as soon"
+    " as earlier ones free their resources.",
+)
+@click.option("--dry-run", is_flag=True)
+@assert_required_config(RequiredCase.JOB)
+@pprint_errors
+@cloud_context
+def sweep(
+    cloud, job_cmds, params, jobs_file, gpus, cpus, memory, max_instances, dry_run
+):
+    """Run JOB_CMDS on instances launched concurrently.
+
+    Each job gets its own instance, unless --gpus, --cpus or --memory are given
+    to pack several jobs onto each instance. Every combination of the --param
+    values is run for each command.
+    E.g. nimbo sweep \"python train.py --lr={lr} --bs={bs}\" -p lr=0.1,0.01
+    -p bs=32,64 runs four jobs.\n
+    The instances run the jobs in the background and are deleted once their
+    job finishes, unless persist is set in the config.
+    """
+    if jobs_file:
+        job_cmds += tuple(line.strip() for line in jobs_file if line.strip())
+
+    job_cmds = utils.expand_sweep(job_cmds, params)
+    if not job_cmds:
+        raise click.UsageError("Specify at least one job command to run.")
+
+    resources = None
+    if any(value is not None for value in (gpus, cpus, memory)):
+        resources = Resources(gpus or 0, cpus or 0, memory or 0)
+
+    cloud.run_sweep(job_cmds, resources, max_instances, dry_run)
 
 
 @cli.command(
@@ -108,6 +180,38 @@ def launch_and_setup(cloud, dry_run):
     cloud.run("_nimbo_launch_and_setup", dry_run)
 
 
+@cli.command(cls=NimboCommand, help_section=HelpSection.INSTANCE)
+@click.option("--dry-run", is_flag=True)
+@assert_required_config(RequiredCase.JOB)
+@pprint_errors
+@cloud_context
+def bake_image(cloud, dry_run):
+    """
+    Bake your environment and datasets into an image.
+
+    An instance is set up as for launch-and-setup and imaged. Later instances
+    using the same image and conda environment are launched from the baked
+    image, skipping the environment setup and most of the dataset staging.
+    """
+    cloud.bake_image(dry_run)
+
+
+@cli.command(cls=NimboCommand, help_section=HelpSection.INSTANCE)
+@click.option("--dry-run", is_flag=True)
+@assert_required_config(RequiredCase.JOB)
+@pprint_errors
+@cloud_context
+def snapshot_datasets(cloud, dry_run):
+    """
+    Copy your datasets onto an EBS snapshot.
+
+    With dataset_snapshots enabled, instances attach a volume restored from the
+    newest snapshot instead of downloading the datasets. Rerun this command to
+    add new dataset files to the snapshot.
+    """
+    cloud.snapshot_datasets(dry_run)
+
+
 @cli.command(cls=NimboCommand, help_section=HelpSection.INSTANCE)
 @click.argument("instance_id")
 @click.option("--dry-run", is_flag=True)
@@ -119,6 +223,24 @@ def ssh(cloud, instance_id, dry_run):
     cloud.ssh(instance_id, dry_run)
 
 
+@cli.command(cls=NimboCommand, help_section=HelpSection.INSTANCE)
+@click.argument("instance_id")
+@click.option(
+    "-f", "--follow", is_flag=True, help="Keep streaming new output of the job."
+)
+@click.option("--dry-run", is_flag=True)
+@assert_required_config(RequiredCase.INSTANCE, RequiredCase.STORAGE)
+@pprint_errors
+@cloud_context
+def logs(cloud, instance_id, follow, dry_run):
+    """Print the log of a job run in the background by INSTANCE_ID.
+
+    The log is streamed over ssh while the instance runs, and read from S3
+    once the instance is gone.
+    """
+    cloud.logs(instance_id, follow, dry_run)
+
+
 @cli.command(cls=NimboCommand, help_section=HelpSection.INSTANCE)
 @click.argument("instance_id")
 @click.option("--dry-run", is_flag=True)
@@ -162,17 +284,20 @@ def rm_instance(cloud, instance_id, dry_run):
 
 
 @cli.command(cls=NimboCommand, help_section=HelpSection.INSTANCE)
+@click.option(
+    "--all-regions", is_flag=True, help="Terminate instances in every region."
+)
 @click.option("--dry-run", is_flag=True)
 @assert_required_config(RequiredCase.MINIMAL)
 @pprint_errors
 @cloud_context
-def rm_all_instances(cloud, dry_run):
+def rm_all_instances(cloud, all_regions, dry_run):
     """Terminate all your instances."""
     click.confirm(
         "This will delete all your running instances.\n" "Do you want to continue?",
         abort=True,
     )
-    cloud.delete_all_instances(dry_run)
+    cloud.delete_all_instances(dry_run, all_regions)
 
 
 @cli.command(cls=NimboCommand, help_section=HelpSection.INSTANCE)
@@ -365,6 +490,18 @@ def ls_spot_prices(cloud, dry_run):
     cloud.ls_spot_gpu_prices(dry_run)
 
 
+@cli.command(cls=NimboCommand, help_section=HelpSection.UTILS)
+@click.argument("instance_id")
+@click.option("-o", "--output", help="Write a Chrome trace of the phases to a file.")
+@click.option("--dry-run", is_flag=True)
+@assert_required_config(RequiredCase.MINIMAL, RequiredCase.STORAGE)
+@pprint_errors
+@cloud_context
+def timings(cloud, instance_id, output, dry_run):
+    """Show how long each phase of launching INSTANCE_ID and its job took."""
+    cloud.timings(instance_id, output, dry_run)
+
+
 @cli.command(cls=NimboCommand, help_section=HelpSection.UTILS)
 @click.argument("qty", type=int, required=True)
 @click.argument("timescale", type=click.Choice(["days", "months"]), required=True)
@@ -0,0 +1,105 @@
+"""
+Job scheduler run on the instance by remote_setup.sh for packed sweeps.
+
+Runs a queue of jobs that share the instance, each pinned to its own GPUs with
+CUDA_VISIBLE_DEVICES. Whenever a job finishes, the queued jobs that fit in the
+freed GPUs, CPUs and memory are started, so that short jobs backfill around
+long ones. The output of every job is written to LOGS_DIR/job-<index>.txt.
+
+JOBS_JSON holds the resources of the instance under "capacity" and the queue
+under "jobs", both as {"gpus", "cpus", "memory"} objects, with every job also
+having an "index" and a "cmd".
+
+Usage:
+    python nimbo_schedule.py JOBS_JSON LOGS_DIR
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+POLL_INTERVAL = 1.0
+
+
+def fits(job, free):
+    return all(job[key] <= free[key] for key in ("gpus", "cpus", "memory"))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("jobs_json")
+    parser.add_argument("logs_dir")
+    args = parser.parse_args()
+
+    with open(args.jobs_json) as f:
+        schedule = json.load(f)
+
+    os.makedirs(args.logs_dir, exist_ok=True)
+    queue = schedule["jobs"]
+    free = dict(schedule["capacity"])
+    free_gpus = list(range(free["gpus"]))
+    running = {}
+    failed = []
+
+    while queue or running:
+        # Start every queued job that fits, in order, skipping the ones that don't
+        for job in list(queue):
+            free["gpus"] = len(free_gpus)
+            if not fits(job, free):
+                continue
+
+            gpus, free_gpus = free_gpus[: job["gpus"]], free_gpus[job["gpus"] :]
+            free["cpus"] -= job["cpus"]
+            free["memory"] -= job["memory"]
+
+            env = dict(os.environ, CUDA_VISIBLE_DEVICES=",".join(map(str, gpus)))
+            log_path = os.path.join(args.logs_dir, f"job-{job['index']}.txt")
+            with open(log_path, "w") as log:
+                process = subprocess.Popen(
+                    job["cmd"],
+                    shell=True,
+                    executable="/bin/bash",
+                    env=env,
+                    stdout=log,
+                    stderr=subprocess.STDOUT,
+                )
+
+            running[process] = (job, gpus)
+            queue.remove(job)
+            print(
+                f"Started job {job['index']} on GPUs {gpus}: {job['cmd']}", flush=True
+            )
+
+        if not running:
+            # Nothing fits even on an idle instance, which pack() rules out
+            failed.extend(job["index"] for job in queue)
+            break
+
+        finished = [process for process in running if process.poll() is not None]
+        if not finished:
+            time.sleep(POLL_INTERVAL)
+
+        for process in finished:
+            job, gpus = running.pop(process)
+            free_gpus = sorted(free_gpus + gpus)
+            free["cpus"] += job["cpus"]
+            free["memory"] += job["memory"]
+
+            if process.returncode:
+                failed.append(job["index"])
+            print(
+                f"Job {job['index']} finished with exit code {process.returncode}.",
+                flush=True,
+            )
+
+    if failed:
+        print(f"Failed jobs: {', '.join(map(str, sorted(failed)))}", flush=True)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,104 @@
+"""
+Spot interruption watcher run on spot instances by remote_setup.sh.
+
+Polls the instance metadata for the two minute spot interruption notice. Once
+the notice is given, the --hook command is run from the project folder so that
+the job can save a checkpoint, and the results uploader is signalled to upload
+everything right away. The metadata service can be replaced by a local stand-in
+with --metadata-url for testing.
+
+Usage:
+    python nimbo_spot_watch.py [--metadata-url URL] [--interval SECONDS]
+                               [--hook CMD] [--uploader-pid PID]
+"""
+
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+METADATA_URL = "http://169.254.169.254"
+TOKEN_TTL = 6 * 3600
+# Leaves the uploader about half a minute of the two minute notice
+HOOK_TIMEOUT = 90
+
+
+def metadata_token(base_url):
+    """ An IMDSv2 session token, None where only IMDSv1 is available """
+
+    request = urllib.request.Request(
+        f"{base_url}/latest/api/token",
+        method="PUT",
+        headers={"X-aws-ec2-metadata-token-ttl-seconds": str(TOKEN_TTL)},
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=2) as response:
+            return response.read().decode("utf-8")
+    except OSError:
+        return None
+
+
+def interruption_notice(base_url, token):
+    """ The scheduled spot instance action, or None if there is none """
+
+    headers = {"X-aws-ec2-metadata-token": token} if token else {}
+    request = urllib.request.Request(
+        f"{base_url}/latest/meta-data/spot/instance-action", headers=headers
+    )
+    with urllib.request.urlopen(request, timeout=2) as response:
+        return json.loads(response.read().decode("utf-8"))
+
+
+def wait_for_interruption(base_url, interval):
+    token, token_time = None, None
+
+    while True:
+        if token_time is None or time.monotonic() - token_time > TOKEN_TTL / 2:
+            token, token_time = metadata_token(base_url), time.monotonic()
+
+        try:
+            return interruption_notice(base_url, token)
+        except urllib.error.HTTPError as e:
+            # 404 means no interruption is scheduled, 401 an expired token
+            if e.code == 401:
+                token_time = None
+        except (OSError, ValueError) as e:
+            print(f"Could not read the instance metadata: {e}", flush=True)
+
+        time.sleep(interval)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--metadata-url", default=METADATA_URL)
+    parser.add_argument("--interval", type=float, default=5.0)
+    parser.add_argument("--hook", default=None)
+    parser.add_argument("--uploader-pid", type=int, default=None)
+    args = parser.parse_args()
+
+    notice = wait_for_interruption(args.metadata_url, args.interval)
+    print(f"Spot interruption notice received: {notice}", flush=True)
+
+    if args.hook:
+        print(f"Running interruption hook: {args.hook}", flush=True)
+        try:
+            subprocess.run(
+                args.hook, shell=True, executable="/bin/bash", timeout=HOOK_TIMEOUT
+            )
+        except subprocess.TimeoutExpired:
+            print("The interruption hook timed out.", flush=True)
+
+    if args.uploader_pid:
+        try:
+            os.kill(args.uploader_pid, signal.SIGUSR1)
+        except ProcessLookupError:
+            print("The results uploader is not running.", flush=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
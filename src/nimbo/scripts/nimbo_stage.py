@@ -0,0 +1,193 @@
+"""
+Staging agent run on the instance by remote_setup.sh.
+
+Downloads one or more S3 prefixes into local folders with a pool of worker
+threads. Files already present with the same size and modification time are
+skipped, partial downloads are resumed with ranged GETs and single part
+objects not encrypted with SSE-KMS or SSE-C are verified against their ETag.
+Files matching the --require patterns are fetched first, and --ready-file is
+created as soon as all of them are present so that the job can start while
+the rest keeps downloading.
+
+Usage:
+    python nimbo_stage.py [--workers N] [--require PATTERNS] [--ready-file PATH]
+                          S3_PATH LOCAL_PATH [S3_PATH LOCAL_PATH ...]
+"""
+
+import argparse
+import fnmatch
+import hashlib
+import os
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+import botocore.config
+
+PARTS_DIR = "/home/ubuntu/.nimbo-stage"
+CHUNK_SIZE = 1 << 20
+# Multipart ETags end in -<parts> and are never the MD5 of the content
+MD5_ETAG = re.compile(r"[0-9a-f]{32}")
+
+
+def split_s3_path(path):
+    bucket, _, prefix = path[len("s3://") :].partition("/")
+    prefix = prefix.strip("/")
+    return bucket, prefix + "/" if prefix else ""
+
+
+def list_objects(client, s3_path, local_path):
+    bucket, prefix = split_s3_path(s3_path)
+    paginator = client.get_paginator("list_objects_v2")
+
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            rel_key = obj["Key"][len(prefix) :]
+            if rel_key and not rel_key.endswith("/"):
+                yield {
+                    "bucket": bucket,
+                    "key": obj["Key"],
+                    "size": obj["Size"],
+                    "etag": obj["ETag"].strip('"'),
+                    "mtime": obj["LastModified"].timestamp(),
+                    "path": os.path.join(local_path, *rel_key.split("/")),
+                }
+
+
+def is_staged(obj):
+    try:
+        stat = os.stat(obj["path"])
+    except OSError:
+        return False
+    return stat.st_size == obj["size"] and int(stat.st_mtime) == int(obj["mtime"])
+
+
+def etag_is_md5(response):
+    # The ETag of an object encrypted with SSE-KMS or SSE-C is no MD5 either
+    return (
+        response.get("ServerSideEncryption") != "aws:kms"
+        and "SSECustomerAlgorithm" not in response
+    )
+
+
+def download(client, obj):
+    if is_staged(obj):
+        return
+
+    # Parts are named after the ETag as well, so that the bytes of an object
+    # that has changed since are never stitched to the new object
+    path_hash = hashlib.sha1(obj["path"].encode("utf-8")).hexdigest()
+    part_path = os.path.join(PARTS_DIR, f"{path_hash}.{obj['etag']}")
+    for name in os.listdir(PARTS_DIR):
+        if name.startswith(path_hash + ".") and name != os.path.basename(part_path):
+            os.remove(os.path.join(PARTS_DIR, name))
+
+    # Whether the ETag is an MD5 of the content is only known from the response
+    # of the GetObject call, so a part that needs none is only checked for size
+    md5 = hashlib.md5() if MD5_ETAG.fullmatch(obj["etag"]) else None
+    verify_md5 = False
+
+    # Creating the part file up front means empty objects need no request at all
+    open(part_path, "ab").close()
+    offset = os.path.getsize(part_path)
+    if offset > obj["size"]:
+        open(part_path, "wb").close()
+        offset = 0
+    elif offset and md5:
+        with open(part_path, "rb") as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                md5.update(chunk)
+
+    if offset < obj["size"]:
+        # IfMatch makes S3 refuse the rest if the object changes after listing
+        response = client.get_object(
+            Bucket=obj["bucket"],
+            Key=obj["key"],
+            Range=f"bytes={offset}-",
+            IfMatch=obj["etag"],
+        )
+        verify_md5 = md5 is not None and etag_is_md5(response)
+        with open(part_path, "ab") as f:
+            for chunk in response["Body"].iter_chunks(CHUNK_SIZE):
+                f.write(chunk)
+                if md5:
+                    md5.update(chunk)
+
+    s3_path = f"s3://{obj['bucket']}/{obj['key']}"
+    if os.path.getsize(part_path) != obj["size"]:
+        raise IOError(f"Size mismatch while downloading {s3_path}")
+    if verify_md5 and md5.hexdigest() != obj["etag"]:
+        os.remove(part_path)
+        raise IOError(f"ETag mismatch while downloading {s3_path}")
+
+    os.makedirs(os.path.dirname(obj["path"]), exist_ok=True)
+    os.replace(part_path, obj["path"])
+    os.utime(obj["path"], (obj["mtime"], obj["mtime"]))
+
+
+def stage(client, required, objects, workers, ready_file):
+    """ Download required objects first, creating ready_file once they are done """
+
+    def mark_ready():
+        if ready_file:
+            open(ready_file, "w").close()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # The executor runs tasks in submission order, so required files go first
+        required_futures = [executor.submit(download, client, o) for o in required]
+        other_futures = [executor.submit(download, client, o) for o in objects]
+
+        try:
+            for future in required_futures:
+                future.result()
+            if required:
+                print("Required files staged, the job can start.", flush=True)
+                mark_ready()
+
+            for future in other_futures:
+                future.result()
+        except BaseException:
+            for future in required_futures + other_futures:
+                future.cancel()
+            raise
+
+    mark_ready()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=32)
+    parser.add_argument("--require", default="", help="comma separated patterns")
+    parser.add_argument("--ready-file", default=None)
+    parser.add_argument("--region", default=None)
+    parser.add_argument("paths", nargs="+")
+    args = parser.parse_args()
+
+    if len(args.paths) % 2:
+        parser.error("paths must be given as S3_PATH LOCAL_PATH pairs")
+
+    os.makedirs(PARTS_DIR, exist_ok=True)
+    client = boto3.client(
+        "s3",
+        region_name=args.region,
+        config=botocore.config.Config(max_pool_connections=args.workers),
+    )
+
+    patterns = [p.strip() for p in args.require.split(",") if p.strip()]
+    required, objects = [], []
+    for s3_path, local_path in zip(args.paths[::2], args.paths[1::2]):
+        print(f"Staging {s3_path} to {local_path}...", flush=True)
+        for obj in list_objects(client, s3_path, local_path):
+            rel_path = os.path.relpath(obj["path"])
+            if any(fnmatch.fnmatch(rel_path, pattern) for pattern in patterns):
+                required.append(obj)
+            else:
+                objects.append(obj)
+
+    stage(client, required, objects, args.workers, args.ready_file)
+    print(f"Staged {len(required) + len(objects)} files.", flush=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,254 @@
+"""
+Results uploader run on the instance by remote_setup.sh.
+
+Watches the results folder with inotify (falling back to polling where inotify
+is unavailable) and uploads files once they are closed after writing, so S3 is
+never listed and unchanged files are never re-sent. Events are collected over
+a short window and uploaded concurrently. The nimbo log is shipped as
+appended chunks stored under <S3_LOG_PATH>.parts/<byte offset>, so only new
+output is uploaded on every tick. remote_setup.sh deletes the chunks once the
+complete log is uploaded. SIGUSR1 uploads everything right away, which
+the spot interruption watcher uses, and SIGTERM flushes everything and exits.
+
+Only files modified after the uploader started are uploaded, which skips the
+files that were just staged from S3 into the results folder.
+
+Usage:
+    python nimbo_upload.py [--sse SSE] [--region REGION]
+                           LOCAL_LOG S3_LOG_PATH LOCAL_RESULTS S3_RESULTS
+"""
+
+import argparse
+import ctypes
+import ctypes.util
+import os
+import select
+import signal
+import struct
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+import botocore.config
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+EVENT_HEADER = struct.Struct("iIII")
+BATCH_WINDOW = 2.0
+LOG_INTERVAL = 5.0
+WORKERS = 16
+
+
+def split_s3_path(path):
+    bucket, _, prefix = path[len("s3://") :].partition("/")
+    return bucket, prefix.strip("/")
+
+
+class Inotify:
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._libc = libc
+        self.fd = libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+        self._dirs = {}
+
+    def add_tree(self, root):
+        """ Watch root and all of its subdirectories, returning the files in them """
+
+        files = []
+        for dir_path, _, file_names in os.walk(root):
+            wd = self._libc.inotify_add_watch(
+                self.fd, os.fsencode(dir_path), WATCH_MASK
+            )
+            if wd >= 0:
+                self._dirs[wd] = dir_path
+            files.extend(os.path.join(dir_path, name) for name in file_names)
+        return files
+
+    def read(self, timeout):
+        """ Return (paths of written files, whether the event queue overflowed) """
+
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return [], False
+
+        data = os.read(self.fd, 64 * 1024)
+        paths, overflow, offset = [], False, 0
+
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            # Names are bytes, which may not be valid UTF-8
+            name = os.fsdecode(data[offset : offset + length].rstrip(b"\0"))
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                overflow = True
+            elif wd in self._dirs:
+                path = os.path.join(self._dirs[wd], name)
+                if mask & IN_ISDIR:
+                    # Files may be written before the new directory is watched
+                    paths.extend(self.add_tree(path))
+                elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                    paths.append(path)
+
+        return paths, overflow
+
+
+class Uploader:
+    def __init__(self, client, args):
+        self.client = client
+        self.extra_args = {"ServerSideEncryption": args.sse} if args.sse else {}
+        self.log_path = args.local_log
+        self.log_bucket, self.log_key = split_s3_path(args.s3_log)
+        self.log_offset = 0
+        self.results_path = args.local_results
+        self.results_bucket, self.results_prefix = split_s3_path(args.s3_results)
+        self.start_time = time.time()
+        self.uploaded = {}
+        self.executor = ThreadPoolExecutor(max_workers=WORKERS)
+
+    def scan(self):
+        files = []
+        for dir_path, _, file_names in os.walk(self.results_path):
+            files.extend(os.path.join(dir_path, name) for name in file_names)
+        return files
+
+    def upload_results(self, paths):
+        futures = {}
+
+        for path in sorted(set(paths)):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+
+            signature = (stat.st_size, stat.st_mtime)
+            if stat.st_mtime < self.start_time or self.uploaded.get(path) == signature:
+                continue
+
+            rel_path = os.path.relpath(path, self.results_path).replace(os.sep, "/")
+            key = f"{self.results_prefix}/{rel_path}".lstrip("/")
+            future = self.executor.submit(
+                self.client.upload_file,
+                path,
+                self.results_bucket,
+                key,
+                ExtraArgs=self.extra_args,
+            )
+            futures[future] = (path, signature)
+
+        for future, (path, signature) in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Upload failed: {e}", flush=True)
+            else:
+                # Failed files are uploaded again by the next batch or scan
+                self.uploaded[path] = signature
+
+    def upload_log(self):
+        try:
+            with open(self.log_path, "rb") as f:
+                f.seek(self.log_offset)
+                chunk = f.read()
+        except OSError:
+            return
+
+        if not chunk:
+            return
+
+        try:
+            self.client.put_object(
+                Bucket=self.log_bucket,
+                Key=f"{self.log_key}.parts/{self.log_offset:012d}",
+                Body=chunk,
+                **self.extra_args,
+            )
+        except Exception as e:
+            # The same chunk, and whatever was appended since, is sent next time
+            print(f"Log upload failed: {e}", flush=True)
+            return
+        self.log_offset += len(chunk)
+
+
+def install_signal_handlers(stopping, flushing):
+    """ SIGTERM stops the uploader and SIGUSR1 flushes, both after the next tick """
+
+    signal.signal(signal.SIGTERM, lambda *_: stopping.append(True))
+    signal.signal(signal.SIGUSR1, lambda *_: flushing.append(True))
+
+
+def watch(uploader, inotify, stopping, flushing):
+    """ Upload results in batches and the log every LOG_INTERVAL until stopping """
+
+    pending, batch_start, last_log = [], None, 0.0
+
+    while not stopping:
+        if inotify:
+            paths, overflow = inotify.read(timeout=0.5)
+            pending.extend(uploader.scan() if overflow else paths)
+        else:
+            time.sleep(BATCH_WINDOW)
+            pending.extend(uploader.scan())
+
+        if flushing:
+            print("Flushing results and logs now.", flush=True)
+            uploader.upload_results(pending + uploader.scan())
+            pending, batch_start, last_log = [], None, 0.0
+            flushing.clear()
+
+        if pending and batch_start is None:
+            batch_start = time.monotonic()
+        if pending and time.monotonic() - batch_start >= BATCH_WINDOW:
+            uploader.upload_results(pending)
+            pending, batch_start = [], None
+
+        if time.monotonic() - last_log >= LOG_INTERVAL:
+            uploader.upload_log()
+            last_log = time.monotonic()
+
+    # Flush everything that is left, including files whose events were missed
+    uploader.upload_results(pending + uploader.scan())
+    uploader.upload_log()
+    uploader.executor.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sse", default=None)
+    parser.add_argument("--region", default=None)
+    parser.add_argument("local_log")
+    parser.add_argument("s3_log")
+    parser.add_argument("local_results")
+    parser.add_argument("s3_results")
+    args = parser.parse_args()
+
+    client = boto3.client(
+        "s3",
+        region_name=args.region,
+        config=botocore.config.Config(max_pool_connections=WORKERS),
+    )
+    uploader = Uploader(client, args)
+
+    stopping, flushing = [], []
+    install_signal_handlers(stopping, flushing)
+
+    try:
+        inotify = Inotify()
+        inotify.add_tree(args.local_results)
+    except (OSError, AttributeError):
+        print("inotify unavailable, polling the results folder.", flush=True)
+        inotify = None
+
+    watch(uploader, inotify, stopping, flushing)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,16 +4,97 @@ trap 'echo "Job failed."; do_cleanup; exit 1' ERR
 trap 'echo "Received signal to stop."; do_cleanup; exit 1' SIGINT
 
 do_cleanup () { 
+    if [ -n "$ENV_PACK_PID" ]; then
+        echo "Waiting for the conda environment upload to finish..."
+        wait $ENV_PACK_PID
+    fi
+
+    if [ -n "$UPLOADER_PID" ] && kill -0 $UPLOADER_PID 2>/dev/null; then
+        echo "Flushing pending result uploads..."
+        kill -TERM $UPLOADER_PID && wait $UPLOADER_PID
+    fi
+
     echo "Backing up nimbo logs..."
-    $AWS s3 cp --quiet $LOCAL_LOG $S3_LOG_PATH
+    # The chunks streamed while the job ran are only needed until the full log
+    # is uploaded, and would otherwise be staged into every later instance
+    $AWS s3 cp --quiet $LOCAL_LOG $S3_LOG_PATH \
+        && $AWS s3 rm --quiet --recursive $S3_LOG_PATH.parts/
+    upload_timings
 
     PERSIST="$(grep 'persist:' $CONFIG | awk '{print $2}')"
     if [ "$PERSIST" = "no" ]; then
-        echo "Deleting instance $INSTANCE_ID."
+        # Warm pool instances stop on shutdown instead of terminating
+        if [ -n "$WARM_POOL" ]; then
+            echo "Stopping instance $INSTANCE_ID and returning it to the warm pool."
+        else
+            echo "Deleting instance $INSTANCE_ID."
+        fi
         sudo shutdown now >/tmp/nimbo-system-logs
     fi
 }
 
+env_pack_available () {
+    # Sweep jobs wait up to ENV_CACHE_WAIT seconds for the first job of the sweep
+    # to publish the packed environment, rather than all building the same one
+    local waited=0
+    until $AWS s3 ls $ENV_PACK >/dev/null 2>&1; do
+        if [ "$waited" -ge "${ENV_CACHE_WAIT:-0}" ]; then
+            return 1
+        fi
+        if [ "$waited" -eq 0 ]; then
+            echo "Waiting for the conda environment to be built by another job..."
+        fi
+        sleep 10
+        waited=$((waited + 10))
+    done
+}
+
+now_us () {
+    date +%s%6N
+}
+
+record_span () {
+    # Appends the phase $1 started at $2 (see now_us) as a Chrome trace event,
+    # in the format of the spans recorded locally by nimbo.core.timing
+    local end=$(now_us)
+    printf '{"name": "%s", "cat": "remote", "ph": "X", "ts": %s, "dur": %s, %s}\n' \
+        "$1" "$2" "$((end - $2))" '"pid": 2, "tid": 1' >> $TIMINGS
+}
+
+upload_timings () {
+    $S3CP --quiet $TIMINGS $S3_RESULTS_PATH/nimbo-timings/$INSTANCE_ID/remote.jsonl \
+        || echo "Could not upload the setup timings."
+}
+
+mount_instance_store () {
+    # Stripes the local NVMe instance store volumes into one RAID 0 array. Their
+    # contents do not survive a stop, so this runs again on warm pool instances.
+    if mountpoint -q $SCRATCH_DIR; then
+        return 0
+    fi
+
+    local devices=$(lsblk -dpno NAME,MODEL \
+        | grep "Amazon EC2 NVMe Instance Storage" | awk '{print $1}')
+    local count=$(echo $devices | wc -w)
+    if [ "$count" -eq 0 ]; then
+        echo "This instance type has no NVMe instance store, using the root volume."
+        return 1
+    fi
+
+    echo "Striping $count NVMe instance store volumes at $SCRATCH_DIR..."
+    local device=$devices
+    if [ "$count" -gt 1 ]; then
+        device=/dev/md0
+        if [ ! -e $device ]; then
+            sudo mdadm --create $device --run --level=0 --raid-devices=$count $devices
+        fi
+    fi
+    sudo mkfs.ext4 -q -F -E nodiscard $device
+    sudo mkdir -p $SCRATCH_DIR
+    sudo mount -o noatime $device $SCRATCH_DIR
+    sudo chown ubuntu:ubuntu $SCRATCH_DIR
+}
+
 PYTHONUNBUFFERED=1
 
 INSTANCE_ID=$1
@@ -23,6 +104,9 @@ AWS=/usr/local/bin/aws
 PROJ_DIR=/home/ubuntu/project
 CONDA_PATH=/home/ubuntu/miniconda3
 CONDASH=$CONDA_PATH/etc/profile.d/conda.sh
+SCRATCH_DIR=/mnt/nimbo-scratch
+TIMINGS=/home/ubuntu/nimbo-timings.jsonl
+rm -f $TIMINGS
 
 cd $PROJ_DIR
 
@@ -40,17 +124,53 @@ fi
 ENV_FILE=local_env.yml
 ENV_NAME="$(grep 'name:' $ENV_FILE | awk '{print $2}')"
 
-S3_LOG_NAME=$(date +%Y-%m-%d_%H-%M-%S).txt
+# The instance id lets 'nimbo logs' find the log once the instance is gone
+S3_LOG_NAME=$(date +%Y-%m-%d_%H-%M-%S)_$INSTANCE_ID.txt
 S3_LOG_PATH=$S3_RESULTS_PATH/nimbo-logs/$S3_LOG_NAME
 LOCAL_LOG=/home/ubuntu/nimbo-log.txt
 echo "Will save logs to $S3_LOG_PATH"
 
 mkdir -p $LOCAL_DATASETS_PATH
 mkdir -p $LOCAL_RESULTS_PATH
+
+SPAN_START=$(now_us)
+if [ -n "$DATASETS_VOLUME" ]; then
+    # Nitro instances name the NVMe device of an EBS volume after the volume id
+    DATASETS_DEVICE=/dev/disk/by-id/nvme-Amazon_Elastic_Block_Store_${DATASETS_VOLUME/-/}
+    for i in $(seq 60); do
+        [ -e $DATASETS_DEVICE ] || [ -e /dev/xvdf ] && break
+        sleep 1
+    done
+    [ -e $DATASETS_DEVICE ] || DATASETS_DEVICE=/dev/xvdf
+
+    if ! sudo blkid $DATASETS_DEVICE >/dev/null; then
+        echo "Formatting the datasets volume..."
+        sudo mkfs.ext4 -q -L nimbo-datasets $DATASETS_DEVICE
+    fi
+    if ! mountpoint -q $LOCAL_DATASETS_PATH; then
+        echo "Mounting the datasets volume at $LOCAL_DATASETS_PATH..."
+        sudo mount $DATASETS_DEVICE $LOCAL_DATASETS_PATH
+        sudo chown ubuntu:ubuntu $LOCAL_DATASETS_PATH
+    fi
+    # The volume can be larger than the snapshot it was restored from
+    sudo resize2fs $DATASETS_DEVICE >/dev/null 2>&1 || true
+elif [ -n "$INSTANCE_STORE_DATASETS" ] && mount_instance_store; then
+    if ! mountpoint -q $LOCAL_DATASETS_PATH; then
+        mkdir -p $SCRATCH_DIR/datasets
+        sudo mount --bind $SCRATCH_DIR/datasets $LOCAL_DATASETS_PATH
+    fi
+fi
+
+if [ -n "$INSTANCE_STORE_CONDA_PKGS" ] && mount_instance_store; then
+    mkdir -p $SCRATCH_DIR/conda-pkgs
+    export CONDA_PKGS_DIRS=$SCRATCH_DIR/conda-pkgs
+fi
+record_span "volume mounts" $SPAN_START
 mkdir -p $CONDA_PATH
 
 
 # ERROR: This currently doesn't allow for a new unseen env to be passed. Fix this.
+SPAN_START=$(now_us)
 if [ -f "$CONDASH" ]; then
     echo ""
     echo "Conda installation found."
@@ -64,30 +184,133 @@ fi
 
 source $CONDASH
 
-echo "Creating conda environment: $ENV_NAME"
-conda env create -q --file $ENV_FILE
-conda activate $ENV_NAME
+# The staging agent needs boto3 in the base environment, which the nimbo
+# images ship with. Older images get it installed here.
+AGENT_PYTHON=$CONDA_PATH/bin/python
+if ! $AGENT_PYTHON -c "import boto3" >/dev/null 2>&1; then
+    $AGENT_PYTHON -m pip install -q boto3
+fi
+record_span "conda install" $SPAN_START
 
-echo "Done."
+if [ "$JOB_CMD" = "_nimbo_snapshot_datasets" ]; then
+    # Only the datasets go on the volume, the environment and results are not
+    # needed to snapshot it
+    echo ""
+    echo "Importing datasets from $S3_DATASETS_PATH to $LOCAL_DATASETS_PATH..."
+    SPAN_START=$(now_us)
+    $AGENT_PYTHON /home/ubuntu/nimbo_stage.py --workers $STAGE_WORKERS \
+        --region $REGION_NAME $S3_DATASETS_PATH $LOCAL_DATASETS_PATH \
+        >/tmp/nimbo-stage-logs 2>&1
+    record_span "dataset import" $SPAN_START
+
+    # Everything is written to the volume before it is snapshotted
+    sync
+    sudo umount $LOCAL_DATASETS_PATH
+    echo "Datasets staged, the volume is ready to be snapshotted."
+    upload_timings
+    exit 0
+fi
 
-# Import datasets and results from the bucket
+# Import datasets and results from the bucket while the environment is set up
 echo ""
 echo "Importing datasets from $S3_DATASETS_PATH to $LOCAL_DATASETS_PATH..."
-$S3CP --recursive $S3_DATASETS_PATH $LOCAL_DATASETS_PATH >/tmp/nimbo-s3-logs
 echo "Importing results from $S3_RESULTS_PATH to $LOCAL_RESULTS_PATH..."
-$S3CP --recursive $S3_RESULTS_PATH $LOCAL_RESULTS_PATH >/tmp/nimbo-s3-logs
+STAGE_READY=/tmp/nimbo-stage-ready
+rm -f $STAGE_READY
+STAGE_START=$(now_us)
+$AGENT_PYTHON /home/ubuntu/nimbo_stage.py --workers $STAGE_WORKERS \
+    --region $REGION_NAME --require "$STAGE_REQUIRED" --ready-file $STAGE_READY \
+    $S3_DATASETS_PATH $LOCAL_DATASETS_PATH $S3_RESULTS_PATH $LOCAL_RESULTS_PATH \
+    >/tmp/nimbo-stage-logs 2>&1 &
+STAGE_PID=$!
+
+ENV_DIR=$CONDA_PATH/envs/$ENV_NAME
+ENV_PACK=$CONDA_ENV_CACHE/$ENV_HASH.tar.gz
+ENV_HASH_FILE=$ENV_DIR/.nimbo-env-hash
+
+# Environments packed with conda-pack are cached in S3 under the hash of the
+# env file, so unchanged environments skip dependency resolution entirely.
+# Instances resumed from the warm pool already have the environment installed.
+SPAN_START=$(now_us)
+if [ -n "$ENV_HASH" ] && [ "$(cat $ENV_HASH_FILE 2>/dev/null)" = "$ENV_HASH" ]; then
+    echo "Reusing conda environment: $ENV_NAME"
+elif [ -n "$CONDA_ENV_CACHE" ] && env_pack_available; then
+    echo "Unpacking cached conda environment: $ENV_NAME"
+    rm -rf $ENV_DIR
+    mkdir -p $ENV_DIR
+    # Stream the download straight into tar so unpacking overlaps the transfer
+    $AWS s3 cp --quiet $ENV_PACK - | tar -xzf - -C $ENV_DIR
+    source $ENV_DIR/bin/activate && conda-unpack && source $ENV_DIR/bin/deactivate
+else
+    echo "Creating conda environment: $ENV_NAME"
+    rm -rf $ENV_DIR
+    conda env create -q --file $ENV_FILE
+
+    if [ -n "$CONDA_ENV_CACHE" ]; then
+        echo "Caching conda environment in $ENV_PACK in the background..."
+        # Installed with pip like the agents' boto3, as a conda install would
+        # solve the base environment again under the running staging agent
+        nohup bash -c "{ [ -x $CONDA_PATH/bin/conda-pack ] ||
+        $AGENT_PYTHON -m pip install -q conda-pack; } &&
+        $CONDA_PATH/bin/conda-pack -q -n $ENV_NAME -o /tmp/nimbo-env.tar.gz &&
+        $S3CP --quiet /tmp/nimbo-env.tar.gz $ENV_PACK;
+        rm -f /tmp/nimbo-env.tar.gz" >/tmp/nimbo-env-cache-logs 2>&1 &
+        ENV_PACK_PID=$!
+    fi
+fi
+if [ -n "$ENV_HASH" ]; then
+    echo $ENV_HASH > $ENV_HASH_FILE
+fi
+conda activate $ENV_NAME
+record_span "conda env" $SPAN_START
+
+echo "Done."
+
+echo ""
+echo "Waiting for datasets and results to be staged..."
+while [ ! -f $STAGE_READY ] && kill -0 $STAGE_PID 2>/dev/null; do
+    sleep 0.5
+done
+if [ ! -f $STAGE_READY ]; then
+    # The agent exited without staging everything, surface its exit code
+    wait $STAGE_PID
+fi
+record_span "dataset import" $STAGE_START
+echo "Done."
+
+if [ "$JOB_CMD" = "_nimbo_bake" ]; then
+    # Nothing is left running in the background while the image is taken
+    if [ -n "$ENV_PACK_PID" ]; then
+        echo "Waiting for the conda environment upload to finish..."
+        wait $ENV_PACK_PID
+    fi
+    echo "Setup complete, the instance is ready to be imaged."
+    upload_timings
+    exit 0
+fi
 
 echo ""
 echo "================================================="
 echo ""
 
-nohup bash -c "while true;  
-do $S3CP --quiet $LOCAL_LOG $S3_LOG_PATH >>/tmp/nimbo-s3-logs 2>&1;
-$S3SYNC --quiet $LOCAL_RESULTS_PATH $S3_RESULTS_PATH >>/tmp/nimbo-s3-logs 2>&1;
-sleep 10; done" >/dev/null 2>&1 &
+# Upload new results as they are written and stream the log in chunks
+nohup $AGENT_PYTHON /home/ubuntu/nimbo_upload.py ${ENCRYPTION:+--sse $ENCRYPTION} \
+    --region $REGION_NAME $LOCAL_LOG $S3_LOG_PATH \
+    $LOCAL_RESULTS_PATH $S3_RESULTS_PATH >>/tmp/nimbo-s3-logs 2>&1 &
+UPLOADER_PID=$!
+
+if [ -n "$SPOT" ]; then
+    # Checkpoint and upload results as soon as the instance is to be reclaimed
+    nohup $AGENT_PYTHON /home/ubuntu/nimbo_spot_watch.py --uploader-pid $UPLOADER_PID \
+        ${SPOT_INTERRUPTION_HOOK:+--hook "$SPOT_INTERRUPTION_HOOK"} \
+        >>/tmp/nimbo-spot-logs 2>&1 &
+fi
+export NIMBO_RESTART_COUNT=${RESTART_COUNT:-0}
 
+SPAN_START=$(now_us)
 if [ "$JOB_CMD" = "_nimbo_launch_and_setup" ]; then
     echo "Setup complete. You can now use 'nimbo ssh $1' to ssh into this instance."
+    upload_timings
     exit 0
 elif [ "$JOB_CMD" = "_nimbo_notebook" ]; then
     if ! conda env export | grep -q jupyterlab; then
@@ -96,15 +319,25 @@ elif [ "$JOB_CMD" = "_nimbo_notebook" ]; then
     fi
     nohup jupyter lab --no-browser --port 57467 --autoreload --ServerApp.token="" >/tmp/nimbo-notebook-logs 2>&1 &
     echo "Notebook running at http://localhost:57467/lab"
+    record_span "notebook start" $SPAN_START
+    upload_timings
     exit 0
+elif [ "$JOB_CMD" = "_nimbo_schedule" ]; then
+    echo "Running the jobs packed on this instance, see $LOCAL_RESULTS_PATH/nimbo-jobs"
+    $AGENT_PYTHON /home/ubuntu/nimbo_schedule.py nimbo_jobs.json \
+        $LOCAL_RESULTS_PATH/nimbo-jobs
 else
     echo "Running job: ${@:2}"
     eval ${@:2}
 fi
+record_span "job" $SPAN_START
 
 echo ""
 echo "Saving results to S3..."
+SPAN_START=$(now_us)
+kill -TERM $UPLOADER_PID && wait $UPLOADER_PID
 $S3SYNC $LOCAL_RESULTS_PATH $S3_RESULTS_PATH
+record_span "results upload" $SPAN_START
 
 conda deactivate
 echo ""
@@ -6,13 +6,9 @@ from typing import Any, Dict, Optional, Union
 
 import pydantic
 
-from nimbo.core.config import (
-    AwsConfig,
-    CloudProvider,
-    GcpConfig,
-    RequiredCase,
-    yaml_loader,
-)
+from nimbo.core.config import CloudProvider, RequiredCase, yaml_loader
+from nimbo.core.config.aws_config import AwsConfig
+from nimbo.core.config.gcp_config import GcpConfig
 
 CONDA_ENV = "env.yml"
 ASSETS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "assets")
@@ -114,6 +114,13 @@ def test_run_job(runner: CliRunner):
     result = runner.invoke(cli, "launch-and-setup --dry-run", catch_exceptions=False)
     assert result.exit_code == 0
 
+    result = runner.invoke(
+        cli,
+        "sweep 'python train.py --lr={lr}' -p lr=0.1,0.01 --dry-run",
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0
+
     result = runner.invoke(cli, "test-access --dry-run", catch_exceptions=False)
     assert result.exit_code == 0
 
@@ -1,10 +1,15 @@
+import json
+import os
+import subprocess
+import sys
+
 import pytest
 from click.testing import CliRunner
 
 from nimbo import CONFIG
 from nimbo.core.cloud_provider.provider_impl.aws.aws_provider import AwsProvider
 from nimbo.core.config import RequiredCase
-from nimbo.tests.aws.utils import isolated_filesystem
+from nimbo.tests.aws.utils import isolated_filesystem, make_file
 
 
 @pytest.fixture
@@ -37,3 +42,1248 @@ def test_get_image_id(runner: CliRunner):
     CONFIG.image = "ami-198571934781039"
     CONFIG.region_name = reference_region
     AwsProvider._get_image_id()
+
+
+def test_disk_cache_ttl(tmp_path, monkeypatch):
+    from nimbo.core import cache
+
+    monkeypatch.setattr(cache, "NIMBO_CACHE_DIR", str(tmp_path))
+
+    assert cache.load("identity", "default", ttl=60) is None
+    cache.store("identity", "default", {"UserId": "AIDA", "Arn": "arn"})
+    assert cache.load("identity", "default", ttl=60) == {"UserId": "AIDA", "Arn": "arn"}
+    assert cache.load("identity", "other", ttl=60) is None
+    assert cache.load("identity", "default", ttl=-1) is None
+
+
+def test_caller_identity_cached_per_access_key(tmp_path, monkeypatch):
+    import types
+
+    from nimbo.core import cache
+    from nimbo.core.config import aws_config
+
+    monkeypatch.setattr(cache, "NIMBO_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(aws_config, "_IDENTITIES", {})
+    monkeypatch.setattr(aws_config.api_calls, "instrument", lambda client: client)
+    monkeypatch.setattr(aws_config.api_calls, "client_config", lambda: None)
+    monkeypatch.setattr(CONFIG, "aws_profile", "default")
+
+    lookups = []
+
+    def session(access_key):
+        def get_caller_identity():
+            lookups.append(access_key)
+            return {"UserId": access_key, "Arn": f"arn:aws:iam::1:user/{access_key}"}
+
+        sts = types.SimpleNamespace(get_caller_identity=get_caller_identity)
+        return types.SimpleNamespace(
+            get_credentials=lambda: types.SimpleNamespace(access_key=access_key),
+            client=lambda service, config=None: sts,
+        )
+
+    assert CONFIG._get_caller_identity(session("AKIAOLD"))["UserId"] == "AKIAOLD"
+    assert CONFIG._get_caller_identity(session("AKIAOLD"))["UserId"] == "AKIAOLD"
+    # Rotated keys behind the same profile resolve to the new identity
+    assert CONFIG._get_caller_identity(session("AKIANEW"))["UserId"] == "AKIANEW"
+    assert lookups == ["AKIAOLD", "AKIANEW"]
+
+    # The on-disk copy is kept per access key too
+    monkeypatch.setattr(aws_config, "_IDENTITIES", {})
+    assert CONFIG._get_caller_identity(session("AKIAOLD"))["UserId"] == "AKIAOLD"
+    assert lookups == ["AKIAOLD", "AKIANEW"]
+
+
+def test_s3_sync_plan():
+    from nimbo.core.cloud_provider.provider_impl.aws.s3_sync import (
+        FileInfo,
+        make_plan,
+        split_s3_path,
+    )
+
+    assert split_s3_path("s3://bucket") == ("bucket", "")
+    assert split_s3_path("s3://bucket/a/b/") == ("bucket", "a/b/")
+    with pytest.raises(ValueError):
+        split_s3_path("bucket/a")
+
+    source = {
+        "same.txt": FileInfo(10, 100.0),
+        "resized.txt": FileInfo(11, 100.0),
+        "newer.txt": FileInfo(10, 200.0),
+        "new.txt": FileInfo(1, 100.0),
+    }
+    target = {
+        "same.txt": FileInfo(10, 150.0),
+        "resized.txt": FileInfo(10, 150.0),
+        "newer.txt": FileInfo(10, 150.0),
+        "stale.txt": FileInfo(10, 150.0),
+    }
+
+    plan = make_plan(source, target)
+    assert plan.transfer == ["new.txt", "newer.txt", "resized.txt"]
+    assert plan.delete == []
+    assert make_plan(source, target, delete=True).delete == ["stale.txt"]
+
+
+def test_code_manifest_diff(tmp_path, monkeypatch):
+    from nimbo.core import manifest
+
+    monkeypatch.chdir(tmp_path)
+    make_file("a.py", "print('a')")
+    make_file("b.py", "print('b')")
+
+    first = manifest.build(["a.py", "b.py"])
+    assert manifest.diff(first, {}) == (["a.py", "b.py"], [])
+    assert manifest.diff(manifest.build(["a.py", "b.py"], first), first) == ([], [])
+
+    make_file("a.py", "print('changed')")
+    second = manifest.build(["a.py"], first)
+    assert manifest.diff(second, first) == (["a.py"], ["b.py"])
+
+
+def test_aggregate_spot_prices():
+    from dateutil.parser import isoparse
+
+    from nimbo.tests.aws.config import ASSETS_PATH
+
+    with open(os.path.join(ASSETS_PATH, "spot_price_history.json")) as f:
+        records = json.load(f)["SpotPriceHistory"]
+    for record in records:
+        record["Timestamp"] = isoparse(record["Timestamp"])
+
+    rows = AwsProvider._aggregate_spot_prices(records)
+
+    assert [row[:2] for row in rows] == [
+        ["g4dn.xlarge", "eu-west-1c"],
+        ["p3.2xlarge", "eu-west-1b"],
+        ["p3.2xlarge", "eu-west-1a"],
+    ]
+    assert rows[2][2] == pytest.approx(0.918)
+    assert rows[2][3] == pytest.approx(0.918)
+    assert rows[2][4] == pytest.approx((0.918 + 0.99) / 2)
+
+
+@pytest.fixture
+def ec2(monkeypatch):
+    """ An offline EC2 client returned for every CONFIG.get_client call """
+
+    import boto3
+
+    client = boto3.client(
+        "ec2",
+        region_name="eu-west-1",
+        aws_access_key_id="testing",
+        aws_secret_access_key="testing",
+    )
+    monkeypatch.setattr(type(CONFIG), "get_client", lambda *args, **kwargs: client)
+    monkeypatch.setattr(CONFIG, "user_id", "AIDATEST")
+    return client
+
+
+def test_terminate_all_in_region_pages_and_batches(ec2):
+    from botocore.stub import Stubber
+
+    ids = [f"i-{i:017x}" for i in range(1001)]
+
+    def page(instance_ids, **extra):
+        instances = [{"InstanceId": i} for i in instance_ids]
+        return {"Reservations": [{"Instances": instances}], **extra}
+
+    def terminated(instance_ids):
+        return {
+            "TerminatingInstances": [
+                {"InstanceId": i, "CurrentState": {"Code": 32, "Name": "shutting-down"}}
+                for i in instance_ids
+            ]
+        }
+
+    with Stubber(ec2) as stubber:
+        stubber.add_response("describe_instances", page(ids[:600], NextToken="t"))
+        stubber.add_response("describe_instances", page(ids[600:]))
+        stubber.add_response(
+            "terminate_instances", terminated(ids[:1000]), {"InstanceIds": ids[:1000]}
+        )
+        stubber.add_response(
+            "terminate_instances", terminated(ids[1000:]), {"InstanceIds": ids[1000:]}
+        )
+
+        statuses = AwsProvider._terminate_all_in_region("eu-west-1")
+        stubber.assert_no_pending_responses()
+
+    assert [instance_id for instance_id, _ in statuses] == ids
+
+
+def test_block_until_instance_running_gives_up(ec2, monkeypatch):
+    from botocore.stub import Stubber
+
+    from nimbo.core.cloud_provider.provider_impl.aws.services import aws_instance
+
+    clock = [0.0]
+    monkeypatch.setattr(aws_instance.time, "monotonic", lambda: clock[0])
+    monkeypatch.setattr(
+        aws_instance.time, "sleep", lambda s: clock.__setitem__(0, clock[0] + s)
+    )
+
+    def described(status, **extra):
+        instance = {"InstanceId": "i-0123", "State": {"Name": status}, **extra}
+        return {"Reservations": [{"Instances": [instance]}]}
+
+    with Stubber(ec2) as stubber:
+        # A running instance in a private subnet never gets a public IP
+        stubber.add_response("describe_instances", described("pending"))
+        for _ in range(20):
+            stubber.add_response("describe_instances", described("running"))
+        with pytest.raises(RuntimeError, match="without a public IP"):
+            AwsProvider._block_until_instance_running("i-0123")
+
+    clock[0] = 0.0
+    with Stubber(ec2) as stubber:
+        # An instance stuck in pending
+        for _ in range(200):
+            stubber.add_response("describe_instances", described("pending"))
+        with pytest.raises(RuntimeError, match="did not start within"):
+            AwsProvider._block_until_instance_running("i-0123")
+
+    assert clock[0] >= aws_instance._INSTANCE_START_TIMEOUT
+
+
+def test_acquire_pooled_instance(ec2, monkeypatch):
+    from datetime import datetime
+
+    from botocore.stub import Stubber
+
+    monkeypatch.setattr(CONFIG, "warm_pool_size", 2)
+    monkeypatch.setattr(CONFIG, "instance_type", "p3.2xlarge")
+    monkeypatch.setattr(CONFIG, "image", "ami-0123456789abcdef0")
+    monkeypatch.setattr(CONFIG, "conda_env", None)
+
+    pooled = [
+        {"InstanceId": f"i-{i:017x}", "LaunchTime": datetime(2021, 1, i)}
+        for i in range(1, 4)
+    ]
+
+    def started(instance_id, previous_state):
+        codes = {"pending": 0, "stopped": 80}
+        return {
+            "StartingInstances": [
+                {
+                    "InstanceId": instance_id,
+                    "CurrentState": {"Code": 0, "Name": "pending"},
+                    "PreviousState": {
+                        "Code": codes[previous_state],
+                        "Name": previous_state,
+                    },
+                }
+            ]
+        }
+
+    with Stubber(ec2) as stubber:
+        stubber.add_response(
+            "describe_instances", {"Reservations": [{"Instances": pooled}]}
+        )
+        # The least recently used instance is beyond the pool size
+        stubber.add_response(
+            "terminate_instances", {}, {"InstanceIds": [pooled[0]["InstanceId"]]}
+        )
+        # The most recent one was resumed by another process in the meantime
+        stubber.add_response(
+            "start_instances",
+            started(pooled[2]["InstanceId"], "pending"),
+            {"InstanceIds": [pooled[2]["InstanceId"]]},
+        )
+        stubber.add_response(
+            "start_instances",
+            started(pooled[1]["InstanceId"], "stopped"),
+            {"InstanceIds": [pooled[1]["InstanceId"]]},
+        )
+
+        assert AwsProvider._acquire_pooled_instance() == pooled[1]["InstanceId"]
+        stubber.assert_no_pending_responses()
+
+
+def test_get_image_id_per_region(monkeypatch):
+    images = {"eu-west-1": "ami-0123456789abcdef0", "us-east-1": "ami-0fedcba987654321"}
+    monkeypatch.setattr(CONFIG, "image", images)
+    monkeypatch.setattr(CONFIG, "conda_env", None)
+
+    monkeypatch.setattr(CONFIG, "region_name", "us-east-1")
+    assert AwsProvider._get_image_id() == "ami-0fedcba987654321"
+
+    monkeypatch.setattr(CONFIG, "region_name", "us-east-2")
+    with pytest.raises(ValueError):
+        AwsProvider._get_image_id()
+
+
+def test_get_image_id_prefers_baked_image(ec2, monkeypatch, tmp_path):
+    from botocore.stub import ANY, Stubber
+
+    env_file = tmp_path / "env.yml"
+    env_file.write_text("name: test\n")
+    monkeypatch.setattr(CONFIG, "image", "ami-0123456789abcdef0")
+    monkeypatch.setattr(CONFIG, "conda_env", str(env_file))
+    AwsProvider._find_baked_image.cache_clear()
+
+    baked = [
+        {"ImageId": "ami-00000000000000001", "CreationDate": "2021-05-01T10:00:00Z"},
+        {"ImageId": "ami-00000000000000002", "CreationDate": "2021-06-01T10:00:00Z"},
+    ]
+
+    with Stubber(ec2) as stubber:
+        stubber.add_response(
+            "describe_images", {"Images": baked}, {"Owners": ["self"], "Filters": ANY}
+        )
+        assert AwsProvider._get_image_id() == "ami-00000000000000002"
+        # The lookup is only made once per process
+        assert AwsProvider._get_image_id() == "ami-00000000000000002"
+
+        env_file.write_text("name: changed\n")
+        stubber.add_response("describe_images", {"Images": []})
+        assert AwsProvider._get_image_id() == "ami-0123456789abcdef0"
+        stubber.assert_no_pending_responses()
+
+    AwsProvider._find_baked_image.cache_clear()
+
+
+def test_bake_image_after_foreground_setup(ec2, monkeypatch, tmp_path):
+    from botocore.stub import ANY, Stubber
+
+    from nimbo.core.cloud_provider.provider_impl.aws.services.aws_instance import (
+        AwsInstance,
+    )
+
+    env_file = tmp_path / "env.yml"
+    env_file.write_text("name: test\n")
+    monkeypatch.setattr(CONFIG, "image", "ami-0123456789abcdef0")
+    monkeypatch.setattr(CONFIG, "conda_env", str(env_file))
+    monkeypatch.setattr(CONFIG, "run_in_background", True)
+    monkeypatch.setattr(CONFIG, "stage_required_files", CONFIG.stage_required_files)
+    monkeypatch.setattr(CONFIG, "warm_pool_size", CONFIG.warm_pool_size)
+    monkeypatch.setattr(AwsInstance, "_list_datasets", lambda: {})
+
+    events = []
+
+    def run_once(job_cmd, *args):
+        events.append(("remote setup", CONFIG.run_in_background))
+        return {
+            "message": job_cmd + "_success",
+            "instance_id": "i-0123",
+            "exit_code": 0,
+        }
+
+    monkeypatch.setattr(AwsInstance, "_run_once", run_once)
+    monkeypatch.setattr(
+        AwsInstance, "delete_instance", lambda instance_id: events.append("delete")
+    )
+    ec2.meta.events.register(
+        "before-parameter-build.ec2.CreateImage",
+        lambda **kwargs: events.append("create image"),
+    )
+
+    with Stubber(ec2) as stubber:
+        stubber.add_response(
+            "create_image",
+            {"ImageId": "ami-00000000000000001"},
+            {
+                "InstanceId": "i-0123",
+                "Name": ANY,
+                "Description": ANY,
+                "TagSpecifications": ANY,
+            },
+        )
+        stubber.add_response(
+            "describe_images",
+            {"Images": [{"ImageId": "ami-00000000000000001", "State": "available"}]},
+        )
+        assert AwsProvider.bake_image() == "ami-00000000000000001"
+        stubber.assert_no_pending_responses()
+
+    # The setup ran to completion on the instance before it was imaged
+    assert events == [("remote setup", False), "create image", "delete"]
+
+
+def test_snapshot_datasets_after_foreground_staging(ec2, monkeypatch):
+    from botocore.stub import ANY, Stubber
+
+    from nimbo.core.cloud_provider.provider_impl.aws.services.aws_instance import (
+        AwsInstance,
+    )
+
+    monkeypatch.setattr(CONFIG, "s3_datasets_path", "s3://bucket/datasets")
+    monkeypatch.setattr(CONFIG, "run_in_background", True)
+    monkeypatch.setattr(CONFIG, "warm_pool_size", CONFIG.warm_pool_size)
+    monkeypatch.setattr(CONFIG, "dataset_snapshot_fast_restore_zones", [])
+    monkeypatch.setattr(AwsInstance, "_list_datasets", lambda: {})
+    monkeypatch.setattr(AwsInstance, "_find_datasets_snapshot", lambda *args: None)
+    monkeypatch.setattr(AwsInstance, "_datasets_volume_id", lambda i: "vol-0123")
+
+    events = []
+
+    def run_once(job_cmd, *args):
+        events.append(("remote setup", CONFIG.run_in_background))
+        return {
+            "message": job_cmd + "_success",
+            "instance_id": "i-0123",
+            "exit_code": 0,
+        }
+
+    monkeypatch.setattr(AwsInstance, "_run_once", run_once)
+    monkeypatch.setattr(
+        AwsInstance, "delete_instance", lambda instance_id: events.append("delete")
+    )
+    ec2.meta.events.register(
+        "before-parameter-build.ec2.CreateSnapshot",
+        lambda **kwargs: events.append("create snapshot"),
+    )
+
+    with Stubber(ec2) as stubber:
+        stubber.add_response(
+            "create_snapshot",
+            {"SnapshotId": "snap-0123"},
+            {"VolumeId": "vol-0123", "Description": ANY, "TagSpecifications": ANY},
+        )
+        stubber.add_response(
+            "describe_snapshots",
+            {"Snapshots": [{"SnapshotId": "snap-0123", "State": "completed"}]},
+        )
+        assert AwsProvider.snapshot_datasets() == "snap-0123"
+        stubber.assert_no_pending_responses()
+
+    # Staging finished and the volume was unmounted before the snapshot
+    assert events == [("remote setup", False), "create snapshot", "delete"]
+
+
+def test_datasets_block_device_uses_newest_snapshot(ec2, monkeypatch):
+    from datetime import datetime
+
+    from botocore.stub import ANY, Stubber
+
+    monkeypatch.setattr(CONFIG, "dataset_snapshots", True)
+    monkeypatch.setattr(CONFIG, "s3_datasets_path", "s3://bucket/datasets")
+    AwsProvider._find_datasets_snapshot.cache_clear()
+
+    snapshots = [
+        {"SnapshotId": f"snap-{i:017x}", "StartTime": datetime(2021, 1, i)}
+        for i in (2, 3, 1)
+    ]
+    for snapshot in snapshots:
+        snapshot["VolumeSize"] = 100
+
+    ebs_config = {"VolumeSize": 64, "VolumeType": "gp2"}
+    with Stubber(ec2) as stubber:
+        stubber.add_response(
+            "describe_snapshots",
+            {"Snapshots": snapshots},
+            {"OwnerIds": ["self"], "Filters": ANY},
+        )
+        assert AwsProvider._datasets_block_device(None, ebs_config) == {
+            "DeviceName": "/dev/sdf",
+            "Ebs": {
+                "VolumeType": "gp2",
+                "DeleteOnTermination": True,
+                "SnapshotId": f"snap-{3:017x}",
+            },
+        }
+        # Volumes for updating the snapshot are grown to the size given
+        device = AwsProvider._datasets_block_device(150, ebs_config)
+        assert device["Ebs"]["VolumeSize"] == 150
+        stubber.assert_no_pending_responses()
+
+    monkeypatch.setattr(CONFIG, "dataset_snapshots", False)
+    assert AwsProvider._datasets_block_device(None, ebs_config) is None
+    AwsProvider._find_datasets_snapshot.cache_clear()
+
+
+def test_timing_spans_round_trip():
+    import threading
+
+    from nimbo.core import timing
+
+    timing.collect()
+    with timing.span("ssh ready"):
+        pass
+    with pytest.raises(RuntimeError):
+        with timing.span("code sync"):
+            raise RuntimeError
+
+    # Other threads, such as the instances of a sweep, record their own spans
+    def record_other():
+        with timing.span("other"):
+            pass
+
+    thread = threading.Thread(target=record_other)
+    thread.start()
+    thread.join()
+
+    spans = timing.collect()
+    assert [s["name"] for s in spans] == ["ssh ready", "code sync"]
+    assert timing.collect() == []
+
+    # A remote span whose line was cut off is skipped
+    text = timing.dumps(spans) + '{"name": "conda'
+    assert timing.loads(text) == spans
+    assert timing.chrome_trace(spans[::-1])["traceEvents"] == spans
+
+
+def test_api_calls_coalesce_concurrent_describes(monkeypatch):
+    import threading
+    import time
+
+    import boto3
+    import botocore.awsrequest
+
+    from nimbo.core import api_calls
+
+    def make_client(access_key):
+        return api_calls.instrument(
+            boto3.client(
+                "ec2",
+                region_name="eu-west-1",
+                aws_access_key_id=access_key,
+                aws_secret_access_key="testing",
+                config=api_calls.client_config(),
+            )
+        )
+
+    # The clients of two profiles, which may see different instances
+    client, other_client = make_client("testing"), make_client("other")
+    monkeypatch.setattr(api_calls, "_calls", api_calls.collections.Counter())
+    monkeypatch.setattr(api_calls, "_retries", api_calls.collections.Counter())
+    monkeypatch.setattr(api_calls, "_coalesced", api_calls.collections.Counter())
+
+    sent = []
+
+    def respond(model, **kwargs):
+        sent.append(model.name)
+        time.sleep(0.2)
+        parsed = {"Reservations": [], "ResponseMetadata": {"RetryAttempts": 1}}
+        return botocore.awsrequest.AWSResponse(None, 200, {}, None), parsed
+
+    client.meta.events.register("before-call", respond)
+    other_client.meta.events.register("before-call", respond)
+
+    responses = []
+    threads = [
+        threading.Thread(
+            target=lambda c=c: responses.append(
+                c.describe_instances(InstanceIds=["i-0123"])
+            )
+        )
+        for c in [client] * 4 + [other_client] * 2
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Calls with other parameters, and calls that change anything, are sent
+    client.describe_instances(InstanceIds=["i-4567"])
+    client.terminate_instances(InstanceIds=["i-0123"])
+
+    # One call per client, and the one with other parameters
+    assert sent == ["DescribeInstances"] * 3 + ["TerminateInstances"]
+    assert len(responses) == 6 and all(r["Reservations"] == [] for r in responses)
+    assert responses[0] is not responses[1]
+    assert api_calls.stats() == [
+        {
+            "service": "ec2",
+            "operation": "DescribeInstances",
+            "calls": 3,
+            "retries": 3,
+            "coalesced": 4,
+        },
+        {
+            "service": "ec2",
+            "operation": "TerminateInstances",
+            "calls": 1,
+            "retries": 1,
+            "coalesced": 0,
+        },
+    ]
+
+
+def test_read_s3_log_fetches_only_new_bytes(monkeypatch, capsysbinary):
+    import io
+
+    import boto3
+    from botocore.response import StreamingBody
+    from botocore.stub import Stubber
+
+    def body(data):
+        return StreamingBody(io.BytesIO(data), len(data))
+
+    s3 = boto3.client(
+        "s3",
+        region_name="eu-west-1",
+        aws_access_key_id="testing",
+        aws_secret_access_key="testing",
+    )
+    monkeypatch.setattr(type(CONFIG), "get_client", lambda *args, **kwargs: s3)
+    monkeypatch.setattr(CONFIG, "s3_results_path", "s3://bucket/results")
+
+    instance_id = "i-0123456789abcdef0"
+    log_key = f"results/nimbo-logs/2021-01-01_00-00-00_{instance_id}.txt"
+    parts = [(0, b"epoch 1\n"), (8, b"epoch 2\n"), (16, b"epoch 3\n")]
+
+    with Stubber(s3) as stubber:
+        stubber.add_response(
+            "list_objects_v2",
+            {
+                "Contents": [{"Key": "results/nimbo-logs/2020-12-31_i-other.txt"}],
+                "CommonPrefixes": [{"Prefix": log_key + ".parts/"}],
+            },
+            {"Bucket": "bucket", "Prefix": "results/nimbo-logs/", "Delimiter": "/"},
+        )
+        stubber.add_client_error("get_object", "NoSuchKey", http_status_code=404)
+        stubber.add_response(
+            "list_objects_v2",
+            {
+                "Contents": [
+                    {"Key": f"{log_key}.parts/{offset:012d}", "Size": len(data)}
+                    for offset, data in parts
+                ]
+            },
+        )
+        # Bytes 0 to 12 were already streamed over ssh
+        stubber.add_response(
+            "get_object",
+            {"Body": body(b"2\n")},
+            {
+                "Bucket": "bucket",
+                "Key": f"{log_key}.parts/000000000008",
+                "Range": "bytes=4-",
+            },
+        )
+        stubber.add_response(
+            "get_object",
+            {"Body": body(parts[2][1])},
+            {"Bucket": "bucket", "Key": f"{log_key}.parts/000000000016"},
+        )
+
+        offset, last_part = AwsProvider._read_s3_log(instance_id, 12)
+        stubber.assert_no_pending_responses()
+
+    assert offset == 24
+    assert last_part == f"{log_key}.parts/000000000016"
+    assert capsysbinary.readouterr().out == b"2\nepoch 3\n"
+
+
+def test_notebook_port_forward_reports_failure(monkeypatch, capsys):
+    from nimbo.core.cloud_provider.provider_impl.aws.services import aws_instance
+
+    commands = []
+
+    def call(cmd, stderr=None, **kwargs):
+        commands.append(cmd)
+        stderr.write(b"bind [127.0.0.1]:57467: Address already in use\n")
+        return 255
+
+    monkeypatch.setattr(aws_instance.subprocess, "call", call)
+    AwsProvider._forward_notebook_port("198.51.100.1")
+
+    # A dedicated connection, so the tunnel outlives the multiplexed master
+    assert "ControlMaster=no" in commands[0] and "-NfL" in commands[0]
+    output = " ".join(capsys.readouterr().out.split())
+    assert "Address already in use" in output
+
+
+def test_expand_sweep():
+    from nimbo.core.utils import expand_sweep
+
+    assert expand_sweep(["python a.py"], []) == ["python a.py"]
+    assert expand_sweep(
+        ["python a.py --lr={lr} --bs={bs}", "python b.py"],
+        ["lr=0.1,0.01", "bs=32"],
+    ) == [
+        "python a.py --lr=0.1 --bs=32",
+        "python a.py --lr=0.01 --bs=32",
+        "python b.py",
+    ]
+    with pytest.raises(ValueError):
+        expand_sweep(["python a.py"], ["lr"])
+
+
+def test_pack_jobs():
+    from nimbo.core.scheduler import Resources, instance_resources, pack
+
+    capacity = instance_resources("p3.8xlarge")
+    assert capacity == Resources(gpus=4, cpus=32, memory=244)
+
+    # Largest jobs are packed first, smaller ones fill the remaining GPUs
+    requirements = [Resources(1, 4, 16), Resources(3, 4, 16), Resources(2, 4, 16)]
+    requirements += [Resources(1, 4, 16)]
+    assert pack(requirements, capacity) == [[0, 1], [2, 3]]
+
+    # CPUs and memory limit packing as well as GPUs
+    assert pack([Resources(1, 20, 16)] * 2, capacity) == [[0], [1]]
+
+    assert pack([Resources(1, 4, 16)] * 10, capacity, max_instances=2) == [
+        [0, 1, 2, 3, 8, 9],
+        [4, 5, 6, 7],
+    ]
+
+    with pytest.raises(ValueError):
+        pack([Resources(8, 4, 16)], capacity)
+    with pytest.raises(ValueError):
+        instance_resources("t3.medium")
+
+
+def test_wait_for_spot_request_falls_back(ec2, monkeypatch):
+    from botocore.stub import ANY, Stubber
+
+    from nimbo.core.cloud_provider.provider_impl.aws.services import aws_instance
+
+    monkeypatch.setattr(aws_instance.time, "sleep", lambda _: None)
+
+    def spot_request(request_id, code, **extra):
+        return {"SpotInstanceRequestId": request_id, "Status": {"Code": code}, **extra}
+
+    with Stubber(ec2) as stubber:
+        stubber.add_response(
+            "describe_spot_instance_requests",
+            {
+                "SpotInstanceRequests": [
+                    spot_request("sir-1", "capacity-not-available"),
+                    spot_request("sir-2", "pending-fulfillment"),
+                ]
+            },
+        )
+        stubber.add_response(
+            "describe_spot_instance_requests",
+            {
+                "SpotInstanceRequests": [
+                    spot_request("sir-2", "fulfilled", InstanceId="i-2")
+                ]
+            },
+            # Requests that failed are no longer polled
+            {"SpotInstanceRequestIds": ["sir-2"], "Filters": ANY},
+        )
+
+        winner = AwsProvider._wait_for_spot_request(["sir-1", "sir-2"])
+        assert winner["InstanceId"] == "i-2"
+
+        stubber.add_response(
+            "describe_spot_instance_requests",
+            {"SpotInstanceRequests": [spot_request("sir-1", "price-too-low")]},
+        )
+        with pytest.raises(Exception, match="price-too-low"):
+            AwsProvider._wait_for_spot_request(["sir-1"])
+
+
+def test_wait_for_spot_request_stops_when_cancelled(ec2):
+    import threading
+
+    from botocore.stub import Stubber
+
+    cancelled = threading.Event()
+    cancelled.set()
+
+    with Stubber(ec2):
+        # Any request would fail, as none is stubbed
+        with pytest.raises(RuntimeError, match="Sweep cancelled"):
+            AwsProvider._wait_for_spot_request(["sir-1"], cancelled)
+
+
+def test_sweep_job_fails_when_remote_setup_fails(monkeypatch):
+    import threading
+
+    from nimbo.core.cloud_provider.provider_impl.aws.services import aws_instance
+    from nimbo.core.cloud_provider.provider_impl.aws.services.aws_instance import (
+        AwsInstance,
+    )
+
+    released = []
+    monkeypatch.setattr(CONFIG, "persist", False)
+    monkeypatch.setattr(CONFIG, "dataset_snapshots", False)
+    monkeypatch.setattr(AwsInstance, "_launch_instance", lambda **kwargs: "i-0123")
+    monkeypatch.setattr(
+        AwsInstance, "_block_until_instance_running", lambda i: "1.2.3.4"
+    )
+    monkeypatch.setattr(AwsInstance, "_block_until_ssh_ready", lambda host: None)
+    monkeypatch.setattr(AwsInstance, "_ssh_cmd", lambda: "ssh")
+    monkeypatch.setattr(AwsInstance, "_scp_cmd", lambda: "scp")
+    monkeypatch.setattr(AwsInstance, "_sync_code", lambda host, i: None)
+    monkeypatch.setattr(aws_instance.manifest, "load", lambda name: {"a.py": "0"})
+    monkeypatch.setattr(aws_instance.subprocess, "check_output", lambda *a, **k: b"")
+    monkeypatch.setattr(AwsInstance, "_run_remote_script", lambda *args: 255)
+    monkeypatch.setattr(AwsInstance, "_release_instance", released.append)
+    monkeypatch.setattr(AwsInstance, "_upload_timings", lambda i: None)
+
+    row = {"cmd": "python train.py", "schedule": None, "instance_id": ""}
+    AwsInstance._provision_sweep_job(row, {}, "", False, threading.Event())
+
+    assert row["status"] == "failed"
+    assert "exited with code 255" in row["error"]
+    assert released == ["i-0123"]
+
+
+def _load_script(name):
+    """ Import one of the agents shipped to instances, which are not a package """
+
+    import importlib.util
+
+    import nimbo
+
+    script = os.path.join(os.path.dirname(nimbo.__file__), "scripts", f"{name}.py")
+    spec = importlib.util.spec_from_file_location(name, script)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_background_spot_jobs_only_watched_on_request(monkeypatch):
+    from nimbo.core.cloud_provider.provider_impl.aws.services.aws_instance import (
+        AwsInstance,
+    )
+
+    monkeypatch.setattr(CONFIG, "spot", True)
+    monkeypatch.setattr(CONFIG, "run_in_background", True)
+    monkeypatch.setattr(CONFIG, "persist", False)
+
+    watched = []
+    monkeypatch.setattr(
+        AwsInstance,
+        "_wait_for_spot_termination",
+        lambda instance_id, timeout: watched.append((instance_id, timeout)) or True,
+    )
+    result = {"message": "train_success", "instance_id": "i-0123", "exit_code": 0}
+
+    # A detached run returns right away
+    assert not AwsInstance._was_spot_interrupted("train", result)
+    assert watched == []
+
+    assert AwsInstance._was_spot_interrupted("train", result, watch_spot=True)
+    assert watched == [("i-0123", None)]
+
+
+def test_spot_watch_reads_interruption_notice():
+    import threading
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+    spot_watch = _load_script("nimbo_spot_watch")
+
+    notice = {"action": "terminate", "time": "2021-06-01T12:00:00Z"}
+    polls = []
+
+    class MetadataStandIn(BaseHTTPRequestHandler):
+        """ Answers like the instance metadata service, interrupting on poll 3 """
+
+        def do_PUT(self):
+            self._reply(200, b"token")
+
+        def do_GET(self):
+            polls.append(self.headers.get("X-aws-ec2-metadata-token"))
+            if len(polls) < 3:
+                self._reply(404, b"")
+            else:
+                self._reply(200, json.dumps(notice).encode("utf-8"))
+
+        def _reply(self, code, body):
+            self.send_response(code)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), MetadataStandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        url = f"http://127.0.0.1:{server.server_port}"
+        assert spot_watch.wait_for_interruption(url, interval=0.01) == notice
+    finally:
+        server.shutdown()
+
+    assert polls == ["token"] * 3
+
+
+@pytest.fixture
+def stage_agent(monkeypatch, tmp_path):
+    """ nimbo_stage.py with its part files in tmp_path and an offline S3 client """
+
+    import boto3
+
+    stage = _load_script("nimbo_stage")
+    monkeypatch.setattr(stage, "PARTS_DIR", str(tmp_path / "parts"))
+    os.makedirs(stage.PARTS_DIR)
+
+    s3 = boto3.client(
+        "s3",
+        region_name="eu-west-1",
+        aws_access_key_id="testing",
+        aws_secret_access_key="testing",
+    )
+    return stage, s3
+
+
+def _staged_object(tmp_path, data, etag=None):
+    import hashlib
+
+    return {
+        "bucket": "bucket",
+        "key": "datasets/train.bin",
+        "size": len(data),
+        "etag": etag or hashlib.md5(data).hexdigest(),
+        "mtime": 1600000000.0,
+        "path": str(tmp_path / "datasets" / "train.bin"),
+    }
+
+
+def _body(data):
+    import io
+
+    from botocore.response import StreamingBody
+
+    return StreamingBody(io.BytesIO(data), len(data))
+
+
+def _part_path(stage, obj):
+    import hashlib
+
+    path_hash = hashlib.sha1(obj["path"].encode("utf-8")).hexdigest()
+    return os.path.join(stage.PARTS_DIR, f"{path_hash}.{obj['etag']}")
+
+
+def test_stage_skips_staged_files(stage_agent, tmp_path):
+    from botocore.stub import Stubber
+
+    stage, s3 = stage_agent
+    obj = _staged_object(tmp_path, b"0123456789")
+    os.makedirs(os.path.dirname(obj["path"]))
+    make_file(obj["path"], "0123456789")
+    os.utime(obj["path"], (obj["mtime"], obj["mtime"]))
+
+    with Stubber(s3):
+        # Any request would fail, as none is stubbed
+        stage.download(s3, obj)
+
+
+def test_stage_resumes_partial_download(stage_agent, tmp_path):
+    from botocore.stub import Stubber
+
+    stage, s3 = stage_agent
+    obj = _staged_object(tmp_path, b"0123456789")
+    with open(_part_path(stage, obj), "wb") as f:
+        f.write(b"0123")
+
+    with Stubber(s3) as stubber:
+        stubber.add_response(
+            "get_object",
+            {"Body": _body(b"456789")},
+            {
+                "Bucket": "bucket",
+                "Key": obj["key"],
+                "Range": "bytes=4-",
+                "IfMatch": obj["etag"],
+            },
+        )
+        stage.download(s3, obj)
+        stubber.assert_no_pending_responses()
+
+    with open(obj["path"], "rb") as f:
+        assert f.read() == b"0123456789"
+    assert os.stat(obj["path"]).st_mtime == obj["mtime"]
+    assert os.listdir(stage.PARTS_DIR) == []
+
+
+def test_stage_discards_part_of_changed_object(stage_agent, tmp_path):
+    from botocore.stub import Stubber
+
+    stage, s3 = stage_agent
+    # A multipart object, whose ETag is no MD5 of the content, that has changed
+    # since the last launch downloaded part of it
+    old = _staged_object(tmp_path, b"0123456789", etag="a" * 32 + "-2")
+    new = _staged_object(tmp_path, b"abcdefghij", etag="b" * 32 + "-2")
+    with open(_part_path(stage, old), "wb") as f:
+        f.write(b"0123")
+
+    with Stubber(s3) as stubber:
+        stubber.add_response(
+            "get_object",
+            {"Body": _body(b"abcdefghij")},
+            {
+                "Bucket": "bucket",
+                "Key": new["key"],
+                "Range": "bytes=0-",
+                "IfMatch": new["etag"],
+            },
+        )
+        stage.download(s3, new)
+        stubber.assert_no_pending_responses()
+
+    with open(new["path"], "rb") as f:
+        assert f.read() == b"abcdefghij"
+    assert os.listdir(stage.PARTS_DIR) == []
+
+
+def test_stage_rejects_etag_mismatch(stage_agent, tmp_path):
+    from botocore.stub import Stubber
+
+    stage, s3 = stage_agent
+    obj = _staged_object(tmp_path, b"0123456789")
+
+    with Stubber(s3) as stubber:
+        stubber.add_response("get_object", {"Body": _body(b"0123456780")})
+        with pytest.raises(IOError, match="ETag mismatch"):
+            stage.download(s3, obj)
+
+    assert not os.path.exists(obj["path"])
+    assert os.listdir(stage.PARTS_DIR) == []
+
+
+def test_stage_skips_md5_check_of_kms_objects(stage_agent, tmp_path):
+    from botocore.stub import Stubber
+
+    stage, s3 = stage_agent
+    # The ETag of an SSE-KMS object looks like an MD5 but is not one
+    obj = _staged_object(tmp_path, b"0123456789", etag="c" * 32)
+
+    with Stubber(s3) as stubber:
+        stubber.add_response(
+            "get_object",
+            {"Body": _body(b"0123456789"), "ServerSideEncryption": "aws:kms"},
+        )
+        stage.download(s3, obj)
+
+    with open(obj["path"], "rb") as f:
+        assert f.read() == b"0123456789"
+
+
+def test_stage_creates_ready_file_before_other_files(
+    stage_agent, monkeypatch, tmp_path
+):
+    import time
+
+    stage, s3 = stage_agent
+    ready_file = str(tmp_path / "ready")
+    seen_ready = []
+
+    def download(client, obj):
+        if obj == "other":
+            # Wait for the ready file, which must not depend on this download
+            deadline = time.monotonic() + 5
+            while not os.path.exists(ready_file) and time.monotonic() < deadline:
+                time.sleep(0.01)
+        seen_ready.append((obj, os.path.exists(ready_file)))
+
+    monkeypatch.setattr(stage, "download", download)
+    stage.stage(s3, ["required"], ["other"], 2, ready_file)
+
+    assert sorted(seen_ready) == [("other", True), ("required", False)]
+    assert os.path.exists(ready_file)
+
+
+class _RecordingS3:
+    """ Records the uploads of nimbo_upload.py """
+
+    def __init__(self):
+        import threading
+
+        self.files = []
+        self.log_parts = {}
+        self._lock = threading.Lock()
+
+    def upload_file(self, path, bucket, key, ExtraArgs=None):
+        with self._lock:
+            self.files.append(key)
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.log_parts[Key] = Body
+
+
+@pytest.fixture
+def upload_agent(monkeypatch, tmp_path):
+    """ A nimbo_upload.py uploader of tmp_path/results, with fast batches """
+
+    import types
+
+    upload = _load_script("nimbo_upload")
+    monkeypatch.setattr(upload, "BATCH_WINDOW", 0.2)
+    monkeypatch.setattr(upload, "LOG_INTERVAL", 0.2)
+
+    results = tmp_path / "results"
+    results.mkdir()
+    # Staged before the uploader started, so never uploaded
+    make_file(str(results / "staged.txt"), "staged")
+    os.utime(results / "staged.txt", (1600000000, 1600000000))
+    make_file(str(tmp_path / "log.txt"), "")
+
+    args = types.SimpleNamespace(
+        sse=None,
+        local_log=str(tmp_path / "log.txt"),
+        s3_log="s3://bucket/results/nimbo-logs/log.txt",
+        local_results=str(results),
+        s3_results="s3://bucket/results",
+    )
+    client = _RecordingS3()
+    return upload, upload.Uploader(client, args), client
+
+
+def _start_watch(upload, uploader, stopping, flushing):
+    import threading
+
+    inotify = upload.Inotify()
+    inotify.add_tree(uploader.results_path)
+    thread = threading.Thread(
+        target=upload.watch, args=(uploader, inotify, stopping, flushing)
+    )
+    thread.start()
+    return thread
+
+
+def _wait_for(condition, timeout=5):
+    import time
+
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_upload_batches_written_files(upload_agent):
+    upload, uploader, client = upload_agent
+    stopping, flushing = [], []
+    thread = _start_watch(upload, uploader, stopping, flushing)
+
+    try:
+        os.makedirs(os.path.join(uploader.results_path, "epoch-1"))
+        for name in ("epoch-1/model.ckpt", "epoch-1/metrics.json"):
+            make_file(os.path.join(uploader.results_path, name), name)
+
+        assert _wait_for(lambda: len(client.files) == 2)
+        # A file written again is uploaded again, an unchanged one is not
+        make_file(os.path.join(uploader.results_path, "epoch-1/metrics.json"), "v2")
+        assert _wait_for(lambda: len(client.files) == 3)
+    finally:
+        stopping.append(True)
+        thread.join()
+
+    assert sorted(client.files[:2]) == [
+        "results/epoch-1/metrics.json",
+        "results/epoch-1/model.ckpt",
+    ]
+    assert client.files[2] == "results/epoch-1/metrics.json"
+
+
+def test_upload_flushes_on_request_and_when_stopping(upload_agent, monkeypatch):
+    upload, uploader, client = upload_agent
+    # Batches and log ticks that never come due, so only flushes upload
+    monkeypatch.setattr(upload, "BATCH_WINDOW", 60)
+    monkeypatch.setattr(upload, "LOG_INTERVAL", 60)
+    stopping, flushing = [], []
+    thread = _start_watch(upload, uploader, stopping, flushing)
+
+    try:
+        make_file(os.path.join(uploader.results_path, "checkpoint.pt"), "weights")
+        with open(uploader.log_path, "a") as f:
+            f.write("epoch 1\n")
+        flushing.append(True)
+        assert _wait_for(
+            lambda: client.files == ["results/checkpoint.pt"] and client.log_parts
+        )
+
+        make_file(os.path.join(uploader.results_path, "final.pt"), "weights")
+        with open(uploader.log_path, "a") as f:
+            f.write("epoch 2\n")
+    finally:
+        stopping.append(True)
+        thread.join()
+
+    assert client.files == ["results/checkpoint.pt", "results/final.pt"]
+    assert "results/staged.txt" not in client.files
+    # The log was shipped with the flush and the rest of it when stopping
+    assert client.log_parts == {
+        "results/nimbo-logs/log.txt.parts/000000000000": b"epoch 1\n",
+        "results/nimbo-logs/log.txt.parts/000000000008": b"epoch 2\n",
+    }
+
+
+def test_upload_retries_failed_uploads(upload_agent):
+    upload, uploader, client = upload_agent
+    path = os.path.join(uploader.results_path, "model.ckpt")
+    make_file(path, "weights")
+    with open(uploader.log_path, "a") as f:
+        f.write("epoch 1\n")
+
+    def fail(*args, **kwargs):
+        raise IOError("Connection reset")
+
+    upload_file, put_object = client.upload_file, client.put_object
+    client.upload_file, client.put_object = fail, fail
+    uploader.upload_results([path])
+    uploader.upload_log()
+    assert client.files == [] and client.log_parts == {}
+
+    # Neither the file nor the log chunk was recorded as uploaded
+    client.upload_file, client.put_object = upload_file, put_object
+    uploader.upload_results([path])
+    uploader.upload_log()
+    uploader.executor.shutdown()
+
+    assert client.files == ["results/model.ckpt"]
+    assert client.log_parts == {
+        "results/nimbo-logs/log.txt.parts/000000000000": b"epoch 1\n"
+    }
+
+
+def test_upload_non_utf8_file_names(upload_agent):
+    upload, uploader, client = upload_agent
+    stopping, flushing = [], []
+    thread = _start_watch(upload, uploader, stopping, flushing)
+
+    try:
+        name = os.fsdecode(b"epoch-\xff.ckpt")
+        make_file(os.path.join(uploader.results_path, name), "weights")
+        assert _wait_for(lambda: client.files == [f"results/{name}"])
+    finally:
+        stopping.append(True)
+        thread.join()
+
+
+def test_upload_signal_handlers(upload_agent):
+    import signal
+
+    upload, _, _ = upload_agent
+    stopping, flushing = [], []
+    previous = {
+        signum: signal.getsignal(signum) for signum in (signal.SIGTERM, signal.SIGUSR1)
+    }
+
+    try:
+        upload.install_signal_handlers(stopping, flushing)
+        os.kill(os.getpid(), signal.SIGUSR1)
+        assert _wait_for(lambda: flushing == [True]) and not stopping
+        os.kill(os.getpid(), signal.SIGTERM)
+        assert _wait_for(lambda: stopping == [True])
+    finally:
+        for signum, handler in previous.items():
+            signal.signal(signum, handler)
+
+
+# Budget for 'import nimbo.main', which every nimbo invocation pays
+IMPORT_TIME_BUDGET_MS = 200
+
+
+def test_cli_import_time():
+    import nimbo
+
+    env = {k: v for k, v in os.environ.items() if k != "NIMBO_ENV"}
+    src_dir = os.path.dirname(os.path.dirname(os.path.abspath(nimbo.__file__)))
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [src_dir, env.get("PYTHONPATH")]))
+    code = (
+        "import sys, nimbo.main; heavy = ['boto3', 'botocore', 'pydantic', 'rich',"
+        " 'pkg_resources', 'yaml']; print([m for m in heavy if m in sys.modules])"
+    )
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+
+    assert result.stdout.strip() == "[]"
+
+    # The last line of -X importtime is the cumulative time of nimbo.main in us
+    cumulative_us = int(result.stderr.strip().splitlines()[-1].split("|")[1])
+    assert cumulative_us / 1000 < IMPORT_TIME_BUDGET_MS
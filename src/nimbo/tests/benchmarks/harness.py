@@ -0,0 +1,231 @@
+"""
+Offline stand-ins for AWS, ssh and the network, and the measurements compared
+against the stored baselines.
+
+AWS calls are answered in process from a botocore before-call hook on every
+client created by boto3, so that the real session and client caching of the
+config is exercised. subprocess.Popen, which also backs check_output and run,
+is replaced by a fake that succeeds at once.
+
+Run pytest with NIMBO_UPDATE_BENCHMARKS=1 to store new baselines.
+"""
+
+import collections
+import functools
+import io
+import json
+import os
+import subprocess
+import threading
+import time
+import types
+from typing import Any, Callable, Dict, NamedTuple
+
+import boto3
+import botocore.awsrequest
+import botocore.response
+
+BASELINES_PATH = os.path.join(os.path.dirname(__file__), "baselines.json")
+# Wall time may exceed the baseline by this factor, or by WALL_SLACK seconds on
+# benchmarks that are too fast for a factor to be meaningful
+WALL_TOLERANCE = 3.0
+WALL_SLACK = 0.5
+
+
+class Measurement(NamedTuple):
+    api_calls: Dict[str, int]
+    sessions: int
+    clients: int
+    spawns: int
+    wall_s: float
+
+
+def streaming_body(data: bytes) -> botocore.response.StreamingBody:
+    return botocore.response.StreamingBody(io.BytesIO(data), len(data))
+
+
+def client_error(code: str) -> Dict[str, Any]:
+    return {"Error": {"Code": code, "Message": code}}
+
+
+class FakeAws:
+    """ Answers boto3 calls by operation name and counts them """
+
+    def __init__(self):
+        self.handlers: Dict[str, Callable[[Dict, str], Dict]] = {}
+        self.calls = collections.Counter()
+        self.sessions = 0
+        self.clients = 0
+        self._lock = threading.Lock()
+        # before-call only sees the serialised request, so the parameters of
+        # the call are kept from before-parameter-build, per calling thread
+        self._params = threading.local()
+
+    def on(self, operation: str, handler: Callable[[Dict, str], Dict]) -> None:
+        """ Answer calls to operation, such as DescribeInstances, with handler """
+
+        self.handlers[operation] = handler
+
+    def install(self, monkeypatch) -> None:
+        for name in ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"):
+            monkeypatch.setenv(name, "testing")
+        monkeypatch.delenv("AWS_PROFILE", raising=False)
+
+        original_init = boto3.Session.__init__
+        original_client = boto3.Session.client
+
+        def init(session, *args, **kwargs):
+            with self._lock:
+                self.sessions += 1
+            original_init(session, *args, **kwargs)
+
+        def client(session, *args, **kwargs):
+            with self._lock:
+                self.clients += 1
+            c = original_client(session, *args, **kwargs)
+            c.meta.events.register("before-parameter-build.*.*", self._keep_params)
+            c.meta.events.register(
+                "before-call.*.*",
+                functools.partial(self._respond, region=c.meta.region_name),
+            )
+            return c
+
+        monkeypatch.setattr(boto3.Session, "__init__", init)
+        monkeypatch.setattr(boto3.Session, "client", client)
+
+    def _keep_params(self, params, **kwargs):
+        self._params.value = dict(params)
+
+    def _respond(self, model, region, **kwargs):
+        with self._lock:
+            self.calls[model.name] += 1
+
+        handler = self.handlers.get(model.name)
+        if handler is None:
+            raise AssertionError(f"Unexpected call to {model.name} in {region}")
+
+        parsed = handler(self._params.value, region)
+        status = 400 if "Error" in parsed else 200
+        return botocore.awsrequest.AWSResponse(None, status, {}, None), parsed
+
+
+class FakePopen:
+    """ A process that succeeds at once, standing in for ssh, scp and rsync """
+
+    spawns = 0
+    _lock = threading.Lock()
+
+    def __init__(self, args, stdin=None, stdout=None, stderr=None, **kwargs):
+        with FakePopen._lock:
+            FakePopen.spawns += 1
+        self.args = args
+        self.returncode = None
+        self.stdin = io.BytesIO() if stdin == subprocess.PIPE else None
+        self._stdout = b"" if stdout == subprocess.PIPE else None
+        self._stderr = b"" if stderr == subprocess.PIPE else None
+
+    def communicate(self, input=None, timeout=None):
+        self.returncode = 0
+        return self._stdout, self._stderr
+
+    def poll(self):
+        self.returncode = 0
+        return self.returncode
+
+    def wait(self, timeout=None):
+        return self.poll()
+
+    def kill(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.wait()
+
+
+class FakeSocket:
+    """ Accepts every connection, so instances are ready for ssh right away """
+
+    def __init__(self, *args):
+        pass
+
+    def settimeout(self, timeout):
+        pass
+
+    def connect_ex(self, address):
+        return 0
+
+    def close(self):
+        pass
+
+
+fake_socket_module = types.SimpleNamespace(
+    socket=FakeSocket, AF_INET=None, SOCK_STREAM=None
+)
+
+
+def install_fake_shell(monkeypatch) -> None:
+    monkeypatch.setattr(FakePopen, "spawns", 0)
+    monkeypatch.setattr(subprocess, "Popen", FakePopen)
+
+
+def measure(aws: FakeAws, func: Callable[[], Any]) -> Measurement:
+    start = time.perf_counter()
+    func()
+    wall_s = time.perf_counter() - start
+
+    return Measurement(
+        api_calls=dict(sorted(aws.calls.items())),
+        sessions=aws.sessions,
+        clients=aws.clients,
+        spawns=FakePopen.spawns,
+        wall_s=round(wall_s, 3),
+    )
+
+
+def load_baselines() -> Dict[str, Dict]:
+    try:
+        with open(BASELINES_PATH, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def check_baseline(name: str, measurement: Measurement) -> None:
+    """
+    Fail when the benchmark makes more API calls, sessions, clients or
+    subprocesses than its baseline, or takes well over its baseline wall time
+    """
+
+    baselines = load_baselines()
+
+    if os.environ.get("NIMBO_UPDATE_BENCHMARKS"):
+        baselines[name] = measurement._asdict()
+        with open(BASELINES_PATH, "w") as f:
+            json.dump(dict(sorted(baselines.items())), f, indent=4)
+            f.write("\n")
+        return
+
+    assert name in baselines, f"No baseline for {name}, see {__name__}"
+    baseline = baselines[name]
+    regressions = []
+
+    for operation, count in measurement.api_calls.items():
+        expected = baseline["api_calls"].get(operation, 0)
+        if count > expected:
+            regressions.append(f"{operation} called {count} times, expected {expected}")
+
+    for key in ("sessions", "clients", "spawns"):
+        if getattr(measurement, key) > baseline[key]:
+            regressions.append(
+                f"{getattr(measurement, key)} {key}, expected {baseline[key]}"
+            )
+
+    wall_s = baseline["wall_s"]
+    wall_limit = max(wall_s * WALL_TOLERANCE, wall_s + WALL_SLACK)
+    if measurement.wall_s > wall_limit:
+        regressions.append(f"took {measurement.wall_s} s, limit {wall_limit:.3f} s")
+
+    assert not regressions, f"{name} regressed: " + "; ".join(regressions)
@@ -0,0 +1,242 @@
+import json
+import os
+import types
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from nimbo import CONFIG
+from nimbo.core import cache, manifest
+from nimbo.core.cloud_provider.provider.services import instance as instance_module
+from nimbo.core.cloud_provider.provider_impl.aws.aws_provider import AwsProvider
+from nimbo.core.cloud_provider.provider_impl.aws.services import aws_permissions
+from nimbo.core.config import aws_config
+from nimbo.core.constants import FULL_REGION_NAMES, INSTANCE_GPU_MAP
+from nimbo.tests.benchmarks.harness import (
+    FakeAws,
+    check_baseline,
+    client_error,
+    fake_socket_module,
+    install_fake_shell,
+    measure,
+    streaming_body,
+)
+
+_INSTANCE_ID = "i-0123456789abcdef0"
+_FILE_SIZE = 1024
+
+
+@pytest.fixture
+def aws(monkeypatch, tmp_path):
+    """ A project in tmp_path, with AWS, ssh and the network stood in for """
+
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("src")
+    for i in range(20):
+        with open(os.path.join("src", f"module_{i}.py"), "w") as f:
+            f.write(f"x = {i}\n")
+    with open("env.yml", "w") as f:
+        f.write("name: bench\n")
+
+    # Start from cold caches, as a new nimbo process would
+    monkeypatch.setattr(aws_config, "_SESSIONS", {})
+    monkeypatch.setattr(aws_config, "_CLIENTS", {})
+    monkeypatch.setattr(aws_config, "_IDENTITIES", {})
+    monkeypatch.setattr(cache, "NIMBO_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setattr(manifest, "_MANIFEST_DIR", str(tmp_path / "manifests"))
+    AwsProvider._find_baked_image.cache_clear()
+    AwsProvider._find_datasets_snapshot.cache_clear()
+
+    settings = {
+        "aws_profile": None,
+        "region_name": "eu-west-1",
+        "image": "ami-0123456789abcdef0",
+        "instance_type": "p3.2xlarge",
+        "disk_size": 64,
+        "instance_key": "key.pem",
+        "security_group": "default",
+        "role": "NimboFullS3AccessRole",
+        "conda_env": "env.yml",
+        "local_datasets_path": "datasets",
+        "local_results_path": "results",
+        "s3_datasets_path": "s3://bucket/datasets",
+        "s3_results_path": "s3://bucket/results",
+        "spot": False,
+        "warm_pool_size": 0,
+        "persist": False,
+        "run_in_background": False,
+        "encryption": None,
+    }
+    for key, value in settings.items():
+        monkeypatch.setattr(CONFIG, key, value)
+
+    fake = FakeAws()
+    fake.install(monkeypatch)
+    fake.on(
+        "GetCallerIdentity",
+        lambda params, region: {
+            "UserId": "AIDATEST",
+            "Arn": "arn:aws:iam::123456789012:user/test",
+            "Account": "123456789012",
+        },
+    )
+
+    install_fake_shell(monkeypatch)
+    monkeypatch.setattr(instance_module, "socket", fake_socket_module)
+    monkeypatch.setattr(
+        aws_permissions.requests,
+        "get",
+        lambda url, **kwargs: types.SimpleNamespace(text="203.0.113.7\n"),
+    )
+    return fake
+
+
+def _objects(keys, prefix, last_modified):
+    return {
+        "Contents": [
+            {
+                "Key": prefix + key,
+                "Size": _FILE_SIZE,
+                "LastModified": last_modified,
+                "ETag": '"etag"',
+            }
+            for key in keys
+        ],
+        "KeyCount": len(keys),
+        "IsTruncated": False,
+    }
+
+
+def test_run_job(aws):
+    running = {
+        "InstanceId": _INSTANCE_ID,
+        "State": {"Code": 16, "Name": "running"},
+        "PublicIpAddress": "198.51.100.1",
+    }
+    aws.on(
+        "DescribeSecurityGroups",
+        lambda params, region: {"SecurityGroups": [{"GroupId": "sg-0123"}]},
+    )
+    aws.on(
+        "AuthorizeSecurityGroupIngress",
+        lambda params, region: client_error("InvalidPermission.Duplicate"),
+    )
+    aws.on("DescribeImages", lambda params, region: {"Images": []})
+    aws.on(
+        "RunInstances",
+        lambda params, region: {"Instances": [{"InstanceId": _INSTANCE_ID}]},
+    )
+    aws.on(
+        "DescribeInstances",
+        lambda params, region: {"Reservations": [{"Instances": [running]}]},
+    )
+    aws.on("PutObject", lambda params, region: {})
+
+    def run():
+        result = AwsProvider.run("python train.py")
+        assert result["message"] == "python train.py_success"
+
+    check_baseline("run_job", measure(aws, run))
+
+
+def test_push_datasets(aws):
+    os.makedirs("datasets")
+    names = [f"part-{i:03d}.bin" for i in range(40)]
+    for name in names:
+        with open(os.path.join("datasets", name), "wb") as f:
+            f.write(b"0" * _FILE_SIZE)
+
+    # Half of the files are already in S3 with the same size and a later mtime
+    newer = datetime.now(timezone.utc) + timedelta(hours=1)
+    listing = _objects(names[:20], "datasets/", newer)
+    aws.on("ListObjectsV2", lambda params, region: listing)
+    aws.on("PutObject", lambda params, region: {"ETag": '"etag"'})
+
+    def push():
+        AwsProvider.push("datasets")
+
+    measurement = measure(aws, push)
+    assert measurement.api_calls["PutObject"] == 20
+    check_baseline("push_datasets", measurement)
+
+
+def test_pull_results(aws):
+    names = [f"epoch-{i:03d}.ckpt" for i in range(30)]
+    listing = _objects(names, "results/", datetime(2021, 1, 1, tzinfo=timezone.utc))
+    aws.on("ListObjectsV2", lambda params, region: listing)
+    aws.on(
+        "HeadObject",
+        lambda params, region: {"ContentLength": _FILE_SIZE, "ETag": '"etag"'},
+    )
+    aws.on(
+        "GetObject",
+        lambda params, region: {
+            "Body": streaming_body(b"0" * _FILE_SIZE),
+            "ContentLength": _FILE_SIZE,
+            "ETag": '"etag"',
+        },
+    )
+
+    def pull():
+        AwsProvider.pull("results")
+
+    measurement = measure(aws, pull)
+    assert len(os.listdir("results")) == len(names)
+    check_baseline("pull_results", measurement)
+
+
+def test_ls_gpu_prices(aws):
+    instance_types = sorted(INSTANCE_GPU_MAP)
+    half = len(instance_types) // 2
+    pages = {
+        None: {
+            "InstanceTypes": [{"InstanceType": t} for t in instance_types[:half]],
+            "NextToken": "page-2",
+        },
+        "page-2": {
+            "InstanceTypes": [{"InstanceType": t} for t in instance_types[half:]]
+        },
+    }
+    aws.on(
+        "DescribeInstanceTypes", lambda params, region: pages[params.get("NextToken")]
+    )
+
+    def price_list(instance_type):
+        dimension = {"pricePerUnit": {"USD": "3.06"}}
+        term = {"priceDimensions": {"dimension": dimension}}
+        return json.dumps({"terms": {"OnDemand": {"term": term}}})
+
+    aws.on(
+        "GetProducts",
+        lambda params, region: {"PriceList": [price_list(params["Filters"][0])]},
+    )
+
+    measurement = measure(aws, AwsProvider.ls_gpu_prices)
+    assert measurement.api_calls["GetProducts"] == len(instance_types)
+    check_baseline("ls_gpu_prices", measurement)
+
+
+def test_delete_all_instances_in_all_regions(aws):
+    def describe(params, region):
+        if region == "af-south-1":
+            return client_error("OptInRequired")
+        instance = {"InstanceId": f"i-{abs(hash(region)) % 16 ** 17:017x}"}
+        return {"Reservations": [{"Instances": [instance]}]}
+
+    def terminate(params, region):
+        return {
+            "TerminatingInstances": [
+                {"InstanceId": i, "CurrentState": {"Code": 32, "Name": "shutting-down"}}
+                for i in params["InstanceIds"]
+            ]
+        }
+
+    aws.on("DescribeInstances", describe)
+    aws.on("TerminateInstances", terminate)
+
+    def delete_all():
+        AwsProvider.delete_all_instances(all_regions=True)
+
+    measurement = measure(aws, delete_all)
+    assert measurement.api_calls["TerminateInstances"] == len(FULL_REGION_NAMES) - 1
+    check_baseline("delete_all_instances_all_regions", measurement)